@@ -1,88 +1,40 @@
-import streamlit as st
-import json
-import io
-import os
 import datetime
-from fpdf import FPDF
-from PIL import Image
-from num2words import num2words
-# Définir les préférences par défaut
-defaut_preferences = {
-    "structure": "Nom de la structure",
-    "adresse": "Adresse de la structure",
-    "finess": "Numéro FINESS",
-    "medecin": "Nom du médecin",
-    "rpps": "Numéro RPPS",
-    "logo": None,
-    "coordonnees": "Coordonnées complètes",
-    "marges": {
-        "haut": 20,
-        "bas": 20,
-        "gauche": 20,
-        "droite": 20
-    }
-}
-# Fonction decomposer les posologies
-import re
-def decomposer_posologie(medicament, dose_totale):
-    """Décompose la posologie en fonction des unités disponibles pour chaque médicament."""
-    
-    decompositions = {
-        "METHADONE GELULES": [40, 20, 10, 5, 1],
-        "METHADONE SIROP": [60, 40, 20, 10, 5, 1],
-        "BUPRENORPHINE HD": [8, 6, 2],
-        "SUBUTEX": [8, 2, 0.4],
-        "OROBUPRE": [8, 2]
-    }
-
-    if medicament not in decompositions or dose_totale <= 0:
-        return {}
-
-    result = {}
-    reste = dose_totale
-
-    for unite in decompositions[medicament]:
-        if reste >= unite:
-            quantite = reste // unite
-            reste = reste % unite
-            result[unite] = quantite
-
-    return result  # Retourne un dictionnaire {unité: quantité}
-
-# Définiton des unités de prise
-from num2words import num2words
-
-def formater_unite(medicament, quantite):
-    """Retourne la bonne unité (gélule, flacon, comprimé) avec l'accord en français."""
-    if medicament == "METHADONE GELULES":
-        unite_nom = "gélule" if quantite == 1 else "gélules"
-    elif medicament == "METHADONE SIROP":
-        unite_nom = "flacon" if quantite == 1 else "flacons"
-    else:  # Pour les comprimés (Buprénorphine HD, Subutex, Orobupré, etc.)
-        unite_nom = "comprimé" if quantite == 1 else "comprimés"
-
-    # Utiliser "une" au lieu de "un" devant gélule
-    quantite_text = "une" if quantite == 1 and unite_nom in ["gélule"] else num2words(quantite, lang='fr')
-
-    return quantite_text, unite_nom
-
-# Charger les préférences utilisateur
-def charger_preferences_utilisateur():
-    try:
-        with open("preferences.json", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return defaut_preferences
-# Sauvegarder les préférences utilisateur
-def sauvegarder_preferences_utilisateur(preferences):
-    with open("preferences.json", "w") as f:
-        json.dump(preferences, f, indent=4)
+import uuid
+import streamlit as st
+import ordo_mesures
+from ordo_apercu import ServiceApercu
+from ordo_preferences import charger_preferences_utilisateur
+from ordo_profils import registre_profils
+from ordo_calendrier import calculer_calendrier, calendrier_csv, calendrier_ics, libelle_dosage
+from ordo_catalogue import catalogue
+from ordo_archive import ouvrir_archive, archiver_ordonnance, rechercher, renouveler
+from ordo_decomposition import resoudre_posologie, MOINS_D_UNITES, MOINS_DE_DOSAGES, POSOLOGIE_MAX_MG
+from ordo_num_secu import (formater_num_secu, calculer_cle_securite_sociale, generer_num_secu_base,
+                           nettoyer_num_secu, est_num_secu_valide)
+from ordo_securite import verifier_ordonnance
+from ordo_rendu import calculer_age, cle_ordonnance, gabarit_pour, rendre_ordonnance
 
 # Interface Streamlit
 st.title("Générateur d'ordonnances sécurisées")
-# Interface de saisie des préférences
+# Mesures de performance (débogage) : activées avant tout le reste pour mesurer chaque étape
+panneau_mesures = st.sidebar.expander("Mesures de performance (débogage)")
+st.session_state.setdefault("mesures_actives", ordo_mesures.actif)
+# Réglage propre à la session : les autres sessions du processus ne sont pas mesurées
+ordo_mesures.activer_contexte(panneau_mesures.checkbox("Mesurer les étapes de génération", key="mesures_actives"))
+# Interface de saisie des préférences : un profil par prescripteur, identifié par son RPPS
 st.sidebar.header("Paramètres de la structure")
-preferences = charger_preferences_utilisateur()
+registre = registre_profils()
+registre.recharger()  # Profils enregistrés depuis une autre session : relus seulement si le dossier a changé
+nouveau_profil = "(Nouveau prescripteur)"
+noms_profils = dict(registre.liste())
+if "profil_enregistre" in st.session_state:
+    st.session_state.profil = st.session_state.pop("profil_enregistre")
+choix_profil = st.sidebar.selectbox("Prescripteur", list(noms_profils) + [nouveau_profil], key="profil",
+                                    format_func=lambda rpps: f"{noms_profils[rpps]} ({rpps})" if rpps in noms_profils else rpps)
+if choix_profil in noms_profils:
+    preferences = registre.preferences(choix_profil)
+else:
+    preferences = charger_preferences_utilisateur()  # preferences.json sert de modèle au nouveau profil
 preferences["structure"] = st.sidebar.text_input("Nom de la structure", preferences["structure"])
 preferences["adresse"] = st.sidebar.text_area("Adresse", preferences["adresse"])
 preferences["finess"] = st.sidebar.text_input("Numéro FINESS", preferences["finess"])
@@ -90,67 +42,125 @@ preferences["medecin"] = st.sidebar.text_input("Nom du médecin", preferences["m
 preferences["rpps"] = st.sidebar.text_input("Numéro RPPS", preferences["rpps"])
 preferences["coordonnees"] = st.sidebar.text_area("Coordonnées", preferences["coordonnees"])
 
-# Gestion du logo
-defaut_logo_path = "logo_structure.png"
+# Gestion du logo (les images sont rangées sous l'empreinte de leur contenu, propres à chaque profil)
 logo_uploaded = st.sidebar.file_uploader("Logo de la structure en haut à gauche (PNG, JPG, JPEG)", type=["png", "jpg", "jpeg"])
 if logo_uploaded:
-    image = Image.open(logo_uploaded).convert("RGBA")
-    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-    image = Image.alpha_composite(white_background, image).convert("RGB")
-    image.save(defaut_logo_path, format="PNG", optimize=True)
-    preferences["logo"] = defaut_logo_path
+    preferences["logo"] = registre.ajouter_image(logo_uploaded)
 else:
     preferences["logo"] = preferences.get("logo", None)
 
 # Gestion du deuxième logo (haut à droite)
-defaut_logo_droit_path = "logo_droit.png"
 logo_droit_uploaded = st.sidebar.file_uploader("Deuxième logo (haut à droite)", type=["png", "jpg", "jpeg"])
 if logo_droit_uploaded:
-    image = Image.open(logo_droit_uploaded).convert("RGBA")
-    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-    image = Image.alpha_composite(white_background, image).convert("RGB")
-    image.save(defaut_logo_droit_path, format="PNG", optimize=True)
-    preferences["logo_droit"] = defaut_logo_droit_path
+    preferences["logo_droit"] = registre.ajouter_image(logo_droit_uploaded)
 else:
     preferences["logo_droit"] = preferences.get("logo_droit", None)
     
 # Gestion de la signature du médecin
-defaut_signature_path = "signature_medecin.png"
 signature_uploaded = st.sidebar.file_uploader("Signature du médecin (PNG, JPG, JPEG)", type=["png", "jpg", "jpeg"])
 
 if signature_uploaded:
-    image = Image.open(signature_uploaded).convert("RGBA")
-    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-    image = Image.alpha_composite(white_background, image).convert("RGB")
-    image.save(defaut_signature_path, format="PNG", optimize=True)
-    preferences["signature"] = defaut_signature_path
+    preferences["signature"] = registre.ajouter_image(signature_uploaded)
 else:
     preferences["signature"] = preferences.get("signature", None)
     
-# Sauvegarde des préférences
+# Sauvegarde des préférences dans le profil du prescripteur
 if st.sidebar.button("Sauvegarder les préférences"):
-    sauvegarder_preferences_utilisateur(preferences)
+    try:
+        rpps_enregistre = registre.enregistrer(preferences)
+    except ValueError as erreur:
+        st.sidebar.error(str(erreur))
+    else:
+        st.session_state.profil_enregistre = rpps_enregistre  # Sélectionne le profil au prochain affichage
+        st.session_state.profil_sauvegarde = True
+        st.rerun()
+if st.session_state.pop("profil_sauvegarde", False):
     st.sidebar.success("Préférences enregistrées avec succès !")
     
+# Liste déroulante des médicaments (catalogue relu automatiquement quand medicaments.json change)
+catalogue_medicaments = catalogue()
+medicament_options = list(catalogue_medicaments) + ["(Champ libre)"]
+
+# Valeurs par défaut du formulaire (les champs sont préremplis par session_state lors d'un renouvellement)
+valeurs_formulaire = {
+    "civilite": "Monsieur", "nom": "NOM", "prenom": "Prénom", "date_naissance": None, "ald_30": "Non",
+    "medicament": medicament_options[0], "posologie": 0, "duree": 1, "rythme": 1, "chevauchement": "Non",
+}
+for cle, valeur in valeurs_formulaire.items():
+    st.session_state.setdefault(cle, valeur)
+if st.session_state.medicament not in medicament_options:  # Retiré du catalogue : conservé en champ libre
+    st.session_state.medicament_libre = st.session_state.medicament
+    st.session_state.medicament = "(Champ libre)"
+
+def renouveler_depuis_archive(identifiant, preferences):
+    """Régénère une ordonnance archivée et préremplit le formulaire avec ses données."""
+    connexion = ouvrir_archive()
+    try:
+        nouvel_identifiant, donnees, pdf = renouveler(connexion, identifiant, preferences)
+    finally:
+        connexion.close()
+    st.session_state.pdf_renouvellement = (pdf, f"ordonnance_{donnees['Nom']}_{nouvel_identifiant}.pdf")
+    st.session_state.setdefault("archives_session", set()).add(nouvel_identifiant)
+    st.session_state.pop("historique_num_secu", None)  # Historique et recherche à relire
+    st.session_state.pop("recherche_terme", None)
+    # Préremplissage du formulaire
+    st.session_state.civilite = donnees["Civilite"]
+    st.session_state.nom = donnees["Nom"]
+    st.session_state.prenom = donnees["Prenom"]
+    st.session_state.date_naissance = donnees["Date_de_Naissance"]
+    st.session_state.ald_30 = donnees["ALD_30"]
+    if donnees["Medicament"] in catalogue_medicaments:  # Nom ou ancien nom (alias) du catalogue
+        st.session_state.medicament = catalogue_medicaments[donnees["Medicament"]].nom
+    else:
+        st.session_state.medicament = "(Champ libre)"
+        st.session_state.medicament_libre = donnees["Medicament"]
+    st.session_state.posologie = donnees["Posologie"]
+    st.session_state.duree = donnees["Duree"]
+    st.session_state.rythme = donnees["Rythme_de_Delivrance"]
+    st.session_state.chevauchement = donnees["Chevauchement_Autorise"]
+    st.session_state.lieu_delivrance_unique = donnees["Lieu_de_Delivrance"]
+    st.session_state.num_secu_renouvele = donnees.get("Numero_Securite_Sociale", "")
+    for cle in [cle for cle in st.session_state if str(cle).startswith("decomp_")]:
+        del st.session_state[cle]  # La décomposition est recalculée à partir de la posologie
+
+# Recherche dans l'archive et renouvellement
+with st.expander("Rechercher / renouveler une ordonnance"):
+    recherche = st.text_input("Nom du patient ou N° SS", key="recherche_archive")
+    if recherche.strip():
+        # Les résultats sont lus une fois par terme recherché, puis après chaque archivage de cette session
+        if st.session_state.get("recherche_terme") != recherche:
+            connexion = ouvrir_archive()
+            try:
+                if est_num_secu_valide(recherche):  # N° SS archivé sur 13 caractères (2A/2B pour la Corse)
+                    st.session_state.recherche_resultats = rechercher(connexion, num_secu=nettoyer_num_secu(recherche)[:13])
+                else:
+                    st.session_state.recherche_resultats = rechercher(connexion, nom=recherche)
+            finally:
+                connexion.close()
+            st.session_state.recherche_terme = recherche
+        resultats = st.session_state.recherche_resultats
+        if resultats:
+            libelles = {r["id"]: f"{r['date_creation'][:10]} – {r['nom']} {r['prenom']} – {r['medicament']} {r['posologie']:g} mg"
+                        for r in resultats}
+            choix = st.selectbox("Ordonnances archivées", list(libelles), format_func=libelles.get)
+            st.button("Renouveler", on_click=renouveler_depuis_archive, args=(choix, preferences))
+        else:
+            st.info("Aucune ordonnance archivée pour cette recherche.")
+    if st.session_state.get("pdf_renouvellement"):
+        pdf_renouvele, nom_fichier_renouvele = st.session_state.pdf_renouvellement
+        st.success("Ordonnance renouvelée et archivée ✅")
+        with ordo_mesures.etape("telechargement"):
+            st.download_button("Télécharger l'ordonnance renouvelée", pdf_renouvele, nom_fichier_renouvele, "application/pdf")
+
 # Interface de saisie de l'ordonnance
 st.header("Créer une ordonnance")
 # Saisie des informations du patient avec valeurs par défaut
 patient_data = {
-    "Civilite": st.selectbox("Civilité", ["Madame", "Monsieur"], index=1),
-    "Nom": st.text_input("Nom du patient", value="NOM"),
-    "Prenom": st.text_input("Prénom du patient", value="Prénom"),
-    "Date_de_Naissance": st.date_input("Date de naissance", value=None, format="DD/MM/YYYY"),
+    "Civilite": st.selectbox("Civilité", ["Madame", "Monsieur"], key="civilite"),
+    "Nom": st.text_input("Nom du patient", key="nom"),
+    "Prenom": st.text_input("Prénom du patient", key="prenom"),
+    "Date_de_Naissance": st.date_input("Date de naissance", format="DD/MM/YYYY", key="date_naissance"),
 }
-from datetime import date
-
-def calculer_age(date_naissance):
-    """Calcule l'âge à partir de la date de naissance."""
-    if date_naissance:
-        today = date.today()
-        age = today.year - date_naissance.year - ((today.month, today.day) < (date_naissance.month, date_naissance.day))
-        return age
-    return None  # Si la date est vide
-
 # Calcul de l'âge si une date est saisie
 age_patient = calculer_age(patient_data["Date_de_Naissance"])
 
@@ -158,49 +168,27 @@ age_patient = calculer_age(patient_data["Date_de_Naissance"])
 if age_patient is not None:
     st.info(f"Âge du patient : {age_patient} ans")
 
-# Numéro sécurité sociale
-import re
-
-def generer_num_secu_base(civilite, date_naissance):
-    """Génère les 5 premiers chiffres du numéro de Sécurité Sociale."""
-    if not date_naissance:
-        return ""  # Pas de génération sans date
-    
-    sexe = "1" if civilite == "Monsieur" else "2"
-    annee = f"{date_naissance.year % 100:02d}"  # Année sur 2 chiffres
-    mois = f"{date_naissance.month:02d}"  # Mois sur 2 chiffres
-    return f"{sexe}{annee}{mois}"  # Retourne 5 premiers chiffres
-
-def formater_num_secu(numero):
-    """Ajoute des espaces au format 0 00 00 00 000 000."""
-    numero = re.sub(r"[^0-9]", "", numero)  # Supprime les caractères non numériques
-    if len(numero) == 13:  # Vérifie que le numéro est bien valide
-        return f"{numero[0]} {numero[1:3]} {numero[3:5]} {numero[5:7]} {numero[7:10]} {numero[10:13]}"
-    return numero  # Retourne tel quel si le format est incorrect
-
-# Fonction pour calculer la clé de Sécurité Sociale
-def calculer_cle_securite_sociale(numero):
-    """Calcule la clé de contrôle pour un numéro de Sécurité Sociale."""
-    numero = re.sub(r"[^0-9]", "", numero)  # Supprime les espaces et caractères non numériques
-    if len(numero) == 13 and numero.isdigit():
-        return 97 - (int(numero) % 97)
-    return None  # ✅ Retourne None si invalide
-
 # Générer les 5 premiers chiffres par défaut
 num_secu_base = generer_num_secu_base(patient_data["Civilite"], patient_data["Date_de_Naissance"])
+# Après un renouvellement, reprendre le N° SS complet s'il correspond toujours au patient saisi
+num_secu_renouvele = st.session_state.get("num_secu_renouvele", "")
+if num_secu_base and num_secu_renouvele.startswith(num_secu_base):
+    num_secu_base = num_secu_renouvele
 
-# Champ de saisie pour entrer/modifier les 13 chiffres du N° SS
+# Champ de saisie pour entrer/modifier les 13 chiffres du N° SS (2A/2B pour la Corse)
 num_secu_complet = st.text_input(
     "Numéro de Sécurité Sociale (13 chiffres)", 
     value=num_secu_base, 
     max_chars=13,
-    help="Les 5 premiers chiffres sont pré-remplis : Sexe (1/2) + Année (2 derniers chiffres) + Mois (2 chiffres). Complétez les 8 autres."
+    help="Les 5 premiers chiffres sont pré-remplis : Sexe (1/2) + Année (2 derniers chiffres) + Mois (2 chiffres). Complétez les 8 autres "
+         "(département 2A ou 2B pour la Corse)."
 )
+num_secu_complet = nettoyer_num_secu(num_secu_complet)
 
 # Vérification si 13 chiffres sont bien saisis
 cle_secu = None  # Valeur par défaut avant validation complète
 num_secu_formatte = ""  # Initialisation
-if len(num_secu_complet) == 13 and re.fullmatch(r"\d{13}", num_secu_complet):
+if len(num_secu_complet) == 13 and est_num_secu_valide(num_secu_complet):
     patient_data["Numero_Securite_Sociale"] = num_secu_complet
     cle_secu = calculer_cle_securite_sociale(patient_data["Numero_Securite_Sociale"])
     num_secu_formatte = formater_num_secu(patient_data["Numero_Securite_Sociale"])  # Formate le numéro
@@ -210,74 +198,44 @@ if cle_secu is not None:
     st.success(f"N° SS : {num_secu_formatte} - Clé : {cle_secu:02d}")
 
 # Sélection ALD 30 : Oui / Non
-patient_data["ALD_30"] = st.selectbox("ALD 30 :", ["Oui", "Non"], index=1)
-
-# Liste déroulante des médicaments
-medicament_options = [
-    "METHADONE GELULES", "METHADONE SIROP", "BUPRENORPHINE HD", "SUBUTEX", "OROBUPRE",
-    "SUBOXONE", "METHYLPHENIDATE", "CONCERTA", "QUASYM", "RITATINE LP",
-    "RITALINE LI", "MEDIKINET", "(Champ libre)"
-]
-selected_medicament = st.selectbox("Médicament", medicament_options)
+patient_data["ALD_30"] = st.selectbox("ALD 30 :", ["Oui", "Non"], key="ald_30")
+
+selected_medicament = st.selectbox("Médicament", medicament_options, key="medicament")
 # Si l'utilisateur choisit "(Champ libre)", lui permettre d'entrer un médicament
 if selected_medicament == "(Champ libre)":
-    selected_medicament = st.text_input("Entrez le médicament")
+    selected_medicament = st.text_input("Entrez le médicament", key="medicament_libre")
 # Assigner correctement la valeur au dictionnaire patient_data
 patient_data["Medicament"] = selected_medicament if selected_medicament else "Non spécifié"
-patient_data["Posologie"] = st.number_input("Posologie (mg/jour)", min_value=0)
-
-from num2words import num2words
-
-def decomposer_posologie(medicament, dose_totale):
-    """Décompose la posologie en fonction des unités disponibles pour chaque médicament."""
-    
-    # Définition des unités disponibles pour chaque médicament
-    decompositions = {
-        "METHADONE GELULES": [40, 20, 10, 5, 1],
-        "METHADONE SIROP": [60, 40, 20, 10, 5, 1],
-        "BUPRENORPHINE HD": [8, 6, 2],
-        "SUBUTEX": [8, 2, 0.4],
-        "OROBUPRE": [8, 2]
-    }
-
-    # Vérifier que le médicament est dans la liste et que la dose est valide
-    if medicament not in decompositions or dose_totale <= 0:
-        return {}
-
-    result = {}  # Dictionnaire qui stocke la décomposition
-    reste = dose_totale
-
-    # Répartition de la dose totale en unités adaptées
-    for unite in decompositions[medicament]:
-        if reste >= unite:
-            quantite = reste // unite
-            reste = reste % unite
-            result[unite] = quantite  # Ajout de l'unité et de la quantité correspondante
-
-    return result  # Retourne un dictionnaire {unité: quantité}
-
-# Générer la décomposition automatique
-decomposition = decomposer_posologie(patient_data["Medicament"], patient_data["Posologie"])
+fiche_medicament = catalogue_medicaments.get(patient_data["Medicament"])
+if fiche_medicament is not None:
+    details = [fiche_medicament.forme, "stupéfiant" if fiche_medicament.stupefiant else None,
+               f"dose maximale {fiche_medicament.dose_max_jour_mg:g} mg/jour" if fiche_medicament.dose_max_jour_mg else None,
+               f"prescription limitée à {fiche_medicament.duree_max_jours} jours" if fiche_medicament.duree_max_jours else None]
+    st.caption(" · ".join(detail for detail in details if detail))
+patient_data["Posologie"] = st.number_input("Posologie (mg/jour)", min_value=0, max_value=POSOLOGIE_MAX_MG,
+                                              key="posologie")
 
 # Affichage et modification manuelle de la décomposition dans Streamlit
 st.subheader("Décomposition de la posologie")
 
-decomposition_modifiee = {}  # Stocke les valeurs modifiées par l'utilisateur
+# Générer la décomposition automatique (optimale selon le critère choisi)
+criteres_decomposition = {"Moins d'unités": MOINS_D_UNITES, "Moins de dosages différents": MOINS_DE_DOSAGES}
+critere = st.radio("Critère de décomposition", list(criteres_decomposition), horizontal=True)
+resultat_decomposition = resoudre_posologie(patient_data["Medicament"], patient_data["Posologie"],
+                                            criteres_decomposition[critere])
+decomposition = resultat_decomposition.decomposition
+if patient_data["Posologie"] > 0 and not resultat_decomposition.exacte and any(resultat_decomposition.doses_proches):
+    doses_proches = " ou ".join(f"{dose} mg" for dose in resultat_decomposition.doses_proches if dose is not None)
+    st.warning(f"{patient_data['Posologie']} mg ne peut pas être obtenu exactement avec les dosages disponibles. "
+               f"Doses possibles les plus proches : {doses_proches}.")
 
-# Liste des unités disponibles en fonction du médicament
-unités_possibles = {
-    "METHADONE GELULES": [40, 20, 10, 5, 1],
-    "METHADONE SIROP": [60, 40, 20, 10, 5, 1],
-    "BUPRENORPHINE HD": [8, 6, 2],
-    "SUBUTEX": [8, 2, 0.4],
-    "OROBUPRE": [8, 2]
-}
+decomposition_modifiee = {}  # Stocke les valeurs modifiées par l'utilisateur
 
-# Vérifier si le médicament est dans la liste
-if patient_data["Medicament"] in unités_possibles:
+# Vérifier si le médicament a des dosages dans le catalogue
+if fiche_medicament is not None and fiche_medicament.dosages:
     total_corrige = 0  # Initialisation du total recalculé
     
-    for unite in unités_possibles[patient_data["Medicament"]]:  # Boucle sur toutes les unités
+    for unite in fiche_medicament.dosages:  # Boucle sur toutes les unités
         quantite = decomposition.get(unite, 0)  # Récupérer la quantité ou 0 par défaut
         nouvelle_valeur = st.number_input(
             f"{quantite} unité(s) de {unite} mg", 
@@ -290,6 +248,7 @@ if patient_data["Medicament"] in unités_possibles:
         total_corrige += nouvelle_valeur * unite  # Ajoute la dose corrigée au total recalculé
 
     # Vérification si le total correspond à la posologie souhaitée
+    total_corrige = round(total_corrige, 3)  # Évite les erreurs d'arrondi avec les dosages décimaux (0,4 mg)
     if total_corrige != patient_data["Posologie"]:
         st.error(f"La somme des corrections ({total_corrige} mg) ne correspond pas à la posologie totale ({patient_data['Posologie']} mg).")
     else:
@@ -303,9 +262,26 @@ decomposition_finale = decomposition_modifiee if decomposition_modifiee else dec
 decomposition_finale = {unite: quantite for unite, quantite in decomposition_finale.items() if quantite > 0}
 
 # Saisies suivantes
-patient_data["Duree"] = st.number_input("Durée du traitement (jours)", min_value=1, step=1)
-patient_data["Rythme_de_Delivrance"] = st.number_input("Rythme de délivrance (jours)", min_value=1, step=1)
-patient_data["Chevauchement_Autorise"] = st.selectbox("Chevauchement autorisé", ["Oui", "Non"], index=1)
+patient_data["Duree"] = st.number_input("Durée du traitement (jours)", min_value=1, step=1, key="duree")
+patient_data["Rythme_de_Delivrance"] = st.number_input("Rythme de délivrance (jours)", min_value=1, step=1, key="rythme")
+patient_data["Chevauchement_Autorise"] = st.selectbox("Chevauchement autorisé", ["Oui", "Non"], key="chevauchement")
+
+# Contrôles de sécurité : dose et durée maximales, puis historique du patient dans l'archive (par N° SS)
+# L'historique est lu une fois par N° SS, puis après chaque archivage de cette session
+historique_patient = []
+if patient_data.get("Numero_Securite_Sociale"):
+    if st.session_state.get("historique_num_secu") != patient_data["Numero_Securite_Sociale"]:
+        connexion = ouvrir_archive()
+        try:
+            st.session_state.historique_patient = rechercher(connexion, num_secu=patient_data["Numero_Securite_Sociale"])
+        finally:
+            connexion.close()
+        st.session_state.historique_num_secu = patient_data["Numero_Securite_Sociale"]
+    # Les ordonnances générées ou renouvelées dans cette session (brouillons corrigés) ne comptent pas
+    historique_patient = [ordonnance for ordonnance in st.session_state.historique_patient
+                          if ordonnance["id"] not in st.session_state.get("archives_session", ())]
+for alerte in verifier_ordonnance(patient_data, historique_patient):
+    st.warning(f"Contrôle de sécurité : {alerte.message}")
 
 # Saisie du lieu de délivrance en multi-ligne, obligatoire
 # Saisie multi-ligne
@@ -323,12 +299,65 @@ if not patient_data["Lieu_de_Delivrance"].strip():
 else:
     lieu_rempli = True
 
-    # Initialisation de l'état de la génération si elle n'existe pas encore
+# Calendrier de délivrance à partir de la date de l'ordonnance
+calendrier = calculer_calendrier(decomposition_finale, patient_data["Duree"], patient_data["Rythme_de_Delivrance"],
+                                 datetime.date.today())
+with st.expander("Calendrier de délivrance"):
+    if decomposition_finale and calendrier:
+        st.dataframe([{"Délivrance": livraison.numero, "Date": livraison.date.strftime("%d/%m/%Y"), "Jours": livraison.jours,
+                       **{libelle_dosage(patient_data["Medicament"], unite): quantite
+                          for unite, quantite in livraison.quantites.items()}}
+                      for livraison in calendrier], hide_index=True)
+        colonne_ics, colonne_csv = st.columns(2)
+        colonne_ics.download_button("Exporter (agenda ICS)", calendrier_ics(patient_data, calendrier),
+                                    f"calendrier_{patient_data['Nom']}.ics", "text/calendar")
+        colonne_csv.download_button("Exporter (CSV)", calendrier_csv(patient_data, calendrier),
+                                    f"calendrier_{patient_data['Nom']}.csv", "text/csv")
+    else:
+        st.info("Le calendrier est disponible dès que la décomposition de la posologie est connue.")
+joindre_calendrier = st.checkbox("Joindre le calendrier de délivrance à l'ordonnance", key="joindre_calendrier")
+calendrier_pdf = calendrier if joindre_calendrier and decomposition_finale else None
+
+# Initialisation de l'état de la génération si elle n'existe pas encore
 if "pdf_ready" not in st.session_state:
     st.session_state.pdf_ready = False
 
-if "pdf_buffer" not in st.session_state:
-    st.session_state.pdf_buffer = None  # Initialisation du buffer PDF
+if "pdf_octets" not in st.session_state:
+    st.session_state.pdf_octets = None  # PDF généré (octets)
+    st.session_state.pdf_cle = None  # Empreinte des données ayant servi à le générer
+    st.session_state.pdf_avertissements = []
+
+# Empreinte des données de l'ordonnance : le PDF n'est régénéré que si elle change
+cle_pdf = cle_ordonnance(preferences, patient_data, decomposition_finale, calendrier=calendrier_pdf)
+
+# Aperçu en direct de la première page, recalculé en arrière-plan seulement quand les données changent
+@st.cache_resource
+def service_apercu():
+    """Service d'aperçu partagé par les sessions (un fil d'exécution, en-têtes dessinés une fois)."""
+    return ServiceApercu()
+
+@st.fragment(run_every=0.2)
+def attendre_apercu(cle_apercu):
+    """Affiche l'aperçu précédent jusqu'à ce que le nouveau soit prêt, puis relance l'affichage complet."""
+    if service_apercu().attendre(cle_apercu, 0.05) is not None or service_apercu().erreur(cle_apercu):
+        st.rerun()
+    if st.session_state.get("apercu_image"):
+        st.image(st.session_state.apercu_image, caption="Mise à jour de l'aperçu…", width="stretch")
+
+with st.expander("Aperçu de l'ordonnance", expanded=True):
+    if st.toggle("Aperçu en direct", value=True, key="apercu_direct"):
+        st.session_state.setdefault("canal_apercu", uuid.uuid4().hex)
+        cle_apercu = cle_ordonnance(preferences, patient_data, decomposition_finale)
+        service_apercu().demander(cle_apercu, gabarit_pour(preferences), dict(patient_data), dict(decomposition_finale),
+                                  datetime.date.today(), canal=st.session_state.canal_apercu)
+        image_apercu = service_apercu().attendre(cle_apercu, 0.1)
+        if image_apercu is not None:
+            st.session_state.apercu_image = image_apercu
+            st.image(image_apercu, width="stretch")
+        elif service_apercu().erreur(cle_apercu):
+            st.warning(f"Aperçu indisponible : {service_apercu().erreur(cle_apercu)}")
+        else:
+            attendre_apercu(cle_apercu)
 
 # Vérification après un clic sur le bouton
 if st.button("Générer l'ordonnance PDF", key="generer_pdf_button"):
@@ -336,175 +365,41 @@ if st.button("Générer l'ordonnance PDF", key="generer_pdf_button"):
         st.error("Le lieu de délivrance est obligatoire. Veuillez le renseigner et le valider.")
         st.session_state.pdf_ready = False  # Bloque la génération
     else:
-        # Marquer que le PDF est en cours de génération
-        st.session_state.pdf_ready = True  
-
-        # Génération du PDF
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", '', 10)
-        pdf.multi_cell(0, 5, f"Lieu de délivrance :\n{patient_data['Lieu_de_Delivrance']}", align="L")
-
-        # Génération du fichier en mémoire
-        buffer = io.BytesIO()
-        buffer.write(pdf.output(dest="S").encode("latin1"))
-        buffer.seek(0)
-
-        # Stocke le fichier PDF dans session_state
-        st.session_state.pdf_buffer = buffer
-        
-# Initialiser le document PDF avant toute action
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_left_margin(preferences["marges"]["gauche"])
-    pdf.set_right_margin(preferences["marges"]["droite"])
-    pdf.set_top_margin(preferences["marges"]["haut"])
-
-# Ajouter le premier logo (après l'initialisation de pdf)
-    if preferences.get("logo") and os.path.exists(preferences["logo"]):
-        try:
-            pdf.image(preferences["logo"], x=10, y=10, w=40)
-        except RuntimeError:
-            st.warning("Erreur lors du chargement du logo : fichier invalide.")
-
-# Bloc info structure
-    pdf.set_xy(10, 50)  # ✅ Plus d'erreur ici
-    pdf.set_font("Arial", 'B', 10)
-    pdf.cell(0, 5, preferences["structure"], ln=True, align="L")
-    pdf.set_x(10)  # Réaligner l'adresse à gauche
-    pdf.set_font("Arial", '', 9)
-    pdf.cell(0, 5, preferences["adresse"], ln=True, align="L")
-    pdf.set_x(10)  # Réaligner le FINESS à gauche
-    pdf.set_font("Arial", '', 10)
-    pdf.cell(0, 5, f"FINESS: {preferences['finess']}", ln=True, align="L")
-
-# Ajout du deuxième logo (haut à droite)
-    if preferences.get("logo_droit") and os.path.exists(preferences["logo_droit"]):
-        try:
-            pdf.image(preferences["logo_droit"], x=150, y=10, w=40)  # Logo à droite (aligné au même niveau)
-        except RuntimeError:
-            st.warning("Erreur lors du chargement du logo de droite : fichier invalide.")
-
-# Bloc identification médecin   
-    pdf.set_xy(150, 50)
-# Écriture du nom du médecin en gras
-    pdf.set_font("Arial", 'B', 10)
-    pdf.cell(0, 5, preferences['medecin'], ln=True, align="C")
-# Écriture du RPPS en standard mais dans la même cellule
-    pdf.set_font("Arial", '', 10)
-    pdf.set_x(150)  # Remet l'alignement en X à la position précédente
-    pdf.cell(0, 5, f"RPPS: {preferences['rpps']}", ln=True, align="C")
-# Afficher la date en toutes lettres
-    from num2words import num2words
-    jours_fr = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
-    mois_fr = ["janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre", "novembre", "décembre"]
-    maintenant = datetime.datetime.now()
-    jour_lettres = num2words(maintenant.day, lang='fr')
-    jour_semaine = jours_fr[maintenant.weekday()]
-    mois_lettres = mois_fr[maintenant.month - 1]
-    date_complete = f"{jour_semaine} {jour_lettres} {mois_lettres} {maintenant.year}"
-# Définir le pdf
-    pdf.set_xy(150, 70)
-    pdf.set_font("Arial", 'B', 10)
-# Vérification et formatage de la date de naissance
-    if patient_data["Date_de_Naissance"]:
-        date_naissance = patient_data["Date_de_Naissance"].strftime("%d/%m/%Y")
-        today = datetime.date.today()
-        birth_date = patient_data["Date_de_Naissance"]
-        age = today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
-    else:
-        date_naissance = "Non renseignée"
-        age = "Non renseigné"
-# Ecrire la date sur le PDF 
-    pdf.cell(0, 5, date_complete, ln=True, align="R")
-# Ecrire le infos patient sur le PDF
-    pdf.cell(0, 10, txt=f"{patient_data['Civilite']} {patient_data['Nom']} {patient_data['Prenom']}", ln=True, align="R")
-    pdf.set_y(pdf.get_y()-2)  # Réduit l'espacement
-    pdf.set_font("Arial", 'I', 9)
-    pdf.cell(0, 5, f"Né(e) le : {date_naissance} (Âge: {age})", ln=True, align="R")
-## Vérifier securité sociale definie avant de les utiliser
-    if "Numero_Securite_Sociale" not in patient_data:
-        patient_data["Numero_Securite_Sociale"] = ""
-    if "cle_secu" not in locals():
-        cle_secu = None
-# Vérifier que les données SS sont bien valides avant d'afficher
-    if patient_data["Numero_Securite_Sociale"] and cle_secu is not None:
-        pdf.set_font("Arial", '', 10)  # Texte standard
-        pdf.cell(0, 5, f"N° Sécurité Sociale : {num_secu_formatte} - Clé : {cle_secu:02d}", ln=True, align="R")
-
-    pdf.set_font("Arial", 'B', 12)  # Texte en gras et taille 12
-
-# Titre
-# Définition du titre selon l'ALD 30
-    titre_prescription = "PRESCRIPTIONS ALD 30" if patient_data["ALD_30"] == "Oui" else "PRESCRIPTIONS MÉDICALES"
-# Position du titre
-    pdf.cell(0, 5, "", ln=True)  # Ligne vide pour espacement
-    y_position = pdf.get_y()  # Récupération de la position actuelle
-# Ajout du premier trait horizontal
-    pdf.set_line_width(0.5)
-    pdf.line(10, y_position, 200, y_position)  # Trait horizontal supérieur
-# Ajout du titre
-    pdf.set_xy(10, y_position + 3)  # Légèrement en dessous du trait
-    pdf.cell(190, 10, titre_prescription, border=0, ln=True, align="C")
-# Ajout du deuxième trait horizontal
-    y_position = pdf.get_y() + 2  # Nouvelle position après le titre
-    pdf.line(10, y_position, 200, y_position)  # Trait horizontal inférieur
-# Ajout d'un espacement après le titre
-    pdf.cell(0, 5, "", ln=True)
-    
-# Ajouter médicament
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0, 20, f"{patient_data['Medicament']} : {num2words(patient_data['Posologie'], lang='fr')} milligrammes par jour", ln=True, align="L")
-    pdf.set_font("Arial", '', 10)
-# Vérifier si la décomposition a été modifiée ou non
-    decomposition_finale = decomposition_modifiee if decomposition_modifiee else decomposition
-# Supprimer les unités de quantité 0 pour l'affichage dans le PDF
-    decomposition_finale = {unite: quantite for unite, quantite in decomposition_finale.items() if quantite > 0}
-# Vérifier s'il reste des unités à afficher
-    if decomposition_finale:
-        pdf.cell(0, 5, "Soit :", ln=True, align="L")  # Titre de la décomposition
-        for unite, quantite in decomposition_finale.items():
-            quantite_text, unite_nom = formater_unite(patient_data["Medicament"], quantite)
-            pdf.cell(0, 5, f"- {quantite_text} {unite_nom} de {num2words(unite, lang='fr')} milligrammes", ln=True, align="L")
-    else:
-        pdf.cell(0, 5, "Décomposition impossible pour ce médicament.", ln=True, align="L")
-    pdf.set_font("Arial", '', 10)
-    pdf.cell(0, 10, f"Pendant : {num2words(patient_data['Duree'], lang='fr')} jours", ln=True, align="L")    
-    pdf.set_font("Arial", '', 10)
-# Vérification pour ajouter (délivrance en une fois) si durée = rythme
-    if patient_data["Rythme_de_Delivrance"] == patient_data["Duree"]:
-        pdf.set_font("Arial", '', 10)
-        pdf.cell(0, 8, f"A délivrer tous les {num2words(patient_data['Rythme_de_Delivrance'], lang='fr')} jours (délivrance en une fois)", ln=True, align="L")
-    else:
-        pdf.set_font("Arial", '', 10)
-        pdf.cell(0, 8, f"A délivrer tous les {num2words(patient_data['Rythme_de_Delivrance'], lang='fr')} jours", ln=True, align="L")
-
-# Autres mentions
-    pdf.cell(0, 5, txt=f"Chevauchement autorisé: {patient_data.get('Chevauchement_Autorise', 'Non spécifié')}", ln=True, align="L")
-    pdf.set_font("Arial", '', 10)
-    pdf.multi_cell(0, 5, f"Lieu de délivrance :\n{patient_data['Lieu_de_Delivrance']}", align="L")
-
-# Position par défaut pour la signature et le nom du médecin
-    y_position_signature = pdf.get_y() + 10  # Position de référence en bas du document
-
-# Vérifier si une signature est téléversée
-    if preferences.get("signature") and os.path.exists(preferences["signature"]):
-        try:
-            pdf.image(preferences["signature"], x=150, y=y_position_signature, w=50)  # Signature alignée à droite
-            y_position_text = y_position_signature + 15  # Décaler le texte sous la signature
-        except RuntimeError:
-            st.warning("Erreur lors du chargement de la signature : fichier invalide.")
-            y_position_text = y_position_signature  # Si erreur, placer le texte à la position initiale
+        # Génération du PDF complet, une seule fois pour des données identiques
+        if st.session_state.pdf_cle != cle_pdf:
+            avertissements = []
+            st.session_state.pdf_octets = rendre_ordonnance(preferences, patient_data, decomposition_finale,
+                                                            avertissements=avertissements, calendrier=calendrier_pdf)
+            st.session_state.pdf_cle = cle_pdf
+            st.session_state.pdf_avertissements = avertissements
+            # Archivage de l'ordonnance générée
+            connexion = ouvrir_archive()
+            try:
+                identifiant = archiver_ordonnance(connexion, patient_data, decomposition_finale, st.session_state.pdf_octets)
+                st.session_state.setdefault("archives_session", set()).add(identifiant)
+                st.session_state.pop("historique_num_secu", None)  # Historique et recherche à relire
+                st.session_state.pop("recherche_terme", None)
+            finally:
+                connexion.close()
+        st.session_state.pdf_ready = True
+
+# Affichage du bouton de téléchargement uniquement si le PDF correspond aux données saisies
+if st.session_state.pdf_ready and st.session_state.pdf_octets:
+    if st.session_state.pdf_cle == cle_pdf:
+        for avertissement in st.session_state.pdf_avertissements:
+            st.warning(avertissement)
+        with ordo_mesures.etape("telechargement"):
+            st.download_button("Télécharger l'ordonnance", st.session_state.pdf_octets, "ordonnance.pdf", "application/pdf")
     else:
-        y_position_text = y_position_signature  # Si pas de signature, mettre le texte à la position initiale
-
-# Ajouter le nom du médecin (sous la signature ou seul)
-    pdf.set_xy(150, y_position_text)  # Position définie
-    pdf.set_font("Arial", '', 10)
-    pdf.cell(50, 5, preferences["medecin"], ln=True, align="C")  # Centré
-
-
-
-# Affichage du bouton de téléchargement uniquement si le PDF a été généré avec succès
-if st.session_state.pdf_ready and st.session_state.pdf_buffer:
-    st.download_button("Télécharger l'ordonnance", st.session_state.pdf_buffer, "ordonnance.pdf", "application/pdf")
+        st.info("Les données ont changé depuis la dernière génération : cliquez sur « Générer l'ordonnance PDF ».")
+
+# Panneau des mesures, rempli en fin de script pour inclure les étapes de cet affichage
+if st.session_state.mesures_actives:
+    with panneau_mesures:
+        lignes_mesures = ordo_mesures.resume()
+        if lignes_mesures:
+            st.dataframe(lignes_mesures, hide_index=True)
+        else:
+            st.caption("Aucune mesure pour l'instant.")
+        st.download_button("Exporter (format Prometheus)", ordo_mesures.format_prometheus(), "ordo_mesures.prom", "text/plain")
+        st.button("Remettre à zéro", on_click=ordo_mesures.reinitialiser)
@@ -0,0 +1,389 @@
+"""Mesures de performance de la chaîne de génération des ordonnances.
+
+Chaque mesure donne le débit (opérations ou documents par seconde), les latences p50/p99
+et la mémoire (RSS) qui lui est propre : chaque lot est rendu dans un sous-processus dont on
+relève le pic, les autres mesures donnent la hausse du pic du processus pendant la mesure.
+Les résultats sont enregistrés en JSON et comparés à une référence pour repérer les régressions.
+
+Exemples :
+    python bench_ordo.py                                  # toutes les mesures, listes de 1, 100 et 10 000 patients
+    python bench_ordo.py --tailles 1 100 --rapide         # mesures courtes
+    python bench_ordo.py --enregistrer-reference          # enregistre bench_reference.json
+    python bench_ordo.py --ecrire-liste patients.csv 1000 # écrit une liste de patients fictifs
+    python bench_ordo.py --imports                        # vérifie seulement les budgets de démarrage
+"""
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from ordo_catalogue import catalogue
+from ordo_decomposition import decomposer_posologie, precalculer_tables
+from ordo_num_secu import formater_num_secu, calculer_cle_securite_sociale
+from ordo_rendu import formater_unite, rendre_ordonnance
+from ordo_preferences import completer_preferences, preparer_image
+from nombres_fr import en_lettres
+
+DATE_BENCH = datetime.date(2024, 1, 15)
+medicaments_bench = list(catalogue().decomposables()) + ["Non spécifié"]  # Plus un médicament hors catalogue
+lieux_bench = ["Pharmacie Centrale\n12 rue des Lilas, 75000 Paris", "Pharmacie du Marché\n3 place de la Mairie, 69000 Lyon"]
+
+def memoire_max_mo(enfants=True):
+    """Mémoire maximale (RSS) du processus, et de ses enfants terminés si `enfants`, en Mo."""
+    import resource
+
+    # Sous Linux, ru_maxrss survit à fork/exec (un sous-processus hériterait du pic de son parent) :
+    # le pic propre au processus est lu dans /proc (VmHWM, en Ko)
+    try:
+        with open("/proc/self/status") as f:
+            pic = next(int(ligne.split()[1]) for ligne in f if ligne.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        pic = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if enfants:
+        pic = max(pic, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return pic / (1024 * 1024) if sys.platform == "darwin" else pic / 1024  # octets sur macOS, Ko sous Linux
+
+def _centile(valeurs_triees, centile):
+    index = min(len(valeurs_triees) - 1, int(round(centile / 100 * (len(valeurs_triees) - 1))))
+    return valeurs_triees[index]
+
+def resume(nom, durees, duree_totale, unite="op", rss_mo=None):
+    """Construit le résultat d'une mesure à partir des durées individuelles (secondes) et de sa mémoire (Mo)."""
+    durees = sorted(durees)
+    return {
+        "nom": nom,
+        "nombre": len(durees),
+        "unite": unite,
+        "debit": len(durees) / duree_totale if duree_totale else None,
+        "p50_ms": _centile(durees, 50) * 1000,
+        "p99_ms": _centile(durees, 99) * 1000,
+        "duree_s": duree_totale,
+        "rss_mo": rss_mo,
+    }
+
+def mesurer(nom, fonction, elements, unite="op"):
+    """Appelle `fonction` sur chaque élément en chronométrant chaque appel."""
+    durees = []
+    pic = memoire_max_mo(enfants=False)
+    debut = time.perf_counter()
+    for element in elements:
+        t = time.perf_counter()
+        fonction(element)
+        durees.append(time.perf_counter() - t)
+    return resume(nom, durees, time.perf_counter() - debut, unite, memoire_max_mo(enfants=False) - pic)
+
+# Données fictives
+def generer_num_secu(civilite, date_naissance, aleatoire):
+    """Génère un N° SS fictif de 13 chiffres cohérent avec la civilité et la date de naissance."""
+    sexe = "1" if civilite == "Monsieur" else "2"
+    return (f"{sexe}{date_naissance.year % 100:02d}{date_naissance.month:02d}"
+            f"{aleatoire.randint(1, 95):02d}{aleatoire.randint(1, 999):03d}{aleatoire.randint(1, 999):03d}")
+
+def generer_liste_patients(nombre, graine=0):
+    """Retourne `nombre` dictionnaires patient_data fictifs (reproductibles pour une graine donnée)."""
+    aleatoire = random.Random(graine)
+    patients = []
+    for index in range(nombre):
+        civilite = aleatoire.choice(["Madame", "Monsieur"])
+        date_naissance = datetime.date(aleatoire.randint(1950, 2005), aleatoire.randint(1, 12), aleatoire.randint(1, 28))
+        medicament = aleatoire.choice(medicaments_bench)
+        unites = catalogue().dosages(medicament) or [10]
+        posologie = sum(aleatoire.choice(unites) for _ in range(aleatoire.randint(1, 4)))
+        duree = aleatoire.choice([7, 14, 28])
+        patients.append({
+            "Civilite": civilite,
+            "Nom": f"PATIENT{index:05d}",
+            "Prenom": aleatoire.choice(["Élodie", "Jérôme", "Anaïs", "François", "Léa"]),
+            "Date_de_Naissance": date_naissance,
+            "Numero_Securite_Sociale": generer_num_secu(civilite, date_naissance, aleatoire),
+            "ALD_30": aleatoire.choice(["Oui", "Non"]),
+            "Medicament": medicament,
+            "Posologie": int(posologie) if float(posologie).is_integer() else round(posologie, 1),
+            "Duree": duree,
+            "Rythme_de_Delivrance": aleatoire.choice([d for d in (1, 7, 14, 28) if d <= duree]),
+            "Chevauchement_Autorise": aleatoire.choice(["Oui", "Non"]),
+            "Lieu_de_Delivrance": aleatoire.choice(lieux_bench),
+        })
+    return patients
+
+def ecrire_liste_csv(chemin, patients):
+    """Écrit une liste de patients au format attendu par ordo_batch.py."""
+    from ordo_batch import colonnes_patient
+
+    with open(chemin, "w", newline="", encoding="utf-8") as f:
+        ecrivain = csv.writer(f)
+        ecrivain.writerow(colonnes_patient)
+        for p in patients:
+            ecrivain.writerow([p["Civilite"], p["Nom"], p["Prenom"], p["Date_de_Naissance"].strftime("%d/%m/%Y"),
+                               p["Numero_Securite_Sociale"], p["ALD_30"], p["Medicament"], p["Posologie"], p["Duree"],
+                               p["Rythme_de_Delivrance"], p["Chevauchement_Autorise"], p["Lieu_de_Delivrance"]])
+
+def generer_images(dossier):
+    """Crée des logos et une signature fictifs (avec transparence) et retourne leurs octets PNG."""
+    from PIL import Image, ImageDraw
+
+    images = {}
+    for nom, taille in (("logo", (600, 300)), ("logo_droit", (400, 400)), ("signature", (800, 250))):
+        image = Image.new("RGBA", taille, (0, 0, 0, 0))
+        dessin = ImageDraw.Draw(image)
+        for i in range(0, taille[0], 20):
+            dessin.line((i, 0, taille[0] - i, taille[1]), fill=(20, 60, 160, 255), width=3)
+        tampon = io.BytesIO()
+        image.save(tampon, format="PNG")
+        images[nom] = tampon.getvalue()
+    return images
+
+def preparer_preferences(dossier, images):
+    """Écrit les images préparées dans `dossier` et retourne des préférences complètes."""
+    preferences = completer_preferences({
+        "structure": "CSAPA Les Tilleuls", "adresse": "4 avenue de la République, 75011 Paris",
+        "finess": "750000000", "medecin": "Dr Martin", "rpps": "10001234567",
+    })
+    for nom, donnees in images.items():
+        preferences[nom] = preparer_image(io.BytesIO(donnees), os.path.join(dossier, f"{nom}.png"))
+    return preferences
+
+# Mesures
+def bench_decomposition(rapide):
+    doses = [dose for dose in range(0, 301)] + [round(0.4 * i, 1) for i in range(1, 751)]
+    elements = [(medicament, dose) for medicament in catalogue().decomposables() for dose in doses]
+    if rapide:
+        elements = elements[::10]
+    precalculer_tables()  # Tables construites hors mesure
+    return [mesurer("decomposition", lambda e: decomposer_posologie(*e), elements)]
+
+def bench_textes(rapide):
+    patients = generer_liste_patients(200 if rapide else 2000, graine=1)
+
+    def textes(p):
+        en_lettres(p["Posologie"])
+        for unite, quantite in decomposer_posologie(p["Medicament"], p["Posologie"]).items():
+            formater_unite(p["Medicament"], quantite)
+            en_lettres(unite)
+        en_lettres(p["Duree"])
+        en_lettres(p["Rythme_de_Delivrance"])
+        en_lettres(DATE_BENCH.day)
+
+    return [mesurer("textes", textes, patients, "ordonnance")]
+
+def bench_num_secu(rapide):
+    import pandas as pd
+    from ordo_num_secu import verifier_num_secu
+
+    patients = generer_liste_patients(1000 if rapide else 10000, graine=2)
+    numeros = [p["Numero_Securite_Sociale"] for p in patients]
+    liste = pd.DataFrame({"N° SS": numeros, "Civilite": [p["Civilite"] for p in patients],
+                          "Date_de_Naissance": [p["Date_de_Naissance"].strftime("%d/%m/%Y") for p in patients]})
+    pic = memoire_max_mo(enfants=False)
+    debut = time.perf_counter()
+    verifier_num_secu(liste)
+    duree = time.perf_counter() - debut
+    return [
+        mesurer("cle_securite_sociale", calculer_cle_securite_sociale, numeros),
+        mesurer("formater_num_secu", formater_num_secu, numeros),
+        resume("verifier_num_secu", [duree / len(numeros)] * len(numeros), duree, "N° SS", memoire_max_mo(enfants=False) - pic),
+    ]
+
+def bench_images(rapide, dossier, images):
+    import ordo_preferences
+
+    elements = [(nom, donnees) for nom, donnees in images.items()] * (1 if rapide else 5)
+
+    def sans_cache(element):
+        ordo_preferences._cache_images.clear()
+        preparer_image(io.BytesIO(element[1]), os.path.join(dossier, f"bench_{element[0]}.png"))
+
+    def avec_cache(element):
+        preparer_image(io.BytesIO(element[1]), os.path.join(dossier, f"bench_{element[0]}.png"))
+
+    resultats = [mesurer("image_preparation", sans_cache, elements, "image")]
+    for element in images.items():  # Cache rempli hors mesure : la mesure « cache » ne voit que des succès
+        avec_cache(element)
+    resultats.append(mesurer("image_preparation_cache", avec_cache, elements, "image"))
+    return resultats
+
+def mesurer_lot(preferences, taille, processus):
+    """Rend une liste de `taille` patients ; appelé seul dans un sous-processus (voir bench_rendu)."""
+    from ordo_parallele import rendre_en_parallele
+
+    liste = generer_liste_patients(taille, graine=4)
+    debut = time.perf_counter()
+    durees = [r.duree for r in rendre_en_parallele(preferences, iter(liste), processus=processus,
+                                                   date_ordonnance=DATE_BENCH) if r.erreur is None]
+    # Pic du sous-processus et de ses processus de rendu : la mémoire de ce lot seul
+    return resume(f"lot_{'serie' if processus == 1 else 'parallele'}_{taille}", durees,
+                  time.perf_counter() - debut, "document", memoire_max_mo())
+
+def bench_rendu(tailles, preferences, processus, dossier):
+    resultats = []
+    patients = generer_liste_patients(min(200, max(tailles)), graine=3)
+    rendre_ordonnance(preferences, patients[0], date_ordonnance=DATE_BENCH)  # Gabarit compilé hors mesure
+    resultats.append(mesurer("rendu_unitaire", lambda p: rendre_ordonnance(preferences, p, date_ordonnance=DATE_BENCH),
+                             patients, "document"))
+    chemin_preferences = os.path.join(dossier, "preferences_bench.json")
+    with open(chemin_preferences, "w") as f:
+        json.dump(preferences, f)
+    for taille in tailles:
+        for nombre_processus in sorted({1, processus}):
+            sortie = subprocess.run([sys.executable, os.path.abspath(__file__), "--mesurer-lot", chemin_preferences,
+                                     str(taille), str(nombre_processus)], capture_output=True, text=True, check=True)
+            resultats.append(json.loads(sortie.stdout))
+    return resultats
+
+def comparer(resultats, reference, tolerance):
+    """Retourne la liste des régressions du rendu (débit ou p99) par rapport à la référence.
+
+    Seules les mesures de documents sont contrôlées : les micro-mesures (moins d'une
+    microseconde par appel) varient trop d'une exécution à l'autre pour servir de seuil.
+    """
+    precedents = {r["nom"]: r for r in reference.get("resultats", [])}
+    regressions = []
+    for r in resultats:
+        ref = precedents.get(r["nom"])
+        if not ref or r["unite"] != "document":
+            continue
+        if ref["debit"] and r["debit"] < ref["debit"] * (1 - tolerance):
+            regressions.append(f"{r['nom']} : débit {r['debit']:.1f}/s contre {ref['debit']:.1f}/s")
+        if ref["p99_ms"] and r["p99_ms"] > ref["p99_ms"] * (1 + tolerance) and r["p99_ms"] - ref["p99_ms"] > 0.05:
+            regressions.append(f"{r['nom']} : p99 {r['p99_ms']:.2f} ms contre {ref['p99_ms']:.2f} ms")
+    return regressions
+
+# Budgets de démarrage à froid (python -X importtime) : nom, code exécuté, budget des imports (ms)
+# et modules lourds qui ne doivent pas être chargés pour cette tâche
+modules_lourds = ("fpdf", "PIL", "num2words", "numpy", "pandas", "streamlit")
+budgets_import = [
+    ("num_secu", "from ordo_num_secu import est_num_secu_valide; est_num_secu_valide('185057800608491')", 10, modules_lourds),
+    ("decomposition", "from ordo_decomposition import decomposer_posologie; decomposer_posologie('SUBUTEX', 10.4)", 25,
+     modules_lourds),
+    ("preferences", "from ordo_preferences import charger_preferences_utilisateur; "
+                    "charger_preferences_utilisateur('preferences_absentes.json')", 25, modules_lourds),
+    ("calendrier", "import ordo_calendrier", 30, modules_lourds),
+    ("securite (import)", "import ordo_securite", 30, modules_lourds),
+    ("rendu (import)", "import ordo_rendu", 40, modules_lourds),
+    ("lot (import)", "import ordo_batch", 80, modules_lourds),
+    ("api (import)", "import ordo_api", 200, modules_lourds),
+]
+
+def mesurer_imports(code, interdits, repetitions=5):
+    """Durée cumulée des imports de `code` dans un processus neuf (ms, meilleure de `repetitions`
+    exécutions, hors imports du démarrage de Python) et modules interdits chargés."""
+    dossier = os.path.dirname(os.path.abspath(__file__))
+    script = f"import sys\n{code}\nprint(','.join(m for m in {tuple(interdits)!r} if m in sys.modules))"
+    meilleure, charges = None, []
+    for _ in range(repetitions):
+        sortie = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=dossier,
+                                capture_output=True, text=True, check=True)
+        total, apres_site = 0, False
+        for ligne in sortie.stderr.splitlines():
+            if not ligne.startswith("import time:"):
+                continue
+            _, cumul, nom = ligne.split("|")
+            if nom.strip() == "site":
+                apres_site, total = True, 0  # Ce qui précède est le démarrage de l'interpréteur
+            elif cumul.strip().isdigit() and not nom.startswith("  "):  # Imports de premier niveau
+                total += int(cumul)
+        meilleure = total if meilleure is None else min(meilleure, total)
+        charges = [module for module in sortie.stdout.strip().split(",") if module]
+    return meilleure / 1000, charges
+
+def verifier_imports(repetitions=5):
+    """Mesure chaque budget de démarrage ; retourne (lignes de résultat, dépassements)."""
+    import compileall
+
+    # Bytecode à jour : la compilation des sources ne doit pas compter dans les imports
+    compileall.compile_dir(os.path.dirname(os.path.abspath(__file__)), maxlevels=0, quiet=1)
+    lignes, depassements = [], []
+    for nom, code, budget_ms, interdits in budgets_import:
+        duree_ms, charges = mesurer_imports(code, interdits, repetitions)
+        lignes.append({"nom": nom, "imports_ms": round(duree_ms, 2), "budget_ms": budget_ms, "modules_lourds": charges})
+        if duree_ms > budget_ms:
+            depassements.append(f"{nom} : imports {duree_ms:.1f} ms pour un budget de {budget_ms} ms")
+        if charges:
+            depassements.append(f"{nom} : charge {', '.join(charges)}")
+    return lignes, depassements
+
+def afficher_imports(lignes):
+    print(f"{'démarrage':<28}{'imports ms':>12}{'budget ms':>11}  modules lourds")
+    for ligne in lignes:
+        print(f"{ligne['nom']:<28}{ligne['imports_ms']:>12.2f}{ligne['budget_ms']:>11}  {', '.join(ligne['modules_lourds']) or '-'}")
+
+def afficher(resultats):
+    print(f"{'mesure':<28}{'nombre':>8}{'débit/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'RSS Mo':>9}")
+    for r in resultats:
+        print(f"{r['nom']:<28}{r['nombre']:>8}{r['debit']:>12.1f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['rss_mo']:>9.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mesures de performance de la génération d'ordonnances.")
+    parser.add_argument("--tailles", type=int, nargs="+", default=[1, 100, 10000], help="Tailles des listes de patients")
+    parser.add_argument("--processus", type=int, default=0, help="Processus pour le rendu parallèle (0 : tous les cœurs)")
+    parser.add_argument("--rapide", action="store_true", help="Mesures réduites")
+    parser.add_argument("--sortie", default="bench_resultats.json", help="Fichier JSON des résultats")
+    parser.add_argument("--reference", default="bench_reference.json", help="Fichier JSON de référence")
+    parser.add_argument("--enregistrer-reference", action="store_true", help="Enregistre les résultats comme référence")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Écart toléré avant de signaler une régression")
+    parser.add_argument("--ecrire-liste", nargs=2, metavar=("CHEMIN", "NOMBRE"), help="Écrit une liste de patients fictifs et s'arrête")
+    parser.add_argument("--imports", action="store_true", help="Vérifie seulement les budgets de démarrage (imports)")
+    parser.add_argument("--mesurer-lot", nargs=3, metavar=("PREFERENCES", "TAILLE", "PROCESSUS"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.mesurer_lot:  # Sous-processus lancé par bench_rendu : le résultat JSON est écrit sur la sortie
+        with open(args.mesurer_lot[0]) as f:
+            preferences = json.load(f)
+        print(json.dumps(mesurer_lot(preferences, int(args.mesurer_lot[1]), int(args.mesurer_lot[2]))))
+        return 0
+
+    if args.ecrire_liste:
+        ecrire_liste_csv(args.ecrire_liste[0], generer_liste_patients(int(args.ecrire_liste[1])))
+        return 0
+
+    imports, depassements = verifier_imports()
+    afficher_imports(imports)
+    for depassement in depassements:
+        print(f"BUDGET DÉPASSÉ {depassement}", file=sys.stderr)
+    if args.imports:
+        return 1 if depassements else 0
+
+    processus = args.processus or os.cpu_count() or 1
+    resultats = []
+    with tempfile.TemporaryDirectory() as dossier:
+        images = generer_images(dossier)
+        preferences = preparer_preferences(dossier, images)
+        resultats += bench_decomposition(args.rapide)
+        resultats += bench_textes(args.rapide)
+        resultats += bench_num_secu(args.rapide)
+        resultats += bench_images(args.rapide, dossier, images)
+        resultats += bench_rendu(args.tailles, preferences, processus, dossier)
+    afficher(resultats)
+
+    rapport = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processus": processus,
+        "resultats": resultats,
+        "imports": imports,
+    }
+    with open(args.sortie, "w") as f:
+        json.dump(rapport, f, indent=4)
+    if args.enregistrer_reference:
+        with open(args.reference, "w") as f:
+            json.dump(rapport, f, indent=4)
+        print(f"Référence enregistrée dans {args.reference}")
+        return 1 if depassements else 0
+    if os.path.exists(args.reference):
+        with open(args.reference) as f:
+            regressions = comparer(resultats, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"RÉGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions or depassements else 0
+    return 1 if depassements else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Nombres en toutes lettres (français) pour les quantités et les dates des ordonnances.
+
+Produit exactement le même texte que num2words(..., lang='fr') sur les nombres imprimés
+(entiers de 0 à 999 999 et décimaux jusqu'au µg comme 0,4 mg), sans importer num2words : les nombres
+de 0 à 999 sont précalculés et les autres sont mémorisés après le premier calcul.
+En dehors de cette plage, le calcul est délégué à num2words.
+
+Vérification et mesure (ajouter « complet » pour vérifier jusqu'à 999 999, plusieurs minutes) :
+    python nombres_fr.py
+"""
+from functools import lru_cache
+
+unites_fr = ["zéro", "un", "deux", "trois", "quatre", "cinq", "six", "sept", "huit", "neuf", "dix",
+             "onze", "douze", "treize", "quatorze", "quinze", "seize"]
+dizaines_fr = {2: "vingt", 3: "trente", 4: "quarante", 5: "cinquante", 6: "soixante"}
+
+# Plus grand entier et nombre maximal de décimales pris en charge sans num2words
+ENTIER_MAX = 999999
+DECIMALES_MAX = 3
+
+def _moins_de_cent(n):
+    """Écrit un nombre de 0 à 99."""
+    if n < 17:
+        return unites_fr[n]
+    if n < 20:
+        return "dix-" + unites_fr[n - 10]
+    dizaine, unite = divmod(n, 10)
+    if dizaine == 7:  # soixante-dix à soixante-dix-neuf
+        return "soixante et onze" if unite == 1 else "soixante-" + _moins_de_cent(n - 60)
+    if dizaine == 8:
+        return "quatre-vingts" if unite == 0 else "quatre-vingt-" + unites_fr[unite]
+    if dizaine == 9:  # quatre-vingt-dix à quatre-vingt-dix-neuf
+        return "quatre-vingt-" + _moins_de_cent(n - 80)
+    if unite == 0:
+        return dizaines_fr[dizaine]
+    if unite == 1:
+        return dizaines_fr[dizaine] + " et un"
+    return dizaines_fr[dizaine] + "-" + unites_fr[unite]
+
+def _moins_de_mille(n):
+    """Écrit un nombre de 0 à 999."""
+    centaine, reste = divmod(n, 100)
+    if centaine == 0:
+        return _moins_de_cent(reste)
+    texte = "cent" if centaine == 1 else unites_fr[centaine] + " cent"
+    if reste == 0:
+        return texte + "s" if centaine > 1 else texte
+    return texte + " " + _moins_de_cent(reste)
+
+# Table précalculée des nombres de 0 à 999
+_table = [_moins_de_mille(n) for n in range(1000)]
+
+def _milliers(n):
+    """Écrit le nombre de milliers devant « mille » (sans « s » final à cents et vingts)."""
+    texte = _table[n]
+    if texte.endswith("cents") or texte.endswith("vingts"):
+        texte = texte[:-1]
+    return texte
+
+def _entier(n):
+    if n < 1000:
+        return _table[n]
+    milliers, reste = divmod(n, 1000)
+    texte = "mille" if milliers == 1 else _milliers(milliers) + " mille"
+    return texte if reste == 0 else texte + " " + _table[reste]
+
+def _feminin(texte):
+    """Accorde au féminin un nombre se terminant par « un » (une, vingt et une...)."""
+    return texte[:-2] + "une" if texte == "un" or texte.endswith(" un") or texte.endswith("-un") else texte
+
+@lru_cache(maxsize=4096, typed=True)
+def _nombre(valeur):
+    if isinstance(valeur, int):
+        if 0 <= valeur <= ENTIER_MAX:
+            return _entier(valeur)
+    elif isinstance(valeur, float):
+        texte = str(valeur)
+        entiere, _, decimale = texte.partition(".")
+        if entiere.isdigit() and decimale.isdigit() and len(decimale) <= DECIMALES_MAX and valeur <= ENTIER_MAX:
+            if int(decimale) == 0:
+                return _entier(int(entiere))
+            return _entier(int(entiere)) + " virgule " + " ".join(unites_fr[int(chiffre)] for chiffre in decimale)
+    from num2words import num2words
+
+    return num2words(valeur, lang='fr')
+
+def en_lettres(valeur, feminin=False):
+    """Retourne `valeur` en toutes lettres, comme num2words(valeur, lang='fr').
+
+    Avec feminin=True, « un » final devient « une » (une gélule).
+    """
+    if isinstance(valeur, bool) or not isinstance(valeur, (int, float)):
+        valeur = float(valeur) if not float(valeur).is_integer() else int(valeur)
+    texte = _nombre(valeur)
+    return _feminin(texte) if feminin else texte
+
+def verifier_contre_num2words(entier_max=ENTIER_MAX, pas_decimal=0.1, decimal_max=300):
+    """Compare en_lettres à num2words sur toute la plage prise en charge.
+
+    Retourne la liste des écarts (valeur, attendu, obtenu), vide si tout concorde.
+    """
+    from num2words import num2words
+
+    ecarts = []
+    valeurs = list(range(entier_max + 1))
+    valeurs += [round(i * pas_decimal, 1) for i in range(int(decimal_max / pas_decimal) + 1)]
+    valeurs += [0.4 * i for i in range(1, 20)]  # Multiples du dosage de 0,4 mg (SUBUTEX)
+    for valeur in valeurs:
+        attendu = num2words(valeur, lang='fr')
+        obtenu = en_lettres(valeur)
+        if attendu != obtenu:
+            ecarts.append((valeur, attendu, obtenu))
+    return ecarts
+
+if __name__ == "__main__":
+    import timeit
+    from num2words import num2words
+
+    import sys
+
+    ecarts = verifier_contre_num2words(ENTIER_MAX if "complet" in sys.argv[1:] else 9999)
+    for valeur, attendu, obtenu in ecarts[:20]:
+        print(f"{valeur!r}: num2words={attendu!r} en_lettres={obtenu!r}")
+    print(f"{len(ecarts)} écart(s) avec num2words")
+    valeurs = [85, 12, 0.4, 28, 7, 17, 60, 2.8]
+    n = 20000
+    t_num2words = timeit.timeit(lambda: [num2words(v, lang='fr') for v in valeurs], number=n) / (n * len(valeurs))
+    t_table = timeit.timeit(lambda: [en_lettres(v) for v in valeurs], number=n) / (n * len(valeurs))
+    print(f"num2words : {t_num2words * 1e6:.2f} µs/nombre, en_lettres : {t_table * 1e6:.2f} µs/nombre "
+          f"(x{t_num2words / t_table:.0f})")
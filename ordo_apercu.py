@@ -0,0 +1,305 @@
+"""Aperçu en direct de l'ordonnance : image de la première page, calculée en arrière-plan.
+
+L'aperçu n'écrit pas de PDF : il exécute directement sur une image (Pillow) les quelques
+opérateurs de dessin qu'émet fpdf (texte, traits, rectangles, images). L'en-tête du gabarit
+est dessiné une fois et gardé en cache ; chaque aperçu ne dessine plus que la partie patient
+sur une copie de cette image. Les polices sont des substituts de Helvetica : l'aperçu montre
+la mise en page, le PDF reste la référence.
+
+ServiceApercu calcule les aperçus sur un fil d'exécution dédié : les demandes rapprochées
+sont regroupées (seule la dernière est rendue) et le script Streamlit n'attend jamais plus
+que le délai qu'il choisit.
+"""
+import contextvars
+import functools
+import io
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from ordo_mesures import etape, compter
+
+RESOLUTION = 100  # Points par pouce de l'image
+
+# Polices de substitution cherchées par Pillow dans les dossiers du système, puis police intégrée
+polices_candidates = {
+    "": ["DejaVuSans.ttf", "LiberationSans-Regular.ttf", "Arial.ttf", "arial.ttf"],
+    "B": ["DejaVuSans-Bold.ttf", "LiberationSans-Bold.ttf", "Arial Bold.ttf", "arialbd.ttf"],
+    "I": ["DejaVuSans-Oblique.ttf", "LiberationSans-Italic.ttf", "Arial Italic.ttf", "ariali.ttf"],
+}
+
+_lexeme = re.compile(r"\((?:\\.|[^\\)])*\)|/[^\s/\[\]()<>]+|[-+]?(?:\d+\.?\d*|\.\d+)|[A-Za-z*'\"]+")
+_echappement = re.compile(r"\\(.)", re.S)
+_polices = {}  # {(style, taille en px): (police, gras simulé)}
+
+def _texte_pdf(chaine):
+    """Décode une chaîne PDF échappée par fpdf : (Texte \\(entre parenthèses\\))."""
+    return _echappement.sub(lambda m: "\r" if m.group(1) == "r" else m.group(1), chaine[1:-1])
+
+def _police(nom, taille):
+    """Police Pillow la plus proche de la police PDF `nom` (Helvetica-Bold...) ; indique si le gras est à simuler.
+
+    Un style introuvable est remplacé par la police droite (le gras est alors simulé).
+    """
+    style = "B" if "Bold" in nom else "I" if "Oblique" in nom or "Italic" in nom else ""
+    cle = (style, taille)
+    police = _polices.get(cle)
+    if police is None:
+        from PIL import ImageFont
+
+        candidates = [(candidate, False) for candidate in polices_candidates[style]]
+        candidates += [(candidate, style == "B") for candidate in polices_candidates[""]] if style else []
+        for candidate, gras in candidates:
+            try:
+                police = (ImageFont.truetype(candidate, taille), gras)
+                break
+            except OSError:
+                continue
+        else:
+            police = (ImageFont.load_default(taille), style == "B")
+        _polices[cle] = police
+    return police
+
+def _couleur(operandes):
+    if len(operandes) == 1:
+        gris = round(float(operandes[0]) * 255)
+        return (gris, gris, gris)
+    return tuple(round(float(valeur) * 255) for valeur in operandes[:3])
+
+class _Etat:
+    """État graphique suivi pendant l'exécution d'un flux de contenu."""
+
+    __slots__ = ("police", "taille", "remplissage", "trait", "epaisseur", "matrice")
+
+    def __init__(self):
+        self.police, self.taille = None, 0.0
+        self.remplissage = self.trait = (0, 0, 0)
+        self.epaisseur = 1.0
+        self.matrice = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+    def copie(self):
+        etat = _Etat()
+        for attribut in self.__slots__:
+            setattr(etat, attribut, getattr(self, attribut))
+        return etat
+
+class Rasteriseur:
+    """Exécute les flux de contenu de fpdf sur une image Pillow d'une page du document."""
+
+    def __init__(self, pdf, resolution=RESOLUTION):
+        self.echelle = resolution / 72
+        self.hauteur_pt = pdf.h_pt
+        self.taille = (round(pdf.w_pt * self.echelle), round(pdf.h_pt * self.echelle))
+        self.polices, self.images = {}, {}
+        self._images = {}  # {(chemin, largeur, hauteur): image redimensionnée}
+        self.actualiser(pdf)
+
+    def actualiser(self, pdf):
+        """Prend en compte les polices et images ajoutées au document depuis la création."""
+        self.polices.update((info["i"], info["name"]) for info in pdf.fonts.values())
+        self.images.update((info["i"], chemin) for chemin, info in pdf.images.items())
+
+    def _point(self, x, y):
+        return (float(x) * self.echelle, (self.hauteur_pt - float(y)) * self.echelle)
+
+    def _image(self, numero, largeur, hauteur):
+        from PIL import Image
+
+        chemin = self.images.get(numero)
+        cle = (chemin, largeur, hauteur)
+        image = self._images.get(cle)
+        if image is None and chemin:
+            with Image.open(chemin) as source:
+                image = source.convert("RGBA").resize((max(largeur, 1), max(hauteur, 1)))
+            self._images[cle] = image
+        return image
+
+    def executer(self, image, contenu, etat=None):
+        """Dessine `contenu` (flux de contenu d'une page) sur `image` et retourne l'état graphique final."""
+        from PIL import ImageDraw
+
+        dessin = ImageDraw.Draw(image)
+        etat = etat.copie() if etat is not None else _Etat()
+        pile, operandes, chemin, sous_chemins = [], [], [], []
+        texte_x = texte_y = 0.0
+        for lexeme in _lexeme.findall(contenu):
+            premier = lexeme[0]
+            if premier in "(/" or premier.isdigit() or premier in "+-.":
+                operandes.append(lexeme)
+                continue
+            operateur = lexeme
+            if operateur == "q":
+                pile.append(etat.copie())
+            elif operateur == "Q":
+                etat = pile.pop() if pile else _Etat()
+            elif operateur == "cm":
+                etat.matrice = tuple(float(valeur) for valeur in operandes[-6:])
+            elif operateur == "BT":
+                texte_x = texte_y = 0.0
+            elif operateur == "Td":
+                texte_x += float(operandes[-2])
+                texte_y += float(operandes[-1])
+            elif operateur == "Tf":
+                etat.police, etat.taille = self.polices.get(int(operandes[-2][2:])), float(operandes[-1])
+            elif operateur == "Tj":
+                texte = _texte_pdf(operandes[-1])
+                if texte.strip() and etat.police:
+                    police, gras = _police(etat.police, max(round(etat.taille * self.echelle), 1))
+                    x, y = self._point(texte_x, texte_y)
+                    dessin.text((x, y), texte, fill=etat.remplissage, font=police, anchor="ls")
+                    if gras:
+                        dessin.text((x + 1, y), texte, fill=etat.remplissage, font=police, anchor="ls")
+            elif operateur in ("g", "rg"):
+                etat.remplissage = _couleur(operandes)
+            elif operateur in ("G", "RG"):
+                etat.trait = _couleur(operandes)
+            elif operateur == "w":
+                etat.epaisseur = float(operandes[-1])
+            elif operateur == "m":
+                if chemin:
+                    sous_chemins.append(chemin)
+                chemin = [self._point(*operandes[-2:])]
+            elif operateur == "l":
+                chemin.append(self._point(*operandes[-2:]))
+            elif operateur in ("c", "v", "y"):  # Courbes : approchées par un segment
+                chemin.append(self._point(*operandes[-2:]))
+            elif operateur == "re":
+                x, y, largeur, hauteur = (float(valeur) for valeur in operandes[-4:])
+                if chemin:
+                    sous_chemins.append(chemin)
+                sous_chemins.append([self._point(x, y), self._point(x + largeur, y), self._point(x + largeur, y + hauteur),
+                                     self._point(x, y + hauteur), self._point(x, y)])
+                chemin = []
+            elif operateur in ("S", "s", "f", "F", "f*", "B", "B*", "b", "b*", "n"):
+                if chemin:
+                    sous_chemins.append(chemin)
+                epaisseur = max(round(etat.epaisseur * self.echelle), 1)
+                for points in sous_chemins:
+                    if operateur in ("f", "F", "f*", "B", "B*", "b", "b*") and len(points) > 2:
+                        dessin.polygon(points, fill=etat.remplissage)
+                    if operateur in ("S", "s", "B", "B*", "b", "b*") and len(points) > 1:
+                        dessin.line(points, fill=etat.trait, width=epaisseur)
+                chemin, sous_chemins = [], []
+            elif operateur == "Do":
+                nom = operandes[-1]
+                a, _, _, d, e, f = etat.matrice
+                if nom.startswith("/I"):
+                    largeur, hauteur = round(a * self.echelle), round(d * self.echelle)
+                    source = self._image(int(nom[2:]), largeur, hauteur)
+                    if source is not None:
+                        x, y = self._point(e, f + d)
+                        image.paste(source, (round(x), round(y)), source)
+            operandes = []  # BT, ET, J, Tw... : sans effet sur l'aperçu
+        return etat
+
+class ApercuGabarit:
+    """Aperçus d'un gabarit : l'en-tête est dessiné une fois, chaque aperçu ne dessine que la partie patient."""
+
+    def __init__(self, gabarit, resolution=RESOLUTION):
+        self.gabarit = gabarit
+        modele = gabarit._modele
+        self._debut_corps = len(modele.pages[1])
+        self.rasteriseur = Rasteriseur(modele, resolution)
+        with etape("apercu_entete"):
+            from PIL import Image
+
+            self.entete = Image.new("RGB", self.rasteriseur.taille, "white")
+            self.etat = self.rasteriseur.executer(self.entete, modele.pages[1])
+
+    def rendre(self, patient_data, decomposition=None, date_ordonnance=None, format_image="JPEG"):
+        """Retourne l'image (octets JPEG ou PNG) de la première page de l'ordonnance."""
+        from ordo_rendu import dessiner_corps
+
+        with etape("apercu"):
+            pdf = self.gabarit.nouveau_document()
+            dessiner_corps(pdf, self.gabarit.preferences, patient_data, decomposition, date_ordonnance)
+            image = self.entete.copy()
+            self.rasteriseur.actualiser(pdf)
+            self.rasteriseur.executer(image, pdf.pages[1][self._debut_corps:], self.etat)
+            sortie = io.BytesIO()
+            image.save(sortie, format_image, quality=85) if format_image == "JPEG" else image.save(sortie, format_image)
+        compter("apercus")
+        return sortie.getvalue()
+
+class ServiceApercu:
+    """Calcule les aperçus sur un fil d'exécution dédié, en ne rendant que la dernière demande de chaque canal.
+
+    Un canal correspond à un utilisateur (session) : les demandes d'un canal se remplacent,
+    celles de canaux différents sont traitées à tour de rôle.
+    """
+
+    def __init__(self, regroupement=0.03, conserves=32):
+        self.regroupement = regroupement  # Attente (s) après une demande, pour regrouper les saisies rapprochées
+        self.conserves = conserves
+        self._condition = threading.Condition()
+        self._demandes = {}  # {canal: (clé, instant, fonction de rendu)}
+        self._resultats = OrderedDict()  # {clé: octets de l'image}, les plus récents en dernier
+        self._erreurs = OrderedDict()  # {clé: message}
+        self._gabarits = weakref.WeakKeyDictionary()  # {GabaritOrdonnance: ApercuGabarit}
+        threading.Thread(target=self._boucle, name="apercu", daemon=True).start()
+
+    def apercu_gabarit(self, gabarit):
+        apercu = self._gabarits.get(gabarit)
+        if apercu is None:
+            apercu = self._gabarits[gabarit] = ApercuGabarit(gabarit)
+        return apercu
+
+    def _rendre(self, gabarit, patient_data, decomposition, date_ordonnance):
+        return self.apercu_gabarit(gabarit).rendre(patient_data, decomposition, date_ordonnance)
+
+    def demander(self, cle, gabarit, patient_data, decomposition=None, date_ordonnance=None, canal=None):
+        """Demande l'aperçu identifié par `cle` (sans effet s'il est déjà calculé)."""
+        with self._condition:
+            if cle in self._resultats:
+                self._resultats.move_to_end(cle)
+                self._demandes.pop(canal, None)  # Retour à un état déjà affiché : la demande en attente est périmée
+                return
+            # Rendu exécuté dans le contexte du demandeur (mesures activées ou non pour sa session)
+            rendu = functools.partial(contextvars.copy_context().run, self._rendre, gabarit, patient_data,
+                                      decomposition, date_ordonnance)
+            self._demandes[canal] = (cle, time.monotonic(), rendu)  # Remplace la demande pas encore traitée
+            self._condition.notify_all()
+
+    def attendre(self, cle, delai):
+        """Retourne l'aperçu de `cle` s'il est prêt dans le délai (secondes), sinon None."""
+        limite = time.monotonic() + delai
+        with self._condition:
+            while cle not in self._resultats and cle not in self._erreurs:
+                reste = limite - time.monotonic()
+                if reste <= 0:
+                    return None
+                self._condition.wait(reste)
+            return self._resultats.get(cle)
+
+    def erreur(self, cle):
+        """Message d'erreur si le rendu de `cle` a échoué, sinon None."""
+        return self._erreurs.get(cle)
+
+    def _suivante(self):
+        """Attend qu'une demande soit stable depuis `regroupement` secondes et la retire de la file."""
+        while True:
+            if not self._demandes:
+                self._condition.wait()
+                continue
+            canal, (cle, instant, rendu) = min(self._demandes.items(), key=lambda demande: demande[1][1])
+            reste = instant + self.regroupement - time.monotonic()
+            if reste <= 0:
+                del self._demandes[canal]
+                return cle, rendu
+            self._condition.wait(reste)
+
+    def _boucle(self):
+        while True:
+            with self._condition:
+                cle, rendu = self._suivante()
+            try:
+                image, erreur = rendu(), None
+            except Exception as exception:  # L'aperçu ne doit jamais interrompre la saisie
+                image, erreur = None, f"{type(exception).__name__} : {exception}"
+            with self._condition:
+                resultats = self._resultats if erreur is None else self._erreurs
+                resultats[cle] = image if erreur is None else erreur
+                while len(resultats) > self.conserves:
+                    resultats.popitem(last=False)
+                self._condition.notify_all()
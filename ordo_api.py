@@ -0,0 +1,422 @@
+"""API HTTP locale de génération d'ordonnances, avec file d'attente.
+
+Le logiciel patient du cabinet envoie une prescription en JSON ; elle est mise en file,
+rendue sur un pool de processus avec la mise en page habituelle, et le PDF est ensuite
+récupéré par son identifiant de travail. Uniquement la bibliothèque standard (asyncio).
+
+    python ordo_api.py --port 8502 --processus 2 --archive ordonnances.sqlite
+
+    POST /ordonnances                {"profil": "<RPPS>", "patient": {...}, "decomposition": {...}}
+                                     → 202 {"id": ..., "etat": "en_attente", ...}
+    GET  /ordonnances/<id>           → état du travail (en_attente, en_cours, termine, echec)
+    GET  /ordonnances/<id>/pdf       → le PDF (409 tant qu'il n'est pas prêt)
+    GET  /metriques                  → profondeur de file, travaux en cours, latences
+    GET  /metrics                    → les mêmes valeurs et les mesures par étape (--mesures), format Prometheus
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import ordo_mesures
+from ordo_catalogue import catalogue
+from ordo_decomposition import POSOLOGIE_MAX_MG, en_microgrammes
+from ordo_preferences import charger_preferences_utilisateur
+from ordo_num_secu import nettoyer_num_secu, est_num_secu_valide
+from ordo_profils import DOSSIER_PROFILS, registre_profils, rpps_valide
+
+# Profil « defaut » : preferences.json ; les autres profils sont désignés par le RPPS du prescripteur
+PROFIL_DEFAUT = "defaut"
+
+# Champs obligatoires de la prescription (mêmes noms que patient_data)
+champs_obligatoires = ["Civilite", "Nom", "Medicament", "Posologie", "Duree", "Rythme_de_Delivrance", "Lieu_de_Delivrance"]
+
+TAILLE_MAX_REQUETE = 1024 * 1024
+_raisons = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class ErreurRequete(Exception):
+    """Requête refusée : `statut` est le code HTTP à renvoyer."""
+    def __init__(self, statut, message):
+        super().__init__(message)
+        self.statut = statut
+
+def preferences_profil(registre, profil):
+    """Retourne les préférences du profil demandé."""
+    if profil == PROFIL_DEFAUT:
+        return charger_preferences_utilisateur()
+    if not rpps_valide(profil):
+        raise ErreurRequete(400, f"Identifiant de profil invalide : {profil!r} (RPPS à 11 chiffres attendu)")
+    registre.actualiser(profil)  # Profil créé ou modifié depuis l'interface après le démarrage
+    if profil not in registre:
+        raise ErreurRequete(404, f"Profil inconnu : {profil}")
+    return registre.preferences(profil)
+
+def patient_data_depuis_json(donnees):
+    """Convertit la prescription reçue en patient_data (dates ISO AAAA-MM-JJ)."""
+    if not isinstance(donnees, dict):
+        raise ErreurRequete(400, "« patient » doit être un objet JSON")
+    manquants = [champ for champ in champs_obligatoires if donnees.get(champ) in (None, "")]
+    if manquants:
+        raise ErreurRequete(400, f"Champs manquants : {', '.join(manquants)}")
+    patient_data = {
+        "Civilite": donnees["Civilite"],
+        "Nom": donnees["Nom"],
+        "Prenom": donnees.get("Prenom", ""),
+        "Date_de_Naissance": None,
+        "ALD_30": donnees.get("ALD_30", "Non"),
+        "Medicament": donnees["Medicament"],
+        "Chevauchement_Autorise": donnees.get("Chevauchement_Autorise", "Non"),
+        "Lieu_de_Delivrance": donnees["Lieu_de_Delivrance"],
+    }
+    try:
+        if donnees.get("Date_de_Naissance"):
+            patient_data["Date_de_Naissance"] = datetime.date.fromisoformat(donnees["Date_de_Naissance"])
+        for champ in ("Posologie", "Duree", "Rythme_de_Delivrance"):
+            if isinstance(donnees[champ], bool) or not isinstance(donnees[champ], (int, float)):
+                raise ValueError(f"{champ} doit être un nombre : {donnees[champ]!r}")
+            nombre = float(donnees[champ])
+            if not math.isfinite(nombre):
+                raise ValueError(f"{champ} n'est pas un nombre fini : {donnees[champ]!r}")
+            patient_data[champ] = int(nombre) if nombre.is_integer() else nombre
+    except (TypeError, ValueError) as erreur:
+        raise ErreurRequete(400, f"Valeur invalide : {erreur}")
+    if patient_data["Posologie"] <= 0:
+        raise ErreurRequete(400, "Posologie doit être strictement positive")
+    for champ in ("Duree", "Rythme_de_Delivrance"):
+        if not isinstance(patient_data[champ], int) or patient_data[champ] <= 0:
+            raise ErreurRequete(400, f"{champ} doit être un nombre entier de jours strictement positif")
+    if patient_data["Posologie"] > POSOLOGIE_MAX_MG:
+        raise ErreurRequete(400, f"Posologie supérieure à {POSOLOGIE_MAX_MG} mg/jour")
+    if donnees.get("Numero_Securite_Sociale"):
+        num_secu = nettoyer_num_secu(donnees["Numero_Securite_Sociale"])
+        if len(num_secu) != 13 or not est_num_secu_valide(num_secu):
+            raise ErreurRequete(400, "Numero_Securite_Sociale invalide (13 caractères attendus)")
+        patient_data["Numero_Securite_Sociale"] = num_secu
+    return patient_data
+
+def decomposition_depuis_json(donnees):
+    """Convertit une décomposition {"dosage": quantité} reçue en JSON (clés texte) en dictionnaire."""
+    if donnees is None:
+        return None
+    message = "« decomposition » doit être un objet {dosage: quantité} (dosage positif, quantité entière positive ou nulle)"
+    decomposition = {}
+    try:
+        for unite, quantite in donnees.items():
+            dosage, nombre = float(unite), float(quantite)
+            if (isinstance(quantite, bool) or not isinstance(quantite, (int, float)) or not math.isfinite(dosage) or dosage <= 0 or not math.isfinite(nombre)
+                    or nombre < 0 or not nombre.is_integer()):
+                raise ErreurRequete(400, message)
+            decomposition[int(dosage) if dosage.is_integer() else dosage] = int(nombre)
+    except (AttributeError, TypeError, ValueError):
+        raise ErreurRequete(400, message)
+    return decomposition
+
+def verifier_decomposition(patient_data, decomposition):
+    """Vérifie qu'une décomposition fournie donne la posologie, avec les dosages du catalogue."""
+    if decomposition is None:
+        return
+    dosages = catalogue().dosages(patient_data["Medicament"])
+    inconnus = [unite for unite in decomposition if dosages and unite not in dosages]
+    if inconnus:
+        raise ErreurRequete(400, f"Dosage(s) absent(s) du catalogue pour {patient_data['Medicament']} : "
+                                 f"{', '.join(f'{unite:g}' for unite in inconnus)} mg")
+    micros = [en_microgrammes(unite) for unite in decomposition]
+    if None in micros or sum(micro * quantite for micro, quantite in zip(micros, decomposition.values())) \
+            != en_microgrammes(patient_data["Posologie"]):
+        somme = sum(unite * quantite for unite, quantite in decomposition.items())
+        raise ErreurRequete(400, f"La décomposition ({somme:g} mg) ne correspond pas à la posologie "
+                                 f"({patient_data['Posologie']:g} mg)")
+
+# Rendu dans un processus du pool (fonctions de module pour être transmises au pool)
+def _initialiser_processus(mesures):
+    from ordo_decomposition import precalculer_tables
+
+    ordo_mesures.activer(mesures)
+    precalculer_tables()
+
+def _rendre(preferences, patient_data, decomposition, date_ordonnance):
+    """Rend une ordonnance et retourne (PDF, décomposition, avertissements, durée du rendu, mesures des étapes)."""
+    from ordo_decomposition import decomposer_posologie
+    from ordo_rendu import rendre_ordonnance
+
+    debut = time.perf_counter()
+    if decomposition is None:
+        decomposition = decomposer_posologie(patient_data["Medicament"], patient_data["Posologie"])
+    avertissements = []
+    pdf = rendre_ordonnance(preferences, patient_data, decomposition, date_ordonnance, avertissements)
+    duree = time.perf_counter() - debut
+    return pdf, decomposition, avertissements, duree, ordo_mesures.instantane(True) if ordo_mesures.actif else None
+
+def _centile(valeurs, centile):
+    valeurs = sorted(valeurs)
+    if not valeurs:
+        return None
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * centile / 100))]
+
+class Travail:
+    """Une demande d'ordonnance et son avancement."""
+    def __init__(self, profil, preferences, patient_data, decomposition):
+        self.id = uuid.uuid4().hex
+        self.profil = profil
+        self.preferences = preferences
+        self.patient_data = patient_data
+        self.decomposition = decomposition
+        self.etat = "en_attente"
+        self.pdf = None
+        self.erreur = None
+        self.avertissements = []
+        self.archive = None
+        self.soumis = time.monotonic()
+        self.termine = None
+
+    def description(self):
+        return {
+            "id": self.id,
+            "etat": self.etat,
+            "profil": self.profil,
+            "erreur": self.erreur,
+            "avertissements": self.avertissements,
+            "archive": self.archive,
+            "pdf": f"/ordonnances/{self.id}/pdf" if self.etat == "termine" else None,
+        }
+
+class ServiceOrdonnances:
+    """File d'attente des travaux et pool de rendu."""
+    def __init__(self, processus=None, file_max=1000, conserves_max=10000, dossier_profils=DOSSIER_PROFILS,
+                 archive=None):
+        self.processus = processus or os.cpu_count() or 1
+        self.registre = registre_profils(dossier_profils)
+        self.file = asyncio.Queue(maxsize=file_max)
+        self.travaux = OrderedDict()  # Plus anciens d'abord ; les travaux terminés au-delà de conserves_max sont oubliés
+        self.conserves_max = conserves_max
+        self.en_cours = 0
+        self.compteurs = {"soumis": 0, "termines": 0, "echecs": 0, "refuses": 0}
+        self.durees_rendu = deque(maxlen=1000)
+        self.durees_totales = deque(maxlen=1000)
+        self.chemin_archive = archive
+        self.pool = None
+        self.archiveur = None
+        self.connexion = None
+        self.ouvriers = []
+
+    async def demarrer(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.processus, initializer=_initialiser_processus,
+                                        initargs=(ordo_mesures.actif,))
+        if self.chemin_archive:
+            # Un seul fil d'exécution pour SQLite : la connexion y est créée et toujours utilisée
+            from ordo_archive import ouvrir_archive
+
+            self.archiveur = ThreadPoolExecutor(max_workers=1)
+            self.connexion = await asyncio.get_running_loop().run_in_executor(
+                self.archiveur, ouvrir_archive, self.chemin_archive)
+        # Autant d'ouvriers que de processus, plus un pour que le pool ne reste jamais inactif
+        self.ouvriers = [asyncio.create_task(self._ouvrier()) for _ in range(self.processus + 1)]
+
+    async def arreter(self):
+        for ouvrier in self.ouvriers:
+            ouvrier.cancel()
+        await asyncio.gather(*self.ouvriers, return_exceptions=True)
+        self.pool.shutdown(cancel_futures=True)
+        if self.archiveur is not None:
+            self.archiveur.submit(self.connexion.close).result()
+            self.archiveur.shutdown()
+
+    def soumettre(self, donnees):
+        """Valide une demande et la met en file ; retourne le travail créé."""
+        if not isinstance(donnees, dict):
+            raise ErreurRequete(400, "Le corps doit être un objet JSON")
+        profil = donnees.get("profil") or PROFIL_DEFAUT
+        preferences = preferences_profil(self.registre, str(profil))
+        patient_data = patient_data_depuis_json(donnees.get("patient"))
+        decomposition = decomposition_depuis_json(donnees.get("decomposition"))
+        verifier_decomposition(patient_data, decomposition)
+        travail = Travail(profil, preferences, patient_data, decomposition)
+        try:
+            self.file.put_nowait(travail)
+        except asyncio.QueueFull:
+            self.compteurs["refuses"] += 1
+            raise ErreurRequete(503, "File d'attente pleine, réessayer plus tard")
+        self.travaux[travail.id] = travail
+        self.compteurs["soumis"] += 1
+        self._oublier_anciens()
+        return travail
+
+    def _oublier_anciens(self):
+        while len(self.travaux) > self.conserves_max:
+            identifiant, travail = next(iter(self.travaux.items()))
+            if travail.etat in ("en_attente", "en_cours"):
+                break
+            del self.travaux[identifiant]
+
+    async def _ouvrier(self):
+        boucle = asyncio.get_running_loop()
+        while True:
+            travail = await self.file.get()
+            travail.etat = "en_cours"
+            self.en_cours += 1
+            try:
+                pdf, decomposition, avertissements, duree, mesures = await boucle.run_in_executor(
+                    self.pool, _rendre, travail.preferences, travail.patient_data, travail.decomposition,
+                    datetime.date.today())
+                if self.connexion is not None:
+                    from ordo_archive import archiver_ordonnance
+
+                    travail.archive = await boucle.run_in_executor(
+                        self.archiveur, archiver_ordonnance, self.connexion, travail.patient_data, decomposition, pdf)
+                travail.pdf, travail.avertissements, travail.etat = pdf, avertissements, "termine"
+                self.durees_rendu.append(duree)
+                ordo_mesures.fusionner(mesures)
+                self.compteurs["termines"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as erreur:
+                travail.etat, travail.erreur = "echec", f"{type(erreur).__name__}: {erreur}"
+                self.compteurs["echecs"] += 1
+            finally:
+                self.en_cours -= 1
+                self.file.task_done()
+            travail.termine = time.monotonic()
+            travail.preferences = None
+            self.durees_totales.append(travail.termine - travail.soumis)
+
+    def metriques(self):
+        def en_ms(valeur):
+            return None if valeur is None else round(valeur * 1000, 3)
+
+        return {
+            "file": self.file.qsize(),
+            "en_cours": self.en_cours,
+            "processus": self.processus,
+            **self.compteurs,
+            "rendu_p50_ms": en_ms(_centile(self.durees_rendu, 50)),
+            "rendu_p99_ms": en_ms(_centile(self.durees_rendu, 99)),
+            "total_p50_ms": en_ms(_centile(self.durees_totales, 50)),
+            "total_p99_ms": en_ms(_centile(self.durees_totales, 99)),
+        }
+
+    def traiter(self, methode, chemin, corps):
+        """Traite une requête et retourne (statut, type de contenu, corps en octets)."""
+        morceaux = [morceau for morceau in chemin.split("?", 1)[0].split("/") if morceau]
+        if morceaux == ["ordonnances"]:
+            if methode != "POST":
+                raise ErreurRequete(405, "Utiliser POST")
+            try:
+                donnees = json.loads(corps or b"null")
+            except ValueError:
+                raise ErreurRequete(400, "JSON invalide")
+            return _json(202, self.soumettre(donnees).description())
+        if methode != "GET":
+            raise ErreurRequete(405, "Utiliser GET")
+        if morceaux == ["metriques"]:
+            return _json(200, self.metriques())
+        if morceaux == ["metrics"]:
+            jauges = {f"api_{nom}": valeur for nom, valeur in self.metriques().items()}
+            return 200, "text/plain; version=0.0.4; charset=utf-8", ordo_mesures.format_prometheus(jauges).encode("utf-8")
+        if len(morceaux) in (2, 3) and morceaux[0] == "ordonnances":
+            travail = self.travaux.get(morceaux[1])
+            if travail is None:
+                raise ErreurRequete(404, "Travail inconnu")
+            if len(morceaux) == 2:
+                return _json(200, travail.description())
+            if morceaux[2] == "pdf":
+                if travail.etat != "termine":
+                    raise ErreurRequete(409, f"PDF non disponible (état : {travail.etat})")
+                return 200, "application/pdf", travail.pdf
+        raise ErreurRequete(404, "Ressource inconnue")
+
+def _json(statut, donnees):
+    return statut, "application/json; charset=utf-8", json.dumps(donnees, ensure_ascii=False).encode("utf-8")
+
+async def _lire_requete(lecteur):
+    """Lit une requête HTTP/1.1 ; retourne (méthode, chemin, en-têtes, corps) ou None en fin de connexion."""
+    ligne = await lecteur.readline()
+    if not ligne.strip():
+        return None
+    try:
+        methode, chemin, _ = ligne.decode("latin1").split()
+    except ValueError:
+        raise ErreurRequete(400, "Ligne de requête invalide")
+    entetes = {}
+    while True:
+        ligne = await lecteur.readline()
+        if ligne in (b"\r\n", b"\n", b""):
+            break
+        nom, _, valeur = ligne.decode("latin1").partition(":")
+        entetes[nom.strip().lower()] = valeur.strip()
+    try:
+        longueur = int(entetes.get("content-length") or 0)
+    except ValueError:
+        raise ErreurRequete(400, "En-tête Content-Length invalide")
+    if longueur < 0:
+        raise ErreurRequete(400, "En-tête Content-Length invalide")
+    if longueur > TAILLE_MAX_REQUETE:
+        raise ErreurRequete(413, "Requête trop volumineuse")
+    corps = await lecteur.readexactly(longueur) if longueur else b""
+    return methode.upper(), chemin, entetes, corps
+
+def creer_gestionnaire(service):
+    """Retourne le gestionnaire de connexion asyncio (connexions persistantes HTTP/1.1)."""
+    async def gerer(lecteur, ecrivain):
+        try:
+            while True:
+                garder = False
+                try:
+                    requete = await _lire_requete(lecteur)
+                    if requete is None:
+                        break
+                    methode, chemin, entetes, corps = requete
+                    garder = entetes.get("connection", "").lower() != "close"
+                    statut, type_contenu, reponse = service.traiter(methode, chemin, corps)
+                except ErreurRequete as erreur:
+                    statut, type_contenu, reponse = _json(erreur.statut, {"erreur": str(erreur)})
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as erreur:
+                    statut, type_contenu, reponse = _json(500, {"erreur": f"{type(erreur).__name__}: {erreur}"})
+                ecrivain.write(f"HTTP/1.1 {statut} {_raisons.get(statut, '')}\r\nContent-Type: {type_contenu}\r\n"
+                               f"Content-Length: {len(reponse)}\r\nConnection: {'keep-alive' if garder else 'close'}"
+                               f"\r\n\r\n".encode("latin1") + reponse)
+                await ecrivain.drain()
+                if not garder:
+                    break
+        finally:
+            ecrivain.close()
+    return gerer
+
+async def servir(hote="127.0.0.1", port=8502, **options):
+    service = ServiceOrdonnances(**options)
+    await service.demarrer()
+    serveur = await asyncio.start_server(creer_gestionnaire(service), hote, port)
+    print(f"API des ordonnances sur http://{hote}:{port} ({service.processus} processus de rendu)")
+    try:
+        async with serveur:
+            await serveur.serve_forever()
+    finally:
+        await service.arreter()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API HTTP locale de génération d'ordonnances.")
+    parser.add_argument("--hote", default="127.0.0.1", help="Adresse d'écoute (locale par défaut)")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--processus", type=int, default=0, help="Nombre de processus de rendu (0 : tous les cœurs)")
+    parser.add_argument("--file-max", type=int, default=1000, help="Nombre maximal de travaux en attente")
+    parser.add_argument("--profils", default=DOSSIER_PROFILS, help="Dossier des profils de prescripteurs")
+    parser.add_argument("--archive", help="Archive SQLite où enregistrer les ordonnances générées")
+    parser.add_argument("--mesures", action="store_true", help="Mesure chaque étape du rendu (exposé sur /metrics)")
+    args = parser.parse_args(argv)
+    if args.mesures:
+        ordo_mesures.activer()
+    try:
+        asyncio.run(servir(args.hote, args.port, processus=args.processus or None, file_max=args.file_max,
+                           dossier_profils=args.profils, archive=args.archive))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Archive locale des ordonnances générées (SQLite).
+
+Chaque ordonnance est enregistrée avec l'identité du patient, la prescription, la
+décomposition et le PDF produit. Les index sur le nom, le N° SS et la date rendent la
+recherche d'un patient immédiate même sur des dizaines de milliers d'ordonnances, et
+une ordonnance peut être renouvelée à l'identique.
+"""
+import datetime
+import json
+import sqlite3
+import unicodedata
+
+CHEMIN_ARCHIVE = "ordonnances.sqlite"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS ordonnances (
+    id INTEGER PRIMARY KEY,
+    date_creation TEXT NOT NULL,
+    civilite TEXT,
+    nom TEXT NOT NULL,
+    prenom TEXT,
+    nom_recherche TEXT NOT NULL,
+    date_naissance TEXT,
+    num_secu TEXT,
+    ald_30 TEXT,
+    medicament TEXT,
+    posologie REAL,
+    decomposition TEXT,
+    duree INTEGER,
+    rythme INTEGER,
+    chevauchement TEXT,
+    lieu_delivrance TEXT,
+    pdf BLOB
+);
+CREATE INDEX IF NOT EXISTS ordonnances_nom ON ordonnances (nom_recherche, date_creation);
+CREATE INDEX IF NOT EXISTS ordonnances_num_secu ON ordonnances (num_secu, date_creation);
+CREATE INDEX IF NOT EXISTS ordonnances_date ON ordonnances (date_creation);
+"""
+
+# Colonnes retournées par les recherches (le PDF n'est lu qu'à la demande)
+_colonnes = ("id, date_creation, civilite, nom, prenom, date_naissance, num_secu, ald_30, medicament, posologie, "
+             "decomposition, duree, rythme, chevauchement, lieu_delivrance")
+
+def normaliser_nom(texte):
+    """Nom en majuscules sans accents, pour une recherche insensible à la casse et aux accents."""
+    texte = unicodedata.normalize("NFKD", texte or "")
+    return "".join(c for c in texte if not unicodedata.combining(c)).upper().strip()
+
+def ouvrir_archive(chemin=CHEMIN_ARCHIVE):
+    """Ouvre (et crée si besoin) l'archive."""
+    connexion = sqlite3.connect(chemin)
+    connexion.row_factory = sqlite3.Row
+    connexion.execute("PRAGMA journal_mode=WAL")
+    connexion.executescript(_schema)
+    return connexion
+
+_insertion = ("INSERT INTO ordonnances (date_creation, civilite, nom, prenom, nom_recherche, date_naissance, num_secu, "
+              "ald_30, medicament, posologie, decomposition, duree, rythme, chevauchement, lieu_delivrance, pdf) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def _valeurs(patient_data, decomposition, pdf, date_creation):
+    date_naissance = patient_data.get("Date_de_Naissance")
+    return (date_creation.isoformat(timespec="seconds"), patient_data.get("Civilite"), patient_data.get("Nom", ""),
+            patient_data.get("Prenom"), normaliser_nom(patient_data.get("Nom", "")),
+            date_naissance.isoformat() if date_naissance else None, patient_data.get("Numero_Securite_Sociale") or None,
+            patient_data.get("ALD_30"), patient_data.get("Medicament"), patient_data.get("Posologie"),
+            json.dumps([[unite, quantite] for unite, quantite in (decomposition or {}).items()]),
+            patient_data.get("Duree"), patient_data.get("Rythme_de_Delivrance"),
+            patient_data.get("Chevauchement_Autorise"), patient_data.get("Lieu_de_Delivrance"), pdf)
+
+def archiver_ordonnance(connexion, patient_data, decomposition, pdf, date_creation=None):
+    """Enregistre une ordonnance générée et retourne son identifiant."""
+    with connexion:
+        curseur = connexion.execute(_insertion, _valeurs(patient_data, decomposition, pdf,
+                                                         date_creation or datetime.datetime.now()))
+    return curseur.lastrowid
+
+def archiver_ordonnances(connexion, ordonnances, date_creation=None):
+    """Enregistre en une seule transaction des (patient_data, decomposition, pdf) ; retourne leur nombre."""
+    date_creation = date_creation or datetime.datetime.now()
+    with connexion:
+        curseur = connexion.executemany(_insertion, (_valeurs(patient_data, decomposition, pdf, date_creation)
+                                                     for patient_data, decomposition, pdf in ordonnances))
+    return curseur.rowcount
+
+def rechercher(connexion, nom=None, num_secu=None, limite=50):
+    """Retourne les ordonnances (plus récentes d'abord) dont le nom commence par `nom` ou de ce N° SS."""
+    conditions, parametres = [], []
+    if nom:
+        debut = normaliser_nom(nom)
+        conditions.append("nom_recherche >= ? AND nom_recherche < ?")  # Préfixe : utilise l'index
+        parametres += [debut, debut + "\uffff"]
+    if num_secu:
+        conditions.append("num_secu = ?")
+        parametres.append(num_secu.replace(" ", ""))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    requete = f"SELECT {_colonnes} FROM ordonnances {where} ORDER BY date_creation DESC, id DESC LIMIT ?"
+    return [dict(ligne) for ligne in connexion.execute(requete, parametres + [limite])]
+
+def lire_ordonnance(connexion, identifiant):
+    """Retourne l'ordonnance `identifiant` sans son PDF, ou None."""
+    ligne = connexion.execute(f"SELECT {_colonnes} FROM ordonnances WHERE id = ?", (identifiant,)).fetchone()
+    return dict(ligne) if ligne else None
+
+def _nombre(valeur):
+    return int(valeur) if isinstance(valeur, float) and valeur.is_integer() else valeur
+
+def patient_data_depuis(ordonnance):
+    """Reconstruit patient_data et la décomposition à partir d'une ordonnance archivée."""
+    patient_data = {
+        "Civilite": ordonnance["civilite"],
+        "Nom": ordonnance["nom"],
+        "Prenom": ordonnance["prenom"],
+        "Date_de_Naissance": datetime.date.fromisoformat(ordonnance["date_naissance"]) if ordonnance["date_naissance"] else None,
+        "ALD_30": ordonnance["ald_30"],
+        "Medicament": ordonnance["medicament"],
+        "Posologie": _nombre(ordonnance["posologie"]),
+        "Duree": ordonnance["duree"],
+        "Rythme_de_Delivrance": ordonnance["rythme"],
+        "Chevauchement_Autorise": ordonnance["chevauchement"],
+        "Lieu_de_Delivrance": ordonnance["lieu_delivrance"],
+    }
+    if ordonnance["num_secu"]:
+        patient_data["Numero_Securite_Sociale"] = ordonnance["num_secu"]
+    decomposition = {_nombre(unite): quantite for unite, quantite in json.loads(ordonnance["decomposition"] or "[]")}
+    return patient_data, decomposition
+
+def renouveler(connexion, identifiant, preferences, date_ordonnance=None):
+    """Régénère une ordonnance archivée à la date du jour, l'archive et retourne (identifiant, patient_data, PDF)."""
+    from ordo_rendu import rendre_ordonnance
+
+    ordonnance = lire_ordonnance(connexion, identifiant)
+    if ordonnance is None:
+        raise KeyError(f"Ordonnance introuvable : {identifiant}")
+    patient_data, decomposition = patient_data_depuis(ordonnance)
+    pdf = rendre_ordonnance(preferences, patient_data, decomposition, date_ordonnance)
+    return archiver_ordonnance(connexion, patient_data, decomposition, pdf), patient_data, pdf
@@ -0,0 +1,240 @@
+"""Génération d'ordonnances en lot à partir d'une liste de patients (CSV ou Parquet).
+
+Exemple :
+    python ordo_batch.py patients.csv --sortie ordonnances/
+    python ordo_batch.py patients.parquet --fusion ordonnances.pdf
+    python ordo_batch.py patients.csv --fusion tournee.pdf --calendrier
+"""
+import argparse
+import os
+import sys
+import time
+import datetime
+import ordo_mesures
+from ordo_preferences import charger_preferences_utilisateur
+from ordo_profils import registre_profils
+from ordo_archive import ouvrir_archive, archiver_ordonnances
+from ordo_decomposition import decomposer_posologie
+from ordo_num_secu import retirer_cle
+from ordo_calendrier import calendrier_patient
+from ordo_fusion import DocumentFusionne
+from ordo_rendu import gabarit_pour
+from ordo_parallele import rendre_en_parallele
+
+# Colonnes attendues dans la liste de patients (mêmes champs que patient_data)
+colonnes_patient = [
+    "Civilite", "Nom", "Prenom", "Date_de_Naissance", "N° SS", "ALD_30", "Medicament", "Posologie",
+    "Duree", "Rythme_de_Delivrance", "Chevauchement_Autorise", "Lieu_de_Delivrance"
+]
+
+def _blocs_patients(chemin, taille_bloc=1000):
+    """Lit la liste de patients par blocs (DataFrames) en vérifiant les colonnes."""
+    import pandas as pd
+    from ordo_num_secu import colonne_num_secu
+
+    if chemin.lower().endswith(".parquet"):
+        blocs = [pd.read_parquet(chemin)]
+    else:
+        blocs = pd.read_csv(chemin, dtype=str, keep_default_na=False, chunksize=taille_bloc)
+    for bloc in blocs:
+        manquantes = [colonne for colonne in colonnes_patient if colonne not in bloc.columns]
+        if manquantes:
+            raise ValueError(f"Colonnes manquantes dans la liste de patients : {', '.join(manquantes)}")
+        bloc = bloc[colonnes_patient].copy()
+        bloc["N° SS"] = colonne_num_secu(bloc["N° SS"])  # Colonne numérique d'un Parquet : pas de « .0 »
+        yield bloc
+
+def lire_liste_patients(chemin, taille_bloc=1000):
+    """Lit la liste de patients par blocs et retourne les lignes une par une (dictionnaires)."""
+    for bloc in _blocs_patients(chemin, taille_bloc):
+        yield from bloc.to_dict("records")
+
+def verifier_liste_patients(chemin, rapport, taille_bloc=100000):
+    """Vérifie les N° SS de toute la liste et écrit les lignes en erreur dans `rapport` (CSV).
+
+    Retourne (nombre de lignes, nombre de lignes en erreur).
+    """
+    from ordo_num_secu import verifier_num_secu
+
+    total = en_erreur = 0
+    with open(rapport, "w", encoding="utf-8", newline="") as fichier:
+        for bloc in _blocs_patients(chemin, taille_bloc):
+            resultat = verifier_num_secu(bloc)
+            erreurs = resultat[resultat["erreur"] != ""]
+            lignes = bloc.loc[erreurs.index, ["Nom", "Prenom", "N° SS"]].assign(
+                Ligne=erreurs.index + 2, Erreur=erreurs["erreur"])  # +2 : en-tête et numérotation à partir de 1
+            lignes[["Ligne", "Nom", "Prenom", "N° SS", "Erreur"]].to_csv(fichier, header=total == 0, index=False)
+            total += len(bloc)
+            en_erreur += len(erreurs)
+    return total, en_erreur
+
+def _texte(valeur, defaut=""):
+    """Retourne la valeur en texte, ou `defaut` si elle est vide ou manquante (NaN)."""
+    if valeur is None or valeur != valeur:  # valeur != valeur : NaN
+        return defaut
+    if isinstance(valeur, float) and valeur.is_integer():
+        valeur = int(valeur)  # 1800175123456.0 → 1800175123456
+    return str(valeur).strip() or defaut
+
+def _nombre(valeur):
+    """Convertit une valeur lue (texte ou flottant) en entier si possible, sinon en flottant."""
+    nombre = float(str(valeur).replace(",", "."))
+    return int(nombre) if nombre.is_integer() else nombre
+
+def _date(valeur):
+    """Convertit une date de naissance (JJ/MM/AAAA, AAAA-MM-JJ ou date) en datetime.date."""
+    if valeur is None or valeur == "" or valeur != valeur:  # valeur != valeur : NaN
+        return None
+    if isinstance(valeur, datetime.datetime):
+        return valeur.date()
+    if isinstance(valeur, datetime.date):
+        return valeur
+    valeur = str(valeur).strip()
+    for format_date in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(valeur, format_date).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Date de naissance invalide : {valeur}")
+
+def ligne_vers_patient_data(ligne):
+    """Transforme une ligne de la liste de patients en dictionnaire patient_data."""
+    return {
+        "Civilite": _texte(ligne["Civilite"]),
+        "Nom": _texte(ligne["Nom"]),
+        "Prenom": _texte(ligne["Prenom"]),
+        "Date_de_Naissance": _date(ligne["Date_de_Naissance"]),
+        "Numero_Securite_Sociale": retirer_cle(_texte(ligne["N° SS"])),  # 13 caractères, clé vérifiée
+        "ALD_30": _texte(ligne["ALD_30"], "Non"),
+        "Medicament": _texte(ligne["Medicament"], "Non spécifié"),
+        "Posologie": _nombre(ligne["Posologie"]),
+        "Duree": _nombre(ligne["Duree"]),
+        "Rythme_de_Delivrance": _nombre(ligne["Rythme_de_Delivrance"]),
+        "Chevauchement_Autorise": _texte(ligne["Chevauchement_Autorise"], "Non"),
+        "Lieu_de_Delivrance": _texte(ligne["Lieu_de_Delivrance"]),
+    }
+
+def nom_fichier(index, patient_data):
+    """Construit un nom de fichier unique et lisible pour l'ordonnance d'un patient."""
+    nom = "".join(c if c.isalnum() else "_" for c in f"{patient_data['Nom']}_{patient_data['Prenom']}")
+    return f"{index:05d}_{nom}.pdf"
+
+def generer_fichiers(lignes, preferences, dossier, date_ordonnance=None, processus=1, archive=None):
+    """Écrit une ordonnance PDF par patient dans `dossier` et retourne le nombre de fichiers écrits.
+
+    Les échecs sont signalés sur la sortie d'erreur sans interrompre le lot. Si `archive`
+    (connexion ouverte par ordo_archive.ouvrir_archive) est fournie, chaque ordonnance y est enregistrée.
+    """
+    os.makedirs(dossier, exist_ok=True)
+    nombre = 0
+    echecs = 0
+    durees = []
+    a_archiver = []
+    resultats = rendre_en_parallele(preferences, lignes, processus=processus,
+                                    date_ordonnance=date_ordonnance, preparer=ligne_vers_patient_data)
+    for resultat in resultats:
+        ligne = resultat.index + 1
+        for avertissement in resultat.avertissements:
+            print(f"Ligne {ligne} : {avertissement}", file=sys.stderr)
+        if resultat.erreur:
+            print(f"Ligne {ligne} : échec du rendu ({resultat.erreur})", file=sys.stderr)
+            echecs += 1
+            continue
+        with open(os.path.join(dossier, nom_fichier(ligne, resultat.patient_data)), "wb") as f:
+            f.write(resultat.pdf)
+        durees.append(resultat.duree)
+        nombre += 1
+        if archive is not None:
+            patient_data = resultat.patient_data
+            a_archiver.append((patient_data, decomposer_posologie(patient_data["Medicament"], patient_data["Posologie"]),
+                               resultat.pdf))
+            if len(a_archiver) >= 500:
+                archiver_ordonnances(archive, a_archiver)
+                a_archiver = []
+    if a_archiver:
+        archiver_ordonnances(archive, a_archiver)
+    if durees:
+        durees.sort()
+        print(f"Rendu par ordonnance : médiane {durees[len(durees) // 2] * 1000:.1f} ms, "
+              f"max {durees[-1] * 1000:.1f} ms, {echecs} échec(s)", file=sys.stderr)
+    return nombre
+
+def generer_fusion(lignes, preferences, chemin, date_ordonnance=None, calendrier=False):
+    """Écrit toutes les ordonnances dans un seul PDF, au fur et à mesure, et retourne leur nombre.
+
+    Une page par patient (deux avec `calendrier`) ; l'en-tête, les logos et la signature ne sont
+    écrits qu'une fois dans le fichier (voir ordo_fusion). Les lignes invalides sont signalées sur
+    la sortie d'erreur sans interrompre le lot.
+    """
+    gabarit = gabarit_pour(preferences)
+    for avertissement in gabarit.avertissements:
+        print(avertissement, file=sys.stderr)
+    nombre = 0
+    with DocumentFusionne(gabarit, chemin) as document:
+        for index, ligne in enumerate(lignes, start=1):
+            try:
+                patient_data = ligne_vers_patient_data(ligne)
+                livraisons = calendrier_patient(patient_data, date_debut=date_ordonnance) if calendrier else None
+                avertissements = document.ajouter(patient_data, date_ordonnance=date_ordonnance, calendrier=livraisons)
+            except (ValueError, KeyError) as erreur:  # Ligne invalide : signalée sans interrompre le lot
+                print(f"Ligne {index} : échec du rendu ({type(erreur).__name__}: {erreur})", file=sys.stderr)
+                continue
+            for avertissement in avertissements:
+                print(f"Ligne {index} : {avertissement}", file=sys.stderr)
+            nombre += 1
+        document.fermer()
+    return nombre
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Génère les ordonnances d'une liste de patients (CSV ou Parquet).")
+    parser.add_argument("liste", help="Fichier CSV ou Parquet des patients")
+    parser.add_argument("--preferences", default="preferences.json", help="Fichier de préférences de la structure")
+    parser.add_argument("--profil", help="RPPS du prescripteur dont le profil remplace --preferences")
+    parser.add_argument("--processus", type=int, default=0,
+                        help="Nombre de processus de rendu (0 : tous les cœurs, uniquement avec --sortie)")
+    sortie = parser.add_mutually_exclusive_group(required=True)
+    sortie.add_argument("--sortie", help="Dossier où écrire un PDF par patient")
+    sortie.add_argument("--fusion", help="Fichier PDF unique contenant toutes les ordonnances")
+    sortie.add_argument("--rapport-num-secu", help="Vérifie seulement les N° SS et écrit les erreurs dans ce fichier CSV")
+    parser.add_argument("--archive", help="Archive SQLite où enregistrer les ordonnances (uniquement avec --sortie)")
+    parser.add_argument("--calendrier", action="store_true",
+                        help="Ajoute la page du calendrier de délivrance après chaque ordonnance (uniquement avec --fusion)")
+    parser.add_argument("--mesures", help="Mesure chaque étape et écrit les résultats dans ce fichier (format Prometheus)")
+    args = parser.parse_args(argv)
+    if args.mesures:
+        ordo_mesures.activer()
+
+    if args.rapport_num_secu:
+        total, en_erreur = verifier_liste_patients(args.liste, args.rapport_num_secu)
+        print(f"{total} ligne(s) vérifiée(s), {en_erreur} N° SS en erreur (détail : {args.rapport_num_secu})")
+        return
+
+    if args.profil:
+        registre = registre_profils()
+        if args.profil not in registre:
+            parser.error(f"profil inconnu : {args.profil}")
+        preferences = registre.preferences(args.profil)
+    else:
+        if not os.path.exists(args.preferences):
+            # Comme dans l'interface : la structure est générée avec les préférences par défaut
+            print(f"{args.preferences} introuvable : préférences par défaut utilisées", file=sys.stderr)
+        preferences = charger_preferences_utilisateur(args.preferences)
+    lignes = lire_liste_patients(args.liste)
+    date_ordonnance = datetime.date.today()
+    debut = time.perf_counter()
+    if args.fusion:
+        nombre = generer_fusion(lignes, preferences, args.fusion, date_ordonnance, args.calendrier)
+    else:
+        archive = ouvrir_archive(args.archive) if args.archive else None
+        try:
+            nombre = generer_fichiers(lignes, preferences, args.sortie, date_ordonnance, args.processus, archive)
+        finally:
+            if archive is not None:
+                archive.close()
+    duree = time.perf_counter() - debut
+    print(f"{nombre} ordonnance(s) générée(s) en {duree:.1f} s")
+    if args.mesures:
+        ordo_mesures.ecrire_prometheus(args.mesures, {"lot_duree_secondes": round(duree, 6)})
+
+if __name__ == "__main__":
+    main()
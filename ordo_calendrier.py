@@ -0,0 +1,208 @@
+"""Calendrier de délivrance : dates de chaque délivrance et nombre d'unités à délivrer.
+
+À partir de la décomposition journalière (unités par jour), de la durée, du rythme et de
+la date de début, chaque délivrance couvre `rythme` jours, sauf la dernière qui couvre
+les jours restants. Le calendrier peut être imprimé en page annexe de l'ordonnance
+(rendre_ordonnance(..., calendrier=...)) et exporté en CSV ou ICS.
+
+calendriers_en_lot() calcule les calendriers de toute une liste en une passe (pandas/NumPy) ;
+en ligne de commande, pour toutes les ordonnances en cours de l'archive :
+    python ordo_calendrier.py --archive ordonnances.sqlite --sortie calendrier.csv
+"""
+import argparse
+import csv
+import datetime
+import hashlib
+import io
+import json
+from collections import namedtuple
+
+# Une délivrance : numéro (à partir de 1), date, nombre de jours couverts, quantités {dosage: unités}
+Livraison = namedtuple("Livraison", ["numero", "date", "jours", "quantites"])
+
+def calculer_calendrier(decomposition, duree, rythme, date_debut):
+    """Retourne la liste des délivrances d'un traitement.
+
+    `decomposition` donne le nombre d'unités de chaque dosage par jour ; la dernière
+    délivrance est raccourcie si la durée n'est pas un multiple du rythme.
+    """
+    duree, rythme = int(duree), int(rythme)
+    if duree <= 0 or rythme <= 0:
+        return []
+    quotidien = {unite: quantite for unite, quantite in (decomposition or {}).items() if quantite > 0}
+    livraisons = []
+    for numero, debut in enumerate(range(0, duree, rythme), start=1):
+        jours = min(rythme, duree - debut)
+        livraisons.append(Livraison(numero, date_debut + datetime.timedelta(days=debut), jours,
+                                    {unite: quantite * jours for unite, quantite in quotidien.items()}))
+    return livraisons
+
+def calendrier_patient(patient_data, decomposition=None, date_debut=None):
+    """Calendrier d'une ordonnance (décomposition recalculée si absente, début le jour même par défaut)."""
+    if decomposition is None:
+        from ordo_decomposition import decomposer_posologie
+
+        decomposition = decomposer_posologie(patient_data["Medicament"], patient_data["Posologie"])
+    return calculer_calendrier(decomposition, patient_data["Duree"], patient_data["Rythme_de_Delivrance"],
+                               date_debut or datetime.date.today())
+
+def libelle_dosage(medicament, unite, quantite=2):
+    """« comprimés de 8 mg » (au singulier si quantite vaut 1)."""
+    from ordo_rendu import formater_unite
+
+    _, unite_nom = formater_unite(medicament, quantite)
+    dosage = f"{unite:g}".replace(".", ",")
+    return f"{unite_nom} de {dosage} mg"
+
+def libelle_quantite(medicament, unite, quantite):
+    """« 14 comprimés de 8 mg »."""
+    return f"{quantite} {libelle_dosage(medicament, unite, quantite)}"
+
+def calendrier_csv(patient_data, livraisons):
+    """Retourne le calendrier en CSV (une ligne par délivrance et par dosage)."""
+    sortie = io.StringIO()
+    ecrivain = csv.writer(sortie, delimiter=";")
+    ecrivain.writerow(["Nom", "Prenom", "Medicament", "Delivrance", "Date", "Jours", "Dosage_mg", "Unites"])
+    for livraison in livraisons:
+        for unite, quantite in livraison.quantites.items():
+            ecrivain.writerow([patient_data["Nom"], patient_data["Prenom"], patient_data["Medicament"], livraison.numero,
+                               livraison.date.isoformat(), livraison.jours, f"{unite:g}", quantite])
+    return sortie.getvalue()
+
+def _texte_ics(texte):
+    """Échappe un texte pour une propriété iCalendar (RFC 5545)."""
+    return (str(texte).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def _plier_ics(ligne, limite=75):
+    """Plie une ligne iCalendar en lignes d'au plus 75 octets (RFC 5545) : CRLF puis une espace,
+    sans couper un caractère UTF-8."""
+    morceaux, courant, taille = [], "", 0
+    for caractere in ligne:
+        octets = len(caractere.encode("utf-8"))
+        if taille + octets > limite:
+            morceaux.append(courant)
+            courant, taille = " ", 1  # L'espace de continuation compte dans la limite
+        courant += caractere
+        taille += octets
+    morceaux.append(courant)
+    return "\r\n".join(morceaux)
+
+def calendrier_ics(patient_data, livraisons):
+    """Retourne le calendrier au format iCalendar : un événement sur la journée par délivrance."""
+    horodatage = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    patient = f"{patient_data['Nom']} {patient_data['Prenom']}".strip()
+    lignes = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//print_ordo//Calendrier de delivrance//FR",
+              "CALSCALE:GREGORIAN"]
+    medicament = patient_data["Medicament"]
+    for livraison in livraisons:
+        identifiant = hashlib.sha256(f"{patient}|{medicament}|{livraison.date}".encode("utf-8")).hexdigest()
+        details = [libelle_quantite(medicament, unite, quantite)
+                   for unite, quantite in livraison.quantites.items()]
+        details.append(f"Chevauchement autorisé : {patient_data.get('Chevauchement_Autorise', 'Non')}")
+        lignes += [
+            "BEGIN:VEVENT",
+            f"UID:{identifiant[:32]}@print_ordo",
+            f"DTSTAMP:{horodatage}",
+            f"DTSTART;VALUE=DATE:{livraison.date:%Y%m%d}",
+            f"DTEND;VALUE=DATE:{livraison.date + datetime.timedelta(days=1):%Y%m%d}",
+            f"SUMMARY:{_texte_ics(f'Délivrance {livraison.numero} – {patient} – {medicament}')}",
+            f"DESCRIPTION:{_texte_ics(chr(10).join(details))}",
+            "END:VEVENT",
+        ]
+    lignes.append("END:VCALENDAR")
+    return "\r\n".join(map(_plier_ics, lignes)) + "\r\n"
+
+def calendriers_en_lot(prescriptions):
+    """Calcule en une passe les calendriers de toute une liste.
+
+    `prescriptions` est un DataFrame avec les colonnes debut (date), Duree, Rythme_de_Delivrance
+    et decomposition ({dosage: unités par jour}). Retourne un DataFrame long avec une ligne par
+    délivrance et par dosage : prescription (index d'origine), delivrance, date, jours, dosage_mg, unites.
+    """
+    import numpy as np
+    import pandas as pd
+
+    duree = pd.to_numeric(prescriptions["Duree"]).to_numpy(dtype=np.int64)
+    rythme = pd.to_numeric(prescriptions["Rythme_de_Delivrance"]).to_numpy(dtype=np.int64)
+    debut = pd.to_datetime(prescriptions["debut"]).to_numpy(dtype="datetime64[D]")
+    valide = (duree > 0) & (rythme > 0)
+
+    # Délivrances : ceil(durée / rythme) par prescription, numérotées dans chaque prescription
+    nombre = np.where(valide, -(-duree // np.where(valide, rythme, 1)), 0)
+    ligne = np.repeat(np.arange(len(nombre)), nombre)
+    rang = np.arange(len(ligne)) - np.repeat(np.cumsum(nombre) - nombre, nombre)
+    decalage = rang * rythme[ligne]
+    jours = np.minimum(rythme[ligne], duree[ligne] - decalage)
+    livraisons = pd.DataFrame({"ligne": ligne, "delivrance": rang + 1,
+                               "date": debut[ligne] + decalage.astype("timedelta64[D]"), "jours": jours})
+
+    # Unités par jour de chaque prescription (format long), puis une ligne par délivrance et par dosage
+    unites = [(position, float(unite), quantite) for position, decomposition in enumerate(prescriptions["decomposition"])
+              for unite, quantite in (decomposition or {}).items() if quantite > 0]
+    unites = pd.DataFrame(unites, columns=["ligne", "dosage_mg", "par_jour"]).astype(
+        {"ligne": np.int64, "dosage_mg": np.float64, "par_jour": np.int64})  # Types fixés même sans aucune ligne
+    resultat = livraisons.merge(unites, on="ligne", how="inner", sort=False)
+    resultat["unites"] = resultat["par_jour"].to_numpy(dtype=np.int64) * resultat["jours"].to_numpy()
+    resultat.insert(0, "prescription", prescriptions.index.to_numpy()[resultat["ligne"].to_numpy()])
+    resultat = resultat.sort_values(["ligne", "delivrance", "dosage_mg"], ascending=[True, True, False], kind="stable")
+    return resultat.drop(columns=["ligne", "par_jour"]).reset_index(drop=True)
+
+def prescriptions_en_cours(connexion, jour=None):
+    """Ordonnances de l'archive dont le traitement n'est pas terminé au `jour` donné (DataFrame).
+
+    Pour un patient (N° SS, ou nom et date de naissance) et un médicament (alias compris), seule
+    la dernière ordonnance compte : deux traitements simultanés gardent chacun leur calendrier.
+    """
+    import pandas as pd
+    from ordo_catalogue import catalogue
+
+    jour = jour or datetime.date.today()
+    requete = ("SELECT id, date_creation, nom, prenom, date_naissance, num_secu, medicament, posologie, decomposition, "
+               "duree, rythme FROM ordonnances WHERE date_creation >= ? ORDER BY date_creation, id")
+    # Les traitements durent au plus quelques mois : inutile de relire toute l'archive
+    debut_recherche = (jour - datetime.timedelta(days=366)).isoformat()
+    ordonnances = pd.read_sql_query(requete, connexion, params=(debut_recherche,))
+    ordonnances["patient"] = ordonnances["num_secu"].fillna(
+        ordonnances["nom"].str.upper() + "|" + ordonnances["prenom"].fillna("").str.upper() + "|"
+        + ordonnances["date_naissance"].fillna(""))
+    fiches = catalogue()
+    references = {nom: fiche.nom for fiche in map(fiches.__getitem__, fiches) for nom in (fiche.nom,) + fiche.alias}
+    ordonnances["reference"] = ordonnances["medicament"].map(references).fillna(ordonnances["medicament"])
+    ordonnances = ordonnances.drop_duplicates(["patient", "reference"], keep="last")
+    ordonnances["debut"] = pd.to_datetime(ordonnances["date_creation"].str.slice(0, 10))
+    fin = ordonnances["debut"] + pd.to_timedelta(ordonnances["duree"], unit="D")
+    ordonnances = ordonnances[fin > pd.Timestamp(jour)].copy()
+    ordonnances["decomposition"] = [{unite: quantite for unite, quantite in json.loads(texte or "[]")}
+                                    for texte in ordonnances["decomposition"]]
+    return ordonnances.rename(columns={"duree": "Duree", "rythme": "Rythme_de_Delivrance"}).set_index("id")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calendriers de délivrance de toutes les ordonnances en cours.")
+    parser.add_argument("--archive", default="ordonnances.sqlite", help="Archive SQLite des ordonnances")
+    parser.add_argument("--jour", type=datetime.date.fromisoformat, help="Jour de référence AAAA-MM-JJ (aujourd'hui par défaut)")
+    parser.add_argument("--a-venir", action="store_true", help="Ne garder que les délivrances à partir du jour de référence")
+    parser.add_argument("--sortie", required=True, help="Fichier CSV des délivrances")
+    args = parser.parse_args(argv)
+
+    from ordo_archive import ouvrir_archive
+
+    jour = args.jour or datetime.date.today()
+    connexion = ouvrir_archive(args.archive)
+    try:
+        prescriptions = prescriptions_en_cours(connexion, jour)
+    finally:
+        connexion.close()
+    calendrier = calendriers_en_lot(prescriptions)
+    if args.a_venir:
+        calendrier = calendrier[calendrier["date"] >= datetime.datetime.combine(jour, datetime.time())]
+    colonnes = ["nom", "prenom", "num_secu", "medicament"]
+    calendrier = calendrier.join(prescriptions[colonnes], on="prescription")
+    calendrier["date"] = calendrier["date"].dt.strftime("%Y-%m-%d")
+    calendrier["dosage_mg"] = calendrier["dosage_mg"].map("{:g}".format)
+    calendrier.to_csv(args.sortie, sep=";", index=False,
+                      columns=["prescription"] + colonnes + ["delivrance", "date", "jours", "dosage_mg", "unites"])
+    print(f"{len(prescriptions)} ordonnance(s) en cours, {len(calendrier)} ligne(s) de délivrance écrites dans {args.sortie}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Catalogue des médicaments : dosages, forme, nom de l'unité, dose et durée maximales, statut de stupéfiant.
+
+Le catalogue est décrit dans medicaments.json (à côté de ce module, ou fichier désigné par la
+variable d'environnement ORDO_CATALOGUE). Il est chargé une fois dans une structure immuable
+indexée par nom (et par alias), puis relu automatiquement quand le fichier change : il suffit
+de modifier le fichier pour ajouter un médicament ou un dosage, sans redémarrer l'application.
+Un fichier invalide est signalé et l'ancien catalogue reste en service.
+
+L'interface (liste des médicaments, champs de décomposition), le décomposeur (dosages) et le
+rendu PDF (nom de l'unité accordé en genre et en nombre) lisent tous ce même catalogue, ainsi
+que les contrôles de sécurité (dose journalière et durée de prescription maximales).
+"""
+import json
+import os
+import threading
+import time
+import warnings
+from collections import namedtuple
+from types import MappingProxyType
+
+CHEMIN_CATALOGUE = os.environ.get("ORDO_CATALOGUE") or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    "medicaments.json")
+
+# Le fichier n'est réexaminé qu'une fois par intervalle (secondes), pas à chaque décomposition
+INTERVALLE_VERIFICATION = 1.0
+
+# Unité des médicaments hors catalogue (champ libre)
+UNITE_PAR_DEFAUT = ("comprimé", "comprimés", False)
+
+# Une fiche : dosages en mg (tuple décroissant), unité (singulier, pluriel, féminin),
+# dose journalière maximale en mg et durée maximale de prescription en jours (None si pas de limite)
+# et statut de stupéfiant
+Medicament = namedtuple("Medicament", ["nom", "forme", "dosages", "singulier", "pluriel", "feminin",
+                                       "dose_max_jour_mg", "duree_max_jours", "stupefiant", "alias"])
+
+def _etat_fichier(chemin):
+    """Retourne (date de modification, taille) du fichier, ou None s'il n'existe pas."""
+    try:
+        infos = os.stat(chemin)
+    except FileNotFoundError:
+        return None
+    return (infos.st_mtime_ns, infos.st_size)
+
+def _dosage(valeur, nom):
+    """Valide un dosage (mg, entier en microgrammes) ; les dosages entiers restent des int (8 et non 8.0)."""
+    if isinstance(valeur, bool) or not isinstance(valeur, (int, float)) or valeur <= 0:
+        raise ValueError(f"{nom} : dosage invalide {valeur!r}")
+    if abs(valeur * 1000 - round(valeur * 1000)) > 1e-6:
+        raise ValueError(f"{nom} : le dosage {valeur!r} n'est pas un nombre entier de microgrammes")
+    return int(valeur) if float(valeur).is_integer() else float(valeur)
+
+def _fiche(donnees):
+    nom = str(donnees.get("nom", "")).strip()
+    if not nom:
+        raise ValueError(f"Médicament sans nom : {donnees!r}")
+    dosages = tuple(sorted({_dosage(valeur, nom) for valeur in donnees.get("dosages", [])}, reverse=True))
+    unite = donnees.get("unite", {})
+    singulier, pluriel, feminin = UNITE_PAR_DEFAUT
+    dose_max = donnees.get("dose_max_jour_mg")
+    if dose_max is not None and (isinstance(dose_max, bool) or not isinstance(dose_max, (int, float)) or dose_max <= 0):
+        raise ValueError(f"{nom} : dose maximale invalide {dose_max!r}")
+    duree_max = donnees.get("duree_max_jours")
+    if duree_max is not None and (isinstance(duree_max, bool) or not isinstance(duree_max, int) or duree_max <= 0):
+        raise ValueError(f"{nom} : durée maximale invalide {duree_max!r}")
+    return Medicament(nom=nom, forme=str(donnees.get("forme", "")), dosages=dosages,
+                      singulier=str(unite.get("singulier", singulier)), pluriel=str(unite.get("pluriel", pluriel)),
+                      feminin=bool(unite.get("feminin", feminin)), dose_max_jour_mg=dose_max,
+                      duree_max_jours=duree_max, stupefiant=bool(donnees.get("stupefiant", False)),
+                      alias=tuple(str(alias).strip() for alias in donnees.get("alias", [])))
+
+class Catalogue:
+    """Catalogue immuable : fiches indexées par nom et par alias, dans l'ordre du fichier."""
+
+    __slots__ = ("noms", "_index", "etat")
+
+    def __init__(self, fiches, etat=None):
+        index = {}
+        for fiche in fiches:
+            for nom in (fiche.nom,) + fiche.alias:
+                if nom in index:
+                    raise ValueError(f"Médicament en double dans le catalogue : {nom}")
+                index[nom] = fiche
+        object.__setattr__(self, "noms", tuple(fiche.nom for fiche in fiches))
+        object.__setattr__(self, "_index", MappingProxyType(index))
+        object.__setattr__(self, "etat", etat)
+
+    def __setattr__(self, nom, valeur):
+        raise AttributeError("Le catalogue est en lecture seule")
+
+    def __contains__(self, nom):
+        return nom in self._index
+
+    def __getitem__(self, nom):
+        return self._index[nom]
+
+    def __iter__(self):
+        return iter(self.noms)
+
+    def __len__(self):
+        return len(self.noms)
+
+    def get(self, nom, defaut=None):
+        return self._index.get(nom, defaut)
+
+    def dosages(self, nom):
+        """Dosages disponibles (tuple décroissant), vide si le médicament est inconnu ou sans dosage."""
+        fiche = self._index.get(nom)
+        return fiche.dosages if fiche is not None else ()
+
+    def decomposables(self):
+        """Noms des médicaments qui ont au moins un dosage."""
+        return tuple(nom for nom in self.noms if self._index[nom].dosages)
+
+def lire_catalogue(chemin=CHEMIN_CATALOGUE):
+    """Lit et valide le fichier du catalogue (ValueError s'il est invalide)."""
+    etat = _etat_fichier(chemin)
+    with open(chemin, "r", encoding="utf-8") as f:
+        try:
+            donnees = json.load(f)
+        except json.JSONDecodeError as erreur:
+            raise ValueError(f"{chemin} : {erreur}") from erreur
+    return Catalogue([_fiche(fiche) for fiche in donnees.get("medicaments", [])], etat)
+
+_verrou = threading.Lock()
+_catalogues = {}  # {chemin: [catalogue, instant de la dernière vérification, dernier état du fichier vu]}
+
+def catalogue(chemin=CHEMIN_CATALOGUE):
+    """Retourne le catalogue courant, relu si le fichier a changé depuis la dernière vérification."""
+    en_cache = _catalogues.get(chemin)
+    maintenant = time.monotonic()
+    if en_cache is not None and maintenant - en_cache[1] < INTERVALLE_VERIFICATION:
+        return en_cache[0]
+    with _verrou:
+        en_cache = _catalogues.get(chemin)
+        if en_cache is None:
+            nouveau = lire_catalogue(chemin)
+            _catalogues[chemin] = en_cache = [nouveau, maintenant, nouveau.etat]
+        else:
+            etat = _etat_fichier(chemin)
+            if etat != en_cache[2]:  # Un fichier invalide n'est signalé qu'une fois
+                en_cache[2] = etat
+                try:
+                    en_cache[0] = lire_catalogue(chemin)
+                except (OSError, ValueError) as erreur:
+                    warnings.warn(f"Catalogue non rechargé, l'ancienne version reste utilisée : {erreur}")
+        en_cache[1] = maintenant
+        return en_cache[0]
+
+def recharger_catalogue(chemin=CHEMIN_CATALOGUE):
+    """Vérifie tout de suite si le fichier a changé (sans attendre l'intervalle) et retourne le catalogue."""
+    with _verrou:
+        en_cache = _catalogues.get(chemin)
+        if en_cache is not None:
+            en_cache[1] = float("-inf")
+    return catalogue(chemin)
@@ -0,0 +1,205 @@
+"""Décomposition optimale des posologies en unités (gélules, flacons, comprimés).
+
+Les doses sont converties en microgrammes entiers (0,4 mg = 400 µg) puis divisées par le
+plus grand diviseur commun des dosages disponibles, ce qui donne de petites tables calculées
+une seule fois par médicament par programmation dynamique. Une décomposition est ensuite
+une simple lecture dans la table.
+
+Les dosages de chaque médicament viennent du catalogue (ordo_catalogue) ; les tables sont
+indexées par jeu de dosages : les médicaments qui ont les mêmes dosages partagent leur
+table, et une modification du catalogue ne recalcule que les tables des dosages changés.
+Au-delà de DOSE_MAX_MG, la dose est résolue à la demande (moins d'unités) sans agrandir les
+tables ; au-delà de POSOLOGIE_MAX_MG, elle est refusée.
+"""
+import math
+import numbers
+from collections import namedtuple
+from itertools import combinations
+from math import gcd
+from ordo_catalogue import catalogue
+from ordo_mesures import etape
+
+# Dose maximale couverte par les tables précalculées (mg)
+DOSE_MAX_MG = 300
+
+# Posologie maximale acceptée (mg/jour) : au-delà, il s'agit d'une erreur de saisie
+POSOLOGIE_MAX_MG = 2000
+
+# Critères de décomposition
+MOINS_D_UNITES = "unites"  # Nombre total d'unités le plus petit
+MOINS_DE_DOSAGES = "dosages"  # Nombre de dosages différents le plus petit, puis d'unités
+
+# Résultat : decomposition {unité: quantité}, exacte (bool), doses_proches (inférieure, supérieure) en mg
+Decomposition = namedtuple("Decomposition", ["decomposition", "exacte", "doses_proches"])
+
+def en_microgrammes(dose):
+    """Convertit une dose en mg en microgrammes entiers, ou None si elle n'est pas entière en µg.
+
+    Seuls les nombres finis sont des doses : un booléen, un texte ou NaN donnent None.
+    """
+    if isinstance(dose, bool) or not isinstance(dose, numbers.Real) or not math.isfinite(dose):
+        return None
+    micro = round(float(dose) * 1000)
+    if abs(float(dose) * 1000 - micro) > 1e-6:
+        return None
+    return micro
+
+def _en_mg(micro):
+    """Convertit des microgrammes en mg (entier si possible)."""
+    return micro // 1000 if micro % 1000 == 0 else micro / 1000
+
+def _moins_d_unites(pas_unites, taille):
+    """Programmation dynamique : nombre minimal d'unités pour chaque quantité 0..taille (en pas)."""
+    nombre = [0] + [None] * taille
+    choix = [None] * (taille + 1)
+    for quantite in range(1, taille + 1):
+        for position, pas in enumerate(pas_unites):  # Dosages décroissants : les plus forts gagnent à égalité
+            if pas <= quantite and nombre[quantite - pas] is not None:
+                candidat = nombre[quantite - pas] + 1
+                if nombre[quantite] is None or candidat < nombre[quantite]:
+                    nombre[quantite] = candidat
+                    choix[quantite] = position
+    return nombre, choix
+
+def _reconstruire(choix, pas_unites, quantite):
+    """Retourne les quantités par position d'unité à partir de la table des choix."""
+    quantites = [0] * len(pas_unites)
+    while quantite:
+        position = choix[quantite]
+        quantites[position] += 1
+        quantite -= pas_unites[position]
+    return quantites
+
+class TableDecomposition:
+    """Décompositions précalculées d'un médicament pour toutes les doses de 0 à dose_max_mg."""
+
+    def __init__(self, unites, dose_max_mg=DOSE_MAX_MG):
+        self.unites = sorted(unites, reverse=True)
+        micro = [en_microgrammes(unite) for unite in self.unites]
+        self.pas = gcd(*micro)
+        self.taille = dose_max_mg * 1000 // self.pas
+        self.dose_max_mg = dose_max_mg
+        pas_unites = [m // self.pas for m in micro]
+        self._solutions = {
+            MOINS_D_UNITES: self._calculer_moins_d_unites(pas_unites),
+            MOINS_DE_DOSAGES: self._calculer_moins_de_dosages(pas_unites),
+        }
+        # Doses atteignables les plus proches de chaque quantité (en pas)
+        atteignable = [solution is not None for solution in self._solutions[MOINS_D_UNITES]]
+        self._precedente = [None] * (self.taille + 1)
+        self._suivante = [None] * (self.taille + 1)
+        derniere = None
+        for quantite in range(self.taille + 1):
+            if atteignable[quantite]:
+                derniere = quantite
+            self._precedente[quantite] = derniere
+        derniere = None
+        for quantite in range(self.taille, -1, -1):
+            if atteignable[quantite]:
+                derniere = quantite
+            self._suivante[quantite] = derniere
+
+    def _decomposition(self, quantites):
+        return {unite: quantite for unite, quantite in zip(self.unites, quantites) if quantite > 0}
+
+    def _calculer_moins_d_unites(self, pas_unites):
+        nombre, choix = _moins_d_unites(pas_unites, self.taille)
+        return [self._decomposition(_reconstruire(choix, pas_unites, quantite)) if nombre[quantite] is not None else None
+                for quantite in range(self.taille + 1)]
+
+    def _calculer_moins_de_dosages(self, pas_unites):
+        # Meilleur résultat par quantité : (nombre de dosages, nombre d'unités, décomposition)
+        meilleurs = [None] * (self.taille + 1)
+        meilleurs[0] = (0, 0, {})
+        for nombre_dosages in range(1, len(pas_unites) + 1):
+            for positions in combinations(range(len(pas_unites)), nombre_dosages):
+                sous_pas = [pas_unites[position] for position in positions]
+                nombre, choix = _moins_d_unites(sous_pas, self.taille)
+                for quantite in range(1, self.taille + 1):
+                    if nombre[quantite] is None:
+                        continue
+                    meilleur = meilleurs[quantite]
+                    if meilleur is not None and (meilleur[0], meilleur[1]) <= (nombre_dosages, nombre[quantite]):
+                        continue
+                    quantites = [0] * len(pas_unites)
+                    for position, sous_quantite in zip(positions, _reconstruire(choix, sous_pas, quantite)):
+                        quantites[position] = sous_quantite
+                    meilleurs[quantite] = (nombre_dosages, nombre[quantite], self._decomposition(quantites))
+        return [meilleur[2] if meilleur is not None else None for meilleur in meilleurs]
+
+    def resoudre(self, dose, critere=MOINS_D_UNITES):
+        """Retourne la Decomposition de `dose` (mg) selon le critère choisi."""
+        micro = en_microgrammes(dose)
+        if micro is None or micro <= 0:
+            return Decomposition({}, False, (None, None))
+        quantite, reste = divmod(micro, self.pas)
+        if quantite > self.taille:
+            return Decomposition({}, False, (_en_mg(self._precedente[self.taille] * self.pas), None))
+        solution = self._solutions[critere][quantite] if reste == 0 else None
+        if solution is not None:
+            return Decomposition(dict(solution), True, (dose, dose))
+        # Doses les plus proches : pour un reste non nul, la quantité inférieure est la borne basse
+        precedente = self._precedente[quantite]
+        suivante = self._suivante[quantite + 1] if quantite < self.taille else None
+        # Aucune dose atteignable au-dessus dans la table : la suivante est cherchée au-delà
+        superieure = (_en_mg(suivante * self.pas) if suivante is not None
+                      else _resoudre_au_dela(self.unites, dose).doses_proches[1])
+        return Decomposition({}, False, (_en_mg(precedente * self.pas) if precedente else None, superieure))
+
+# Tables calculées à la première utilisation de chaque jeu de dosages : {dosages: TableDecomposition}
+_tables = {}
+
+def _table(dosages):
+    table = _tables.get(dosages)
+    if table is None:
+        table = _tables[dosages] = TableDecomposition(dosages)
+    return table
+
+def table_decomposition(medicament):
+    """Retourne la table du médicament (None s'il n'a pas de dosages connus)."""
+    dosages = catalogue().dosages(medicament)
+    return _table(dosages) if dosages else None
+
+def _resoudre_au_dela(dosages, dose):
+    """Dose au-delà des tables : une programmation dynamique (moins d'unités) jusqu'à cette dose, non conservée."""
+    micro = en_microgrammes(dose)
+    if micro is None:
+        return Decomposition({}, False, (None, None))
+    pas = gcd(*(en_microgrammes(unite) for unite in dosages))
+    pas_unites = [en_microgrammes(unite) // pas for unite in dosages]
+    quantite, reste = divmod(micro, pas)
+    taille = quantite + max(pas_unites)  # Assez pour trouver la dose atteignable suivante
+    nombre, choix = _moins_d_unites(pas_unites, taille)
+    if reste == 0 and nombre[quantite] is not None:
+        quantites = _reconstruire(choix, pas_unites, quantite)
+        return Decomposition({unite: q for unite, q in zip(dosages, quantites) if q > 0}, True, (dose, dose))
+    precedente = next((q for q in range(quantite, 0, -1) if nombre[q] is not None), None)
+    suivante = next((q for q in range(quantite + 1, taille + 1) if nombre[q] is not None), None)
+    return Decomposition({}, False, (_en_mg(precedente * pas) if precedente else None,
+                                     _en_mg(suivante * pas) if suivante is not None else None))
+
+def precalculer_tables():
+    """Calcule d'avance les tables de tous les médicaments (par exemple au démarrage d'un processus)."""
+    for medicament in catalogue().decomposables():
+        table_decomposition(medicament)
+
+def resoudre_posologie(medicament, dose_totale, critere=MOINS_D_UNITES):
+    """Décompose la posologie et indique si elle est exacte, sinon les doses atteignables les plus proches.
+
+    Au-delà de DOSE_MAX_MG, seul le critère « moins d'unités » est appliqué.
+    """
+    dosages = catalogue().dosages(medicament)
+    if not dosages or en_microgrammes(dose_totale) is None or not 0 < dose_totale <= POSOLOGIE_MAX_MG:
+        return Decomposition({}, False, (None, None))
+    with etape("decomposition"):
+        if dose_totale > DOSE_MAX_MG:
+            return _resoudre_au_dela(dosages, dose_totale)
+        return _table(dosages).resoudre(dose_totale, critere)
+
+# Fonction decomposer les posologies
+def decomposer_posologie(medicament, dose_totale, critere=MOINS_D_UNITES):
+    """Décompose la posologie en fonction des unités disponibles pour chaque médicament.
+
+    Retourne un dictionnaire {unité: quantité}, vide si la dose ne peut pas être obtenue exactement.
+    """
+    return resoudre_posologie(medicament, dose_totale, critere).decomposition
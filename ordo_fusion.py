@@ -0,0 +1,193 @@
+"""Ordonnances d'un lot réunies dans un seul PDF, écrit sur le disque au fur et à mesure.
+
+L'en-tête du gabarit (structure, médecin, logos) n'est décrit qu'une fois, sous forme
+d'objet graphique réutilisable (Form XObject) que chaque page appelle ; les logos et la
+signature sont des images partagées par toutes les pages. Une page ne contient donc
+plus que la partie patient, et la taille du fichier ne croît qu'avec le texte variable.
+
+Les pages de chaque patient sont compressées et écrites dès qu'elles sont terminées,
+puis libérées : la mémoire reste constante quelle que soit la taille du lot. Polices,
+images, arborescence des pages et table des références sont écrites à la fermeture.
+Le fichier est écrit sous un nom temporaire puis renommé : un lot interrompu ne laisse
+pas de PDF tronqué.
+"""
+import os
+import zlib
+from ordo_mesures import etape, compter
+from ordo_rendu import dessiner_corps, dessiner_calendrier
+
+# Nom de l'en-tête dans le dictionnaire des ressources partagées
+NOM_ENTETE = "/Entete"
+
+class DocumentFusionne:
+    """PDF unique écrit au fur et à mesure : une page (ou plusieurs avec le calendrier) par patient."""
+
+    def __init__(self, gabarit, chemin):
+        self.gabarit = gabarit
+        self.chemin = chemin
+        self._temporaire = f"{chemin}.{os.getpid()}.tmp"
+        self._fichier = open(self._temporaire, "wb")
+        self._position = 0
+        self._objets = 2  # 1 : arborescence des pages, 2 : ressources (écrits à la fermeture)
+        self._positions = {}  # {numéro d'objet: position dans le fichier}
+        self._pages = []  # Numéros des objets page
+        self._pages_ecrites = 0
+        self.pdf = None
+        modele = gabarit._modele
+        # État graphique à la fin de l'en-tête, à rétablir après l'appel de l'objet (Do le restaure)
+        police = modele.fonts[gabarit.cle_police]
+        self._appel_entete = "\n".join([
+            f"{NOM_ENTETE} Do",
+            "BT /F%d %.2f Tf ET" % (police["i"], modele.font_size_pt),
+            "%.2f w" % (modele.line_width * modele.k),
+            modele.draw_color,
+            modele.fill_color,
+        ])
+        self._ecrire(f"%PDF-{modele.pdf_version}\n")
+
+    def _ecrire(self, texte):
+        donnees = texte.encode("latin1") if isinstance(texte, str) else texte
+        self._fichier.write(donnees)
+        self._position += len(donnees)
+
+    def _objet(self, contenu, flux=None):
+        """Écrit un objet (dictionnaire `contenu`, suivi de `flux` s'il est fourni) et retourne son numéro."""
+        self._objets += 1
+        self._positions[self._objets] = self._position
+        self._ecrire(f"{self._objets} 0 obj\n{contenu}\n")
+        if flux is not None:
+            self._ecrire("stream\n")
+            self._ecrire(flux)
+            self._ecrire("\nendstream\n")
+        self._ecrire("endobj\n")
+        return self._objets
+
+    def _flux(self, texte):
+        """Retourne (filtre, données) d'un flux de contenu, compressé comme le ferait fpdf."""
+        donnees = texte.encode("latin1")
+        if self.pdf.compress:
+            return "/Filter /FlateDecode ", zlib.compress(donnees)
+        return "", donnees
+
+    def _nouvelle_page(self):
+        """Ajoute une page qui appelle l'en-tête partagé au lieu de le recopier."""
+        gabarit = self.gabarit
+        if self.pdf is None:
+            self.pdf = gabarit.nouveau_document()
+            premiere = self.pdf.pages[1]
+            self.pdf.pages[1] = premiere[:len(premiere) - len(gabarit.contenu)] + self._appel_entete + "\n"
+            return
+        self.pdf.add_page()
+        self.pdf.pages[self.pdf.page] += self._appel_entete + "\n"
+        for attribut, valeur in gabarit.etat.items():
+            setattr(self.pdf, attribut, valeur)
+        self.pdf.current_font = self.pdf.fonts[gabarit.cle_police]
+
+    def ajouter(self, patient_data, decomposition=None, date_ordonnance=None, calendrier=None):
+        """Dessine l'ordonnance du patient (et son calendrier s'il est fourni), écrit ses pages et
+        retourne la liste des avertissements. En cas d'échec, le document reste tel qu'avant l'appel."""
+        try:
+            with etape("mise_en_page"):
+                self._nouvelle_page()
+                avertissements = dessiner_corps(self.pdf, self.gabarit.preferences, patient_data, decomposition,
+                                                date_ordonnance)
+                if calendrier is not None:
+                    dessiner_calendrier(self.pdf, patient_data, calendrier)
+            with etape("serialisation"):
+                self._vider()
+        except Exception:
+            self._retirer_pages()  # Pas de page à moitié dessinée ou non encodable dans le document
+            raise
+        compter("ordonnances")
+        return avertissements
+
+    def _retirer_pages(self):
+        """Retire les pages pas encore écrites (ordonnance dont le rendu a échoué)."""
+        if self.pdf is None:
+            return
+        for numero in range(self._pages_ecrites + 1, self.pdf.page + 1):
+            del self.pdf.pages[numero]
+        self.pdf.page = self._pages_ecrites
+
+    def _vider(self):
+        """Écrit les pages terminées et libère leur contenu."""
+        pdf = self.pdf
+        groupe = "/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>\n" if pdf.pdf_version > "1.3" else ""
+        # Toutes les pages sont encodées avant d'écrire : un texte hors latin-1 n'écrit rien
+        flux = [self._flux(pdf.pages[numero]) for numero in range(self._pages_ecrites + 1, pdf.page + 1)]
+        for numero, (filtre, donnees) in enumerate(flux, start=self._pages_ecrites + 1):
+            pdf.pages[numero] = ""
+            page = self._objet(f"<</Type /Page\n/Parent 1 0 R\n/Resources 2 0 R\n{groupe}/Contents {self._objets + 2} 0 R>>")
+            self._objet(f"<<{filtre}/Length {len(donnees)}>>", donnees)
+            self._pages.append(page)
+        self._pages_ecrites = pdf.page
+
+    def fermer(self):
+        """Termine le document (polices, images, en-tête, références) et retourne le nombre de pages."""
+        if self.pdf is None:
+            self._nouvelle_page()  # Lot vide : une page avec le seul en-tête, comme fpdf
+            self._vider()
+        with etape("serialisation"):
+            pdf = self.pdf
+            filtre, donnees = self._flux(self.gabarit.contenu)
+            largeur, hauteur = pdf.fw_pt, pdf.fh_pt
+            entete = self._objet(f"<</Type /XObject\n/Subtype /Form\n/BBox [0 0 {largeur:.2f} {hauteur:.2f}]\n"
+                                 f"/Resources 2 0 R\n{filtre}/Length {len(donnees)}>>", donnees)
+
+            # Polices et images par fpdf, dans un tampon dont les positions sont décalées
+            pdf.state, pdf.buffer, pdf.offsets, pdf.n = 1, "", {}, self._objets
+            pdf._putfonts()
+            pdf._putimages()
+            pdf.offsets[1] = len(pdf.buffer)
+            pdf._out("1 0 obj")
+            pdf._out("<</Type /Pages")
+            pdf._out("/Kids [" + " ".join(f"{page} 0 R" for page in self._pages) + "]")
+            pdf._out(f"/Count {len(self._pages)}")
+            pdf._out(f"/MediaBox [0 0 {largeur:.2f} {hauteur:.2f}]")
+            pdf._out(">>")
+            pdf._out("endobj")
+            pdf.offsets[2] = len(pdf.buffer)
+            pdf._out("2 0 obj")
+            pdf._out("<<")
+            pdf._putresourcedict()
+            pdf.buffer = pdf.buffer[:pdf.buffer.rindex(">>\n")] + f"{NOM_ENTETE} {entete} 0 R\n>>\n"
+            pdf._out(">>")
+            pdf._out("endobj")
+            pdf._newobj()
+            pdf._out("<<")
+            pdf._putinfo()
+            pdf._out(">>")
+            pdf._out("endobj")
+            pdf._newobj()
+            pdf._out("<<")
+            pdf._putcatalog()
+            pdf._out(">>")
+            pdf._out("endobj")
+            base = self._position
+            self._positions.update({numero: base + position for numero, position in pdf.offsets.items()})
+            self._ecrire(pdf.buffer)
+
+            references = self._position
+            lignes = ["xref", f"0 {pdf.n + 1}", "0000000000 65535 f "]
+            lignes += ["%010d 00000 n " % self._positions[numero] for numero in range(1, pdf.n + 1)]
+            pdf.buffer = ""
+            pdf._puttrailer()
+            lignes += ["trailer", "<<", pdf.buffer.rstrip("\n"), ">>", "startxref", str(references), "%%EOF"]
+            self._ecrire("\n".join(lignes) + "\n")
+            pdf.state = 3
+            self._fichier.close()
+            os.replace(self._temporaire, self.chemin)
+        return len(self._pages)
+
+    def abandonner(self):
+        """Ferme et supprime le fichier temporaire (lot interrompu)."""
+        self._fichier.close()
+        if os.path.exists(self._temporaire):
+            os.remove(self._temporaire)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_exception, exception, trace):
+        if type_exception is not None:
+            self.abandonner()
@@ -0,0 +1,144 @@
+"""Mesures facultatives des étapes de génération d'une ordonnance.
+
+Désactivées par défaut : chaque point de mesure ne coûte alors qu'un test. Une fois
+activées (activer(), ou variable d'environnement ORDO_MESURES=1), chaque étape alimente
+un compteur et un histogramme de durées, exportables au format texte de Prometheus.
+activer_contexte() remplace ce réglage pour le seul contexte courant (une session de
+l'interface Streamlit) sans changer celui des autres sessions du processus.
+
+Étapes mesurées : preferences (chargement), images (préparation des logos et signature),
+decomposition, gabarit (compilation de l'en-tête), textes (nombres et dates en lettres),
+mise_en_page (partie patient, textes compris), serialisation (pdf.output),
+telechargement (bouton de téléchargement de l'interface), apercu_entete et apercu
+(image de l'en-tête, puis de chaque aperçu en direct).
+"""
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+# Bornes supérieures des classes de l'histogramme (secondes)
+bornes = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+actif = os.environ.get("ORDO_MESURES", "") not in ("", "0")
+_actif_contexte = contextvars.ContextVar("ordo_mesures_actif", default=None)  # None : réglage du processus
+_rien = contextlib.nullcontext()
+_verrou = threading.Lock()
+_etapes = {}  # {nom: [nombre, somme, maximum, [effectif par classe]]}
+_compteurs = {}  # {nom: valeur}
+
+def activer(etat=True):
+    """Active (ou désactive) les mesures pour tout le processus."""
+    global actif
+    actif = etat
+
+def activer_contexte(etat=True):
+    """Active (ou désactive) les mesures pour le contexte courant seulement (session, fil d'exécution)."""
+    _actif_contexte.set(etat)
+
+def _actif():
+    etat = _actif_contexte.get()
+    return actif if etat is None else etat
+
+def reinitialiser():
+    with _verrou:
+        _etapes.clear()
+        _compteurs.clear()
+
+def enregistrer(nom, duree):
+    """Ajoute une durée (secondes) à l'histogramme de l'étape `nom`."""
+    with _verrou:
+        etape = _etapes.get(nom)
+        if etape is None:
+            etape = _etapes[nom] = [0, 0.0, 0.0, [0] * len(bornes)]
+        etape[0] += 1
+        etape[1] += duree
+        etape[2] = max(etape[2], duree)
+        for rang, borne in enumerate(bornes):
+            if duree <= borne:
+                etape[3][rang] += 1
+                break
+
+class _Chrono:
+    __slots__ = ("nom", "debut")
+
+    def __init__(self, nom):
+        self.nom = nom
+
+    def __enter__(self):
+        self.debut = time.perf_counter()
+
+    def __exit__(self, *exception):
+        enregistrer(self.nom, time.perf_counter() - self.debut)
+
+def etape(nom):
+    """Contexte chronométrant l'étape `nom` (sans effet si les mesures sont désactivées)."""
+    return _Chrono(nom) if _actif() else _rien
+
+def compter(nom, valeur=1):
+    """Incrémente le compteur `nom` (sans effet si les mesures sont désactivées)."""
+    if _actif():
+        with _verrou:
+            _compteurs[nom] = _compteurs.get(nom, 0) + valeur
+
+def instantane(reinitialiser_apres=False):
+    """Copie des mesures, transmissible d'un processus à l'autre : {"etapes": ..., "compteurs": ...}."""
+    with _verrou:
+        copie = {"etapes": {nom: [n, somme, maximum, list(classes)] for nom, (n, somme, maximum, classes) in _etapes.items()},
+                 "compteurs": dict(_compteurs)}
+        if reinitialiser_apres:
+            _etapes.clear()
+            _compteurs.clear()
+    return copie
+
+def fusionner(mesures):
+    """Ajoute les mesures d'un autre processus (résultat de instantane()) à celles du processus courant."""
+    if not mesures:
+        return
+    with _verrou:
+        for nom, (n, somme, maximum, classes) in mesures["etapes"].items():
+            etape = _etapes.setdefault(nom, [0, 0.0, 0.0, [0] * len(bornes)])
+            etape[0] += n
+            etape[1] += somme
+            etape[2] = max(etape[2], maximum)
+            etape[3] = [a + b for a, b in zip(etape[3], classes)]
+        for nom, valeur in mesures["compteurs"].items():
+            _compteurs[nom] = _compteurs.get(nom, 0) + valeur
+
+def resume():
+    """Une ligne par étape : nombre, durée totale, moyenne et maximum (ms), pour l'affichage."""
+    lignes = []
+    for nom, (n, somme, maximum, _) in sorted(instantane()["etapes"].items()):
+        lignes.append({"etape": nom, "nombre": n, "total_ms": round(somme * 1000, 3),
+                       "moyenne_ms": round(somme / n * 1000, 4) if n else None, "max_ms": round(maximum * 1000, 3)})
+    return lignes
+
+def format_prometheus(jauges=None):
+    """Retourne les mesures au format texte de Prometheus ; `jauges` ajoute des valeurs instantanées {nom: valeur}."""
+    mesures = instantane()
+    lignes = ["# HELP ordo_etape_duree_secondes Durée des étapes de génération des ordonnances.",
+              "# TYPE ordo_etape_duree_secondes histogram"]
+    for nom, (n, somme, _, classes) in sorted(mesures["etapes"].items()):
+        cumul = 0
+        for borne, effectif in zip(bornes, classes):
+            cumul += effectif
+            lignes.append(f'ordo_etape_duree_secondes_bucket{{etape="{nom}",le="{borne:g}"}} {cumul}')
+        lignes.append(f'ordo_etape_duree_secondes_bucket{{etape="{nom}",le="+Inf"}} {n}')
+        lignes.append(f'ordo_etape_duree_secondes_sum{{etape="{nom}"}} {somme:.9f}')
+        lignes.append(f'ordo_etape_duree_secondes_count{{etape="{nom}"}} {n}')
+    for nom, valeur in sorted(mesures["compteurs"].items()):
+        lignes.append(f"# TYPE ordo_{nom}_total counter")
+        lignes.append(f"ordo_{nom}_total {valeur}")
+    for nom, valeur in sorted((jauges or {}).items()):
+        if valeur is not None:
+            lignes.append(f"# TYPE ordo_{nom} gauge")
+            lignes.append(f"ordo_{nom} {valeur}")
+    return "\n".join(lignes) + "\n"
+
+def ecrire_prometheus(chemin, jauges=None):
+    """Écrit les mesures dans un fichier texte (collecteur de fichiers de node_exporter par exemple)."""
+    temporaire = f"{chemin}.{os.getpid()}.tmp"
+    with open(temporaire, "w", encoding="utf-8") as fichier:
+        fichier.write(format_prometheus(jauges))
+    os.replace(temporaire, chemin)
@@ -0,0 +1,173 @@
+"""Numéro de Sécurité Sociale (NIR) : nettoyage, clé de contrôle, format et vérification.
+
+Les fonctions unitaires servent au formulaire et au PDF ; verifier_num_secu() traite une
+colonne entière d'une liste de patients en une passe (pandas/NumPy), avec un rapport
+d'erreurs par ligne. Les départements de Corse (2A, 2B) sont pris en charge : pour la clé,
+2A vaut 19 et 2B vaut 18, en retranchant respectivement 1 000 000 et 2 000 000.
+"""
+import re
+
+# Sexe (1/2), année, mois, département (2 chiffres, 2A ou 2B), commune (3), ordre (3), clé facultative (2)
+MOTIF_NUM_SECU = r"[12]\d{4}(?:\d{2}|2A|2B)\d{6}(?:\d{2})?"
+_corse = {"2A": ("19", 1000000), "2B": ("18", 2000000)}
+
+_non_significatif = re.compile(r"[^0-9AB]")
+
+def nettoyer_num_secu(numero):
+    """Supprime espaces et séparateurs (conserve les lettres A/B des départements corses)."""
+    return _non_significatif.sub("", str(numero or "").upper())
+
+def valeur_num_secu(numero):
+    """Valeur entière servant au calcul de la clé (Corse : 2A → 19 − 1 000 000, 2B → 18 − 2 000 000)."""
+    departement = numero[5:7]
+    if departement in _corse:
+        remplacement, retrait = _corse[departement]
+        return int(numero[:5] + remplacement + numero[7:13]) - retrait
+    return int(numero[:13])
+
+def est_num_secu_valide(numero):
+    """Indique si le numéro nettoyé a la forme d'un N° SS (13 caractères, ou 15 avec la clé)."""
+    return re.fullmatch(MOTIF_NUM_SECU, nettoyer_num_secu(numero)) is not None
+
+def formater_num_secu(numero):
+    """Ajoute des espaces au format 0 00 00 00 000 000."""
+    numero = nettoyer_num_secu(numero)  # Supprime les caractères non significatifs
+    if len(numero) == 13:  # Vérifie que le numéro est bien valide
+        return f"{numero[0]} {numero[1:3]} {numero[3:5]} {numero[5:7]} {numero[7:10]} {numero[10:13]}"
+    return numero  # Retourne tel quel si le format est incorrect
+
+def retirer_cle(numero):
+    """Retourne le N° SS nettoyé sur 13 caractères : une clé fournie (15 caractères) est vérifiée puis
+    retirée (ValueError si elle est fausse) ; les autres numéros sont retournés nettoyés, tels quels."""
+    numero = nettoyer_num_secu(numero)
+    if len(numero) == 15 and re.fullmatch(MOTIF_NUM_SECU, numero):
+        if int(numero[13:]) != 97 - valeur_num_secu(numero) % 97:
+            raise ValueError(f"N° SS {numero} : clé de contrôle incorrecte")
+        return numero[:13]
+    return numero
+
+# Fonction pour calculer la clé de Sécurité Sociale
+def calculer_cle_securite_sociale(numero):
+    """Calcule la clé de contrôle pour un numéro de Sécurité Sociale."""
+    numero = nettoyer_num_secu(numero)  # Supprime les espaces et caractères non significatifs
+    if len(numero) == 13 and re.fullmatch(MOTIF_NUM_SECU, numero):
+        return 97 - (valeur_num_secu(numero) % 97)
+    return None  # ✅ Retourne None si invalide
+
+# Numéro sécurité sociale
+def generer_num_secu_base(civilite, date_naissance):
+    """Génère les 5 premiers chiffres du numéro de Sécurité Sociale."""
+    if not date_naissance:
+        return ""  # Pas de génération sans date
+
+    sexe = "1" if civilite == "Monsieur" else "2"
+    annee = f"{date_naissance.year % 100:02d}"  # Année sur 2 chiffres
+    mois = f"{date_naissance.month:02d}"  # Mois sur 2 chiffres
+    return f"{sexe}{annee}{mois}"  # Retourne 5 premiers chiffres
+
+def _dates(colonne):
+    """Convertit une colonne de dates (JJ/MM/AAAA, AAAA-MM-JJ ou dates) en datetime64 (NaT si invalide)."""
+    import pandas as pd
+
+    if pd.api.types.is_datetime64_any_dtype(colonne):
+        return colonne
+    texte = colonne.astype("string").str.strip()
+    dates = pd.to_datetime(texte, format="%d/%m/%Y", errors="coerce")
+    return dates.fillna(pd.to_datetime(texte, format="%Y-%m-%d", errors="coerce"))
+
+def colonne_num_secu(colonne):
+    """Colonne de N° SS en texte, valeurs manquantes vides : une colonne numérique (Parquet entier
+    nullable, ou flottants dès qu'une valeur manque) est d'abord ramenée à des entiers, sans « .0 »."""
+    import pandas as pd
+
+    if pd.api.types.is_float_dtype(colonne):
+        colonne = colonne.round().astype("Int64")
+    elif pd.api.types.is_integer_dtype(colonne):
+        colonne = colonne.astype("Int64")
+    return colonne.astype("string").fillna("")
+
+# Contrôles de verifier_num_secu(), dans l'ordre du rapport d'erreurs
+_messages = [
+    "N° SS absent",
+    "N° SS mal formé (13 caractères attendus, 15 avec la clé)",
+    "clé de contrôle incorrecte",
+    "sexe incohérent avec la civilité",
+    "année incohérente avec la date de naissance",
+    "mois incohérent avec la date de naissance",
+]
+
+def verifier_num_secu(liste, colonne="N° SS", civilite="Civilite", naissance="Date_de_Naissance"):
+    """Vérifie et formate les N° SS de toute une liste de patients (DataFrame) en une passe.
+
+    Retourne un DataFrame de même index avec les colonnes num_secu (nettoyé, 13 caractères),
+    cle, num_secu_formatte, et erreur (texte vide si la ligne est correcte). Les contrôles
+    croisés avec la civilité et la date de naissance ne sont faits que si ces colonnes existent.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Numéros nettoyés sous forme de matrice d'octets (une ligne par patient, 15 colonnes)
+    brut = [_non_significatif.sub("", str(numero).upper())
+            for numero in colonne_num_secu(liste[colonne]).to_numpy(dtype=object)]
+    longueurs = np.fromiter(map(len, brut), dtype=np.int64, count=len(brut))
+    octets = np.array([numero[:15] for numero in brut], dtype="S15")
+    caracteres = octets.view(np.uint8).reshape(len(octets), 15)
+    chiffres = caracteres.astype(np.int64) - ord("0")
+    est_chiffre = (chiffres >= 0) & (chiffres <= 9)
+
+    # Forme : sexe 1/2, chiffres partout sauf le département (2A/2B admis), clé facultative
+    departement_2a = (caracteres[:, 5] == ord("2")) & (caracteres[:, 6] == ord("A"))
+    departement_2b = (caracteres[:, 5] == ord("2")) & (caracteres[:, 6] == ord("B"))
+    forme_valide = (((longueurs == 13) | ((longueurs == 15) & est_chiffre[:, 13:15].all(axis=1)))
+                    & ((caracteres[:, 0] == ord("1")) | (caracteres[:, 0] == ord("2")))
+                    & est_chiffre[:, 1:5].all(axis=1) & est_chiffre[:, 7:13].all(axis=1)
+                    & (est_chiffre[:, 5:7].all(axis=1) | departement_2a | departement_2b))
+
+    # Clé : 97 - (numéro mod 97), avec 2A → 19 − 1 000 000 et 2B → 18 − 2 000 000
+    chiffres_cle = np.where(est_chiffre[:, :13], chiffres[:, :13], 0)
+    chiffres_cle[:, 5] = np.where(departement_2a | departement_2b, 1, chiffres_cle[:, 5])
+    chiffres_cle[:, 6] = np.where(departement_2a, 9, np.where(departement_2b, 8, chiffres_cle[:, 6]))
+    valeurs = chiffres_cle @ (10 ** np.arange(12, -1, -1, dtype=np.int64))
+    valeurs -= np.where(departement_2a, 1000000, 0) + np.where(departement_2b, 2000000, 0)
+    cles = 97 - valeurs % 97
+
+    controles = np.zeros((len(brut), len(_messages)), dtype=bool)
+    controles[:, 0] = longueurs == 0
+    controles[:, 1] = (longueurs > 0) & ~forme_valide
+    controles[:, 2] = forme_valide & (longueurs == 15) & (chiffres[:, 13] * 10 + chiffres[:, 14] != cles)
+
+    # Contrôles croisés : sexe avec la civilité, année et mois avec la date de naissance
+    if civilite in liste.columns:
+        sexe_attendu = liste[civilite].map({"Monsieur": 1, "Madame": 2}).fillna(0).to_numpy(dtype=np.int64)
+        controles[:, 3] = forme_valide & (sexe_attendu > 0) & (chiffres[:, 0] != sexe_attendu)
+    if naissance in liste.columns:
+        dates = _dates(liste[naissance])
+        date_connue = dates.notna().to_numpy()
+        annee = dates.dt.year.fillna(0).to_numpy(dtype=np.int64) % 100
+        mois = dates.dt.month.fillna(0).to_numpy(dtype=np.int64)
+        mois_num_secu = chiffres[:, 3] * 10 + chiffres[:, 4]
+        mois_connu = (mois_num_secu >= 1) & (mois_num_secu <= 12)  # 20 à 42 ou 99 : mois inconnu à l'immatriculation
+        controles[:, 4] = forme_valide & date_connue & (chiffres[:, 1] * 10 + chiffres[:, 2] != annee)
+        controles[:, 5] = forme_valide & date_connue & mois_connu & (mois_num_secu != mois)
+
+    # Rapport : un texte par combinaison d'erreurs rencontrée, pas par ligne
+    codes = controles @ (1 << np.arange(len(_messages)))
+    combinaisons, positions = np.unique(codes, return_inverse=True)
+    textes = np.array([" ; ".join(message for rang, message in enumerate(_messages) if code >> rang & 1)
+                       for code in combinaisons], dtype=object)
+    erreurs = textes[positions.ravel()]
+
+    # Format 0 00 00 00 000 000 : insertion des espaces directement dans la matrice d'octets
+    espaces = np.full((len(brut), 18), ord(" "), dtype=np.uint8)
+    for source, cible in ((slice(0, 1), slice(0, 1)), (slice(1, 3), slice(2, 4)), (slice(3, 5), slice(5, 7)),
+                          (slice(5, 7), slice(8, 10)), (slice(7, 10), slice(11, 14)), (slice(10, 13), slice(15, 18))):
+        espaces[:, cible] = caracteres[:, source]
+    formattes = espaces.view("S18").ravel().astype(str)
+    numeros = caracteres[:, :13].copy().view("S13").ravel().astype(str)
+
+    return pd.DataFrame({
+        "num_secu": pd.Series(numeros, index=liste.index, dtype=object).where(forme_valide),
+        "cle": pd.Series(cles, index=liste.index).where(forme_valide).astype("Int64"),
+        "num_secu_formatte": pd.Series(formattes, index=liste.index, dtype=object).where(forme_valide),
+        "erreur": erreurs,
+    }, index=liste.index)
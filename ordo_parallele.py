@@ -0,0 +1,88 @@
+"""Rendu des ordonnances sur plusieurs processus, avec sortie dans l'ordre d'entrée.
+
+Les ordonnances sont réparties sur un pool de processus. Le nombre de rendus en cours est
+borné pour que la mémoire reste stable sur de très longues listes de patients, et chaque
+résultat est retourné dès qu'il est prêt, dans l'ordre de la liste.
+"""
+import os
+import time
+import traceback
+from collections import deque, namedtuple
+import ordo_mesures
+from ordo_decomposition import precalculer_tables
+from ordo_rendu import rendre_ordonnance
+
+# Résultat du rendu d'une ordonnance (pdf vaut None en cas d'échec, erreur contient alors le message) ;
+# mesures : mesures des étapes prises dans un processus de rendu, à fusionner dans le processus principal
+ResultatRendu = namedtuple("ResultatRendu", ["index", "patient_data", "pdf", "duree", "erreur", "avertissements", "mesures"],
+                           defaults=[None])
+
+# Contexte partagé par toutes les tâches d'un processus de rendu
+_contexte = {}
+
+def _initialiser_processus(preferences, date_ordonnance, preparer, transmettre_mesures=False):
+    """Mémorise les paramètres communs une seule fois par processus."""
+    _contexte["preferences"] = preferences
+    _contexte["date_ordonnance"] = date_ordonnance
+    _contexte["preparer"] = preparer
+    _contexte["transmettre_mesures"] = transmettre_mesures
+    if transmettre_mesures:
+        ordo_mesures.activer()
+    precalculer_tables()
+
+def _mesures():
+    """Mesures prises depuis la tâche précédente, si elles doivent remonter au processus principal."""
+    return ordo_mesures.instantane(reinitialiser_apres=True) if _contexte["transmettre_mesures"] else None
+
+def _rendre(index, element):
+    """Rend une ordonnance dans le processus courant sans jamais lever d'exception."""
+    debut = time.perf_counter()
+    patient_data = None
+    avertissements = []
+    try:
+        preparer = _contexte["preparer"]
+        patient_data = preparer(element) if preparer else element
+        pdf = rendre_ordonnance(_contexte["preferences"], patient_data,
+                                date_ordonnance=_contexte["date_ordonnance"], avertissements=avertissements)
+        return ResultatRendu(index, patient_data, pdf, time.perf_counter() - debut, None, avertissements, _mesures())
+    except Exception as erreur:
+        message = f"{type(erreur).__name__}: {erreur}"
+        if not isinstance(erreur, (ValueError, KeyError)):
+            message += "\n" + traceback.format_exc()
+        return ResultatRendu(index, patient_data, None, time.perf_counter() - debut, message, avertissements, _mesures())
+
+def rendre_en_serie(preferences, elements, date_ordonnance=None, preparer=None):
+    """Rend les ordonnances une à une dans le processus courant (même interface que rendre_en_parallele)."""
+    _initialiser_processus(preferences, date_ordonnance, preparer)
+    for index, element in enumerate(elements):
+        yield _rendre(index, element)
+
+def rendre_en_parallele(preferences, elements, processus=None, en_cours_max=None, date_ordonnance=None, preparer=None):
+    """Rend les ordonnances sur un pool de processus et les retourne dans l'ordre d'entrée.
+
+    `elements` peut être un itérateur : il n'est consommé qu'au fur et à mesure, et au plus
+    `en_cours_max` rendus sont en cours à la fois. `preparer`, s'il est fourni, est appelé dans
+    le processus de rendu pour transformer chaque élément en patient_data (fonction de module).
+    """
+    processus = processus or os.cpu_count() or 1
+    if processus == 1:
+        yield from rendre_en_serie(preferences, elements, date_ordonnance, preparer)
+        return
+    en_cours_max = en_cours_max or 4 * processus
+    from concurrent.futures import ProcessPoolExecutor  # multiprocessing n'est chargé que pour un vrai pool
+
+    with ProcessPoolExecutor(max_workers=processus, initializer=_initialiser_processus,
+                             initargs=(preferences, date_ordonnance, preparer, ordo_mesures.actif)) as pool:
+        en_cours = deque()
+        for index, element in enumerate(elements):
+            en_cours.append(pool.submit(_rendre, index, element))
+            # Retourner les résultats déjà prêts en tête de file, ou attendre si la file est pleine
+            while en_cours and (len(en_cours) >= en_cours_max or en_cours[0].done()):
+                yield _recevoir(en_cours.popleft().result())
+        while en_cours:
+            yield _recevoir(en_cours.popleft().result())
+
+def _recevoir(resultat):
+    """Reporte dans le processus principal les mesures prises par le processus de rendu."""
+    ordo_mesures.fusionner(resultat.mesures)
+    return resultat
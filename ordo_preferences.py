@@ -0,0 +1,105 @@
+import io
+import os
+import copy
+import json
+import hashlib
+import threading
+from ordo_mesures import etape, compter
+
+# Définir les préférences par défaut
+defaut_preferences = {
+    "structure": "Nom de la structure",
+    "adresse": "Adresse de la structure",
+    "finess": "Numéro FINESS",
+    "medecin": "Nom du médecin",
+    "rpps": "Numéro RPPS",
+    "logo": None,
+    "coordonnees": "Coordonnées complètes",
+    "marges": {
+        "haut": 20,
+        "bas": 20,
+        "gauche": 20,
+        "droite": 20
+    }
+}
+
+def completer_preferences(preferences):
+    """Complète des préférences partielles avec les valeurs par défaut (sans modifier les défauts)."""
+    resultat = copy.deepcopy(defaut_preferences)
+    resultat.update(preferences)
+    resultat["marges"] = {**defaut_preferences["marges"], **preferences.get("marges", {})}
+    return resultat
+
+# Cache des préférences : {chemin: (état du fichier, préférences)}
+_cache_preferences = {}
+
+def _etat_fichier(chemin):
+    """Retourne (date de modification, taille) du fichier, ou None s'il n'existe pas."""
+    try:
+        infos = os.stat(chemin)
+    except FileNotFoundError:
+        return None
+    return (infos.st_mtime_ns, infos.st_size)
+
+# Charger les préférences utilisateur
+def charger_preferences_utilisateur(chemin="preferences.json"):
+    """Charge les préférences ; le fichier n'est relu que s'il a changé depuis la dernière lecture."""
+    with etape("preferences"):
+        return _charger_preferences(chemin)
+
+def _charger_preferences(chemin):
+    etat = _etat_fichier(chemin)
+    en_cache = _cache_preferences.get(chemin)
+    if en_cache is None or en_cache[0] != etat:
+        if etat is None:
+            preferences = completer_preferences({})
+        else:
+            with open(chemin, "r") as f:
+                preferences = completer_preferences(json.load(f))
+        en_cache = (etat, preferences)
+        _cache_preferences[chemin] = en_cache
+    # Copie : l'interface modifie les préférences retournées
+    return copy.deepcopy(en_cache[1])
+
+def ecrire_json_atomique(donnees, chemin):
+    """Écrit un fichier JSON d'un seul coup : les lecteurs voient l'ancien ou le nouveau contenu, jamais un mélange."""
+    temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaire, "w") as f:
+        json.dump(donnees, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporaire, chemin)
+
+# Cache des images préparées : {chemin: (empreinte du fichier téléversé, état du fichier écrit)}
+_cache_images = {}
+
+# Préparer une image téléversée (logo, signature)
+def preparer_image(fichier, chemin):
+    """Place l'image sur un fond blanc et l'enregistre en PNG à `chemin`.
+
+    Si le même fichier a déjà été préparé vers `chemin` et que celui-ci n'a pas changé depuis,
+    l'image n'est ni décodée ni réécrite.
+    """
+    with etape("images"):
+        return _preparer_image(fichier, chemin)
+
+def _preparer_image(fichier, chemin):
+    donnees = fichier.getvalue() if hasattr(fichier, "getvalue") else fichier.read()
+    empreinte = hashlib.sha256(donnees).hexdigest()
+    en_cache = _cache_images.get(chemin)
+    if en_cache and en_cache[0] == empreinte and en_cache[1] == _etat_fichier(chemin):
+        compter("images_en_cache")
+        return chemin
+    compter("images_preparees")
+
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(donnees)).convert("RGBA")
+    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+    image = Image.alpha_composite(white_background, image).convert("RGB")
+    # Écriture dans un fichier temporaire puis remplacement : un rendu concurrent ne lit jamais une image partielle
+    temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(temporaire, format="PNG", optimize=True)
+    os.replace(temporaire, chemin)
+    _cache_images[chemin] = (empreinte, _etat_fichier(chemin))
+    return chemin
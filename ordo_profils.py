@@ -0,0 +1,127 @@
+"""Profils de prescripteurs, identifiés par leur numéro RPPS.
+
+Chaque médecin a son propre profil (structure, FINESS, coordonnées, marges, logos et
+signature) enregistré dans profils/<RPPS>.json. Les images sont rangées sous le nom de
+l'empreinte de leur contenu (profils/images/<sha256>.png) : un fichier n'est jamais
+modifié après écriture, deux profils qui partagent un logo partagent le fichier, et une
+signature ne peut pas être remplacée par celle d'un confrère.
+
+Le registre charge tous les profils une fois et ne relit que ceux qui changent sur le disque ;
+le dossier n'est parcouru de nouveau que lorsque sa date de modification change.
+Les gabarits d'en-tête compilés sont gardés par ordo_rendu.gabarit_pour(), commun à
+l'interface, à l'API et au lot.
+"""
+import copy
+import hashlib
+import io
+import os
+import re
+import threading
+from ordo_preferences import (charger_preferences_utilisateur, completer_preferences, ecrire_json_atomique,
+                              preparer_image, _etat_fichier)
+
+DOSSIER_PROFILS = "profils"
+_motif_rpps = re.compile(r"\d{11}")
+
+def rpps_valide(rpps):
+    """Indique si `rpps` est un numéro RPPS (11 chiffres)."""
+    return bool(_motif_rpps.fullmatch(str(rpps or "")))
+
+class RegistreProfils:
+    """Profils des prescripteurs chargés en mémoire."""
+
+    def __init__(self, dossier=DOSSIER_PROFILS):
+        self.dossier = dossier
+        self.dossier_images = os.path.join(dossier, "images")
+        self._verrou = threading.Lock()
+        self._profils = {}  # {rpps: (état du fichier, préférences)}
+        self._etat_dossier = None
+        self.recharger(forcer=True)
+
+    def _chemin(self, rpps):
+        return os.path.join(self.dossier, f"{rpps}.json")
+
+    def recharger(self, forcer=False):
+        """Relit les profils modifiés, ajoutés ou supprimés sur le disque depuis le dernier chargement.
+
+        Sans `forcer`, une seule lecture d'état du dossier tant qu'il n'a pas changé : un enregistrement
+        (écriture atomique), un ajout ou une suppression de profil modifie sa date.
+        """
+        with self._verrou:
+            etat = _etat_fichier(self.dossier)
+            if not forcer and etat == self._etat_dossier:
+                return
+            self._etat_dossier = etat
+            presents = set()
+            if os.path.isdir(self.dossier):
+                for nom in os.listdir(self.dossier):
+                    rpps, extension = os.path.splitext(nom)
+                    if extension == ".json" and rpps_valide(rpps):
+                        presents.add(rpps)
+                        self._charger(rpps)
+            for rpps in set(self._profils) - presents:
+                del self._profils[rpps]
+
+    def actualiser(self, rpps):
+        """Relit un seul profil s'il a changé sur le disque (une lecture d'état du fichier sinon)."""
+        with self._verrou:
+            if os.path.exists(self._chemin(rpps)):
+                self._charger(rpps)
+            else:
+                self._profils.pop(rpps, None)
+
+    def _charger(self, rpps):
+        chemin = self._chemin(rpps)
+        etat = _etat_fichier(chemin)
+        en_memoire = self._profils.get(rpps)
+        if en_memoire is None or en_memoire[0] != etat:
+            # charger_preferences_utilisateur complète le profil et copie les préférences
+            self._profils[rpps] = (etat, charger_preferences_utilisateur(chemin))
+
+    def liste(self):
+        """Retourne [(rpps, nom du médecin)] triée par nom."""
+        with self._verrou:
+            profils = [(rpps, preferences["medecin"]) for rpps, (_, preferences) in self._profils.items()]
+        return sorted(profils, key=lambda profil: (profil[1].upper(), profil[0]))
+
+    def __contains__(self, rpps):
+        with self._verrou:
+            return rpps in self._profils
+
+    def preferences(self, rpps):
+        """Retourne une copie des préférences du prescripteur (KeyError s'il est inconnu)."""
+        with self._verrou:
+            preferences = self._profils[rpps][1]
+        return copy.deepcopy(preferences)
+
+    def ajouter_image(self, fichier):
+        """Prépare une image téléversée et la range sous l'empreinte de son contenu ; retourne son chemin."""
+        donnees = fichier.getvalue() if hasattr(fichier, "getvalue") else fichier.read()
+        os.makedirs(self.dossier_images, exist_ok=True)
+        chemin = os.path.join(self.dossier_images, hashlib.sha256(donnees).hexdigest() + ".png")
+        if not os.path.exists(chemin):
+            preparer_image(io.BytesIO(donnees), chemin)
+        return chemin
+
+    def enregistrer(self, preferences):
+        """Enregistre (écriture atomique) le profil du prescripteur désigné par preferences["rpps"]."""
+        rpps = str(preferences.get("rpps", "")).strip()
+        if not rpps_valide(rpps):
+            raise ValueError(f"Numéro RPPS invalide : {rpps!r} (11 chiffres attendus)")
+        preferences = completer_preferences({**preferences, "rpps": rpps})
+        os.makedirs(self.dossier, exist_ok=True)
+        with self._verrou:
+            chemin = self._chemin(rpps)
+            ecrire_json_atomique(preferences, chemin)
+            self._profils[rpps] = (_etat_fichier(chemin), preferences)
+        return rpps
+
+# Registre partagé par processus
+_registres = {}
+
+def registre_profils(dossier=DOSSIER_PROFILS):
+    """Retourne le registre du dossier, chargé une seule fois par processus."""
+    registre = _registres.get(dossier)
+    if registre is None:
+        registre = _registres[dossier] = RegistreProfils(dossier)
+    return registre
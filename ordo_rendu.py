@@ -0,0 +1,367 @@
+"""Cœur de génération des ordonnances : décomposition, textes et mise en page PDF.
+
+Ce module n'importe ni streamlit ni pandas : il peut être utilisé par l'application,
+le mode lot ou un processus de rendu. fpdf n'est chargé qu'à la compilation du premier gabarit.
+"""
+import os
+import copy
+import json
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from nombres_fr import en_lettres
+from ordo_calendrier import libelle_dosage
+from ordo_catalogue import catalogue, UNITE_PAR_DEFAUT
+from ordo_decomposition import decomposer_posologie
+from ordo_mesures import etape, compter
+from ordo_num_secu import formater_num_secu, calculer_cle_securite_sociale
+
+# Définiton des unités de prise
+def formater_unite(medicament, quantite):
+    """Retourne la quantité en lettres et l'unité du catalogue (gélule, flacon, comprimé) accordées en français."""
+    fiche = catalogue().get(medicament)
+    singulier, pluriel, feminin = (fiche.singulier, fiche.pluriel, fiche.feminin) if fiche is not None else UNITE_PAR_DEFAUT
+    unite_nom = singulier if quantite == 1 else pluriel
+
+    # « une gélule », « vingt et une gélules »
+    quantite_text = en_lettres(quantite, feminin=feminin)
+
+    return quantite_text, unite_nom
+
+def calculer_age(date_naissance, aujourd_hui=None):
+    """Calcule l'âge à partir de la date de naissance."""
+    if date_naissance:
+        today = aujourd_hui or datetime.date.today()
+        age = today.year - date_naissance.year - ((today.month, today.day) < (date_naissance.month, date_naissance.day))
+        return age
+    return None  # Si la date est vide
+
+# Date en toutes lettres
+jours_fr = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
+mois_fr = ["janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre", "novembre", "décembre"]
+
+def date_en_lettres(jour):
+    """Retourne la date au format « lundi un janvier 2024 »."""
+    jour_lettres = en_lettres(jour.day)
+    jour_semaine = jours_fr[jour.weekday()]
+    mois_lettres = mois_fr[jour.month - 1]
+    return f"{jour_semaine} {jour_lettres} {mois_lettres} {jour.year}"
+
+# Mise en page de l'ordonnance : partie fixe (logos, structure, médecin)
+def dessiner_entete(pdf, preferences):
+    """Dessine l'en-tête fixe sur la page courante et retourne la liste des avertissements."""
+    avertissements = []
+
+# Initialiser les marges
+    pdf.set_left_margin(preferences["marges"]["gauche"])
+    pdf.set_right_margin(preferences["marges"]["droite"])
+    pdf.set_top_margin(preferences["marges"]["haut"])
+
+# Ajouter le premier logo
+    if preferences.get("logo") and os.path.exists(preferences["logo"]):
+        try:
+            pdf.image(preferences["logo"], x=10, y=10, w=40)
+        except RuntimeError:
+            avertissements.append("Erreur lors du chargement du logo : fichier invalide.")
+
+# Bloc info structure
+    pdf.set_xy(10, 50)
+    pdf.set_font("Arial", 'B', 10)
+    pdf.cell(0, 5, preferences["structure"], ln=True, align="L")
+    pdf.set_x(10)  # Réaligner l'adresse à gauche
+    pdf.set_font("Arial", '', 9)
+    pdf.cell(0, 5, preferences["adresse"], ln=True, align="L")
+    pdf.set_x(10)  # Réaligner le FINESS à gauche
+    pdf.set_font("Arial", '', 10)
+    pdf.cell(0, 5, f"FINESS: {preferences['finess']}", ln=True, align="L")
+
+# Ajout du deuxième logo (haut à droite)
+    if preferences.get("logo_droit") and os.path.exists(preferences["logo_droit"]):
+        try:
+            pdf.image(preferences["logo_droit"], x=150, y=10, w=40)  # Logo à droite (aligné au même niveau)
+        except RuntimeError:
+            avertissements.append("Erreur lors du chargement du logo de droite : fichier invalide.")
+
+# Bloc identification médecin
+    pdf.set_xy(150, 50)
+# Écriture du nom du médecin en gras
+    pdf.set_font("Arial", 'B', 10)
+    pdf.cell(0, 5, preferences['medecin'], ln=True, align="C")
+# Écriture du RPPS en standard mais dans la même cellule
+    pdf.set_font("Arial", '', 10)
+    pdf.set_x(150)  # Remet l'alignement en X à la position précédente
+    pdf.cell(0, 5, f"RPPS: {preferences['rpps']}", ln=True, align="C")
+
+    return avertissements
+
+# Mise en page de l'ordonnance : partie variable (patient, prescription, signature)
+def dessiner_corps(pdf, preferences, patient_data, decomposition=None, date_ordonnance=None):
+    """Dessine la partie propre au patient sous l'en-tête et retourne la liste des avertissements."""
+    avertissements = []
+    if decomposition is None:
+        decomposition = decomposer_posologie(patient_data["Medicament"], patient_data["Posologie"])
+    if date_ordonnance is None:
+        date_ordonnance = datetime.date.today()
+
+# Textes en toutes lettres (date, posologie, décomposition, durée, rythme)
+    with etape("textes"):
+        date_complete = date_en_lettres(date_ordonnance)
+        posologie_texte = en_lettres(patient_data['Posologie'])
+        textes_unites = {unite: (formater_unite(patient_data["Medicament"], quantite), en_lettres(unite))
+                         for unite, quantite in decomposition.items() if quantite > 0}
+        duree_texte = en_lettres(patient_data['Duree'])
+        rythme_texte = en_lettres(patient_data['Rythme_de_Delivrance'])
+    pdf.set_xy(150, 70)
+    pdf.set_font("Arial", 'B', 10)
+# Vérification et formatage de la date de naissance
+    if patient_data.get("Date_de_Naissance"):
+        date_naissance = patient_data["Date_de_Naissance"].strftime("%d/%m/%Y")
+        age = calculer_age(patient_data["Date_de_Naissance"], date_ordonnance)
+    else:
+        date_naissance = "Non renseignée"
+        age = "Non renseigné"
+# Ecrire la date sur le PDF
+    pdf.cell(0, 5, date_complete, ln=True, align="R")
+# Ecrire le infos patient sur le PDF
+    pdf.cell(0, 10, txt=f"{patient_data['Civilite']} {patient_data['Nom']} {patient_data['Prenom']}", ln=True, align="R")
+    pdf.set_y(pdf.get_y()-2)  # Réduit l'espacement
+    pdf.set_font("Arial", 'I', 9)
+    pdf.cell(0, 5, f"Né(e) le : {date_naissance} (Âge: {age})", ln=True, align="R")
+# Vérifier que les données SS sont bien valides avant d'afficher
+    num_secu = patient_data.get("Numero_Securite_Sociale", "")
+    cle_secu = calculer_cle_securite_sociale(num_secu) if num_secu else None
+    if cle_secu is not None:
+        pdf.set_font("Arial", '', 10)  # Texte standard
+        pdf.cell(0, 5, f"N° Sécurité Sociale : {formater_num_secu(num_secu)} - Clé : {cle_secu:02d}", ln=True, align="R")
+
+    pdf.set_font("Arial", 'B', 12)  # Texte en gras et taille 12
+
+# Titre
+# Définition du titre selon l'ALD 30
+    titre_prescription = "PRESCRIPTIONS ALD 30" if patient_data["ALD_30"] == "Oui" else "PRESCRIPTIONS MÉDICALES"
+# Position du titre
+    pdf.cell(0, 5, "", ln=True)  # Ligne vide pour espacement
+    y_position = pdf.get_y()  # Récupération de la position actuelle
+# Ajout du premier trait horizontal
+    pdf.set_line_width(0.5)
+    pdf.line(10, y_position, 200, y_position)  # Trait horizontal supérieur
+# Ajout du titre
+    pdf.set_xy(10, y_position + 3)  # Légèrement en dessous du trait
+    pdf.cell(190, 10, titre_prescription, border=0, ln=True, align="C")
+# Ajout du deuxième trait horizontal
+    y_position = pdf.get_y() + 2  # Nouvelle position après le titre
+    pdf.line(10, y_position, 200, y_position)  # Trait horizontal inférieur
+# Ajout d'un espacement après le titre
+    pdf.cell(0, 5, "", ln=True)
+
+# Ajouter médicament
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 20, f"{patient_data['Medicament']} : {posologie_texte} milligrammes par jour", ln=True, align="L")
+    pdf.set_font("Arial", '', 10)
+# Supprimer les unités de quantité 0 pour l'affichage dans le PDF
+    decomposition_finale = {unite: quantite for unite, quantite in decomposition.items() if quantite > 0}
+# Vérifier s'il reste des unités à afficher
+    if decomposition_finale:
+        pdf.cell(0, 5, "Soit :", ln=True, align="L")  # Titre de la décomposition
+        for unite in decomposition_finale:
+            (quantite_text, unite_nom), unite_text = textes_unites[unite]
+            pdf.cell(0, 5, f"- {quantite_text} {unite_nom} de {unite_text} milligrammes", ln=True, align="L")
+    else:
+        pdf.cell(0, 5, "Décomposition impossible pour ce médicament.", ln=True, align="L")
+    pdf.cell(0, 10, f"Pendant : {duree_texte} jours", ln=True, align="L")
+# Vérification pour ajouter (délivrance en une fois) si durée = rythme
+    if patient_data["Rythme_de_Delivrance"] == patient_data["Duree"]:
+        pdf.cell(0, 8, f"A délivrer tous les {rythme_texte} jours (délivrance en une fois)", ln=True, align="L")
+    else:
+        pdf.cell(0, 8, f"A délivrer tous les {rythme_texte} jours", ln=True, align="L")
+
+# Autres mentions
+    pdf.cell(0, 5, txt=f"Chevauchement autorisé: {patient_data.get('Chevauchement_Autorise', 'Non spécifié')}", ln=True, align="L")
+    pdf.multi_cell(0, 5, f"Lieu de délivrance :\n{patient_data['Lieu_de_Delivrance']}", align="L")
+
+# Position par défaut pour la signature et le nom du médecin
+    y_position_signature = pdf.get_y() + 10  # Position de référence en bas du document
+    y_position_text = y_position_signature  # Sans signature, le texte reste à la position initiale
+
+# Vérifier si une signature est téléversée
+    if preferences.get("signature") and os.path.exists(preferences["signature"]):
+        try:
+            pdf.image(preferences["signature"], x=150, y=y_position_signature, w=50)  # Signature alignée à droite
+            y_position_text = y_position_signature + 15  # Décaler le texte sous la signature
+        except RuntimeError:
+            avertissements.append("Erreur lors du chargement de la signature : fichier invalide.")
+
+# Ajouter le nom du médecin (sous la signature ou seul)
+    pdf.set_xy(150, y_position_text)  # Position définie
+    pdf.set_font("Arial", '', 10)
+    pdf.cell(50, 5, preferences["medecin"], ln=True, align="C")  # Centré
+
+    return avertissements
+
+# Page annexe : calendrier de délivrance
+def dessiner_calendrier(pdf, patient_data, livraisons):
+    """Ajoute une page avec le tableau des délivrances (date, jours couverts, unités de chaque dosage)."""
+    pdf.add_page()
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 10, "CALENDRIER DE DÉLIVRANCE", ln=True, align="C")
+    pdf.set_font("Arial", '', 10)
+    pdf.cell(0, 6, f"{patient_data['Civilite']} {patient_data['Nom']} {patient_data['Prenom']}", ln=True)
+    posologie = f"{patient_data['Posologie']:g}".replace(".", ",")
+    pdf.cell(0, 6, f"{patient_data['Medicament']} : {posologie} mg par jour pendant {patient_data['Duree']} jours, "
+                   f"délivrance tous les {patient_data['Rythme_de_Delivrance']} jours", ln=True)
+    pdf.cell(0, 6, f"Chevauchement autorisé : {patient_data.get('Chevauchement_Autorise', 'Non spécifié')}", ln=True)
+    pdf.cell(0, 4, "", ln=True)
+
+    dosages = list(livraisons[0].quantites) if livraisons else []
+    largeur_dosage = (pdf.w - pdf.l_margin - pdf.r_margin - 75) / max(len(dosages), 1)
+    pdf.set_font("Arial", 'B', 10)
+    pdf.cell(15, 7, "N°", border=1, align="C")
+    pdf.cell(40, 7, "Date", border=1, align="C")
+    pdf.cell(20, 7, "Jours", border=1, align="C")
+    for unite in dosages:
+        pdf.cell(largeur_dosage, 7, libelle_dosage(patient_data["Medicament"], unite), border=1, align="C")
+    if not dosages:
+        pdf.cell(largeur_dosage, 7, "Unités", border=1, align="C")
+    pdf.ln()
+    pdf.set_font("Arial", '', 10)
+    for livraison in livraisons:
+        pdf.cell(15, 7, str(livraison.numero), border=1, align="C")
+        pdf.cell(40, 7, f"{jours_fr[livraison.date.weekday()]} {livraison.date:%d/%m/%Y}", border=1, align="C")
+        pdf.cell(20, 7, str(livraison.jours), border=1, align="C")
+        for unite in dosages:
+            pdf.cell(largeur_dosage, 7, str(livraison.quantites[unite]), border=1, align="C")
+        if not dosages:
+            pdf.cell(largeur_dosage, 7, "Décomposition impossible", border=1, align="C")
+        pdf.ln()
+
+# Gabarit précompilé : l'en-tête est dessiné une seule fois par jeu de préférences
+class GabaritOrdonnance:
+    """En-tête d'ordonnance précompilé pour un jeu de préférences donné.
+
+    Les images (logos, signature) sont décodées une seule fois et le contenu de l'en-tête
+    est conservé tel quel : chaque ordonnance ne dessine plus que la partie patient.
+    """
+
+    def __init__(self, preferences):
+        with etape("gabarit"):
+            self._compiler(preferences)
+        compter("gabarits_compiles")
+
+    def _compiler(self, preferences):
+        from fpdf import FPDF  # fpdf (et PIL, qu'il importe) n'est chargé qu'au premier rendu
+
+        self.preferences = preferences
+        modele = FPDF()
+        modele.add_page()
+        debut = len(modele.pages[1])
+        self.avertissements = dessiner_entete(modele, preferences)
+        self.contenu = modele.pages[1][debut:]
+        # Décoder la signature dès maintenant : elle sera placée sans relecture du fichier
+        signature = preferences.get("signature")
+        if signature and os.path.exists(signature) and signature not in modele.images:
+            try:
+                extension = signature.rsplit(".", 1)[-1].lower()
+                info = modele._parsejpg(signature) if extension in ("jpg", "jpeg") else modele._parsepng(signature)
+                info["i"] = len(modele.images) + 1
+                modele.images[signature] = info
+            except Exception:
+                pass  # L'erreur sera signalée au placement de la signature
+        # État du document à la fin de l'en-tête
+        self.etat = {
+            "l_margin": modele.l_margin, "r_margin": modele.r_margin, "t_margin": modele.t_margin,
+            "x": modele.x, "y": modele.y,
+            "font_family": modele.font_family, "font_style": modele.font_style,
+            "font_size_pt": modele.font_size_pt, "font_size": modele.font_size,
+        }
+        self.cle_police = modele.font_family + modele.font_style
+        self._modele = modele
+
+    def nouveau_document(self):
+        """Retourne un nouveau FPDF dont la première page contient déjà l'en-tête."""
+        modele = self._modele
+        pdf = copy.copy(modele)
+        pdf.pages = dict(modele.pages)
+        pdf.offsets = {}
+        pdf.page_links = {}
+        pdf.links = {}
+        pdf.orientation_changes = dict(modele.orientation_changes)
+        pdf.font_files = dict(modele.font_files)
+        pdf.diffs = dict(modele.diffs)
+        # Les dictionnaires de polices et d'images sont modifiés à l'écriture du PDF : une copie par document
+        pdf.fonts = {cle: dict(info) for cle, info in modele.fonts.items()}
+        pdf.images = {cle: dict(info) for cle, info in modele.images.items()}
+        pdf.current_font = pdf.fonts[self.cle_police]
+        return pdf
+
+def _etat_fichier(chemin):
+    """Retourne (chemin, date de modification, taille) d'un fichier, ou None s'il n'existe pas."""
+    if not chemin:
+        return None
+    try:
+        infos = os.stat(chemin)
+    except OSError:
+        return (chemin, None, None)
+    return (chemin, infos.st_mtime_ns, infos.st_size)
+
+def cle_gabarit(preferences):
+    """Clé identifiant un gabarit : contenu des préférences et état des fichiers image."""
+    images = tuple(_etat_fichier(preferences.get(nom)) for nom in ("logo", "logo_droit", "signature"))
+    return (json.dumps(preferences, sort_keys=True, default=str), images)
+
+# Gabarits compilés, les plus récemment utilisés en dernier : un par prescripteur (interface, API, lot)
+_gabarits = OrderedDict()
+_gabarits_max = 32
+_verrou_gabarits = threading.Lock()
+
+def gabarit_pour(preferences):
+    """Retourne le gabarit des préférences, recompilé si elles ou une image ont changé."""
+    cle = cle_gabarit(preferences)
+    with _verrou_gabarits:
+        gabarit = _gabarits.get(cle)
+        if gabarit is not None:
+            _gabarits.move_to_end(cle)
+            return gabarit
+    gabarit = GabaritOrdonnance(copy.deepcopy(preferences))  # Compilé hors du verrou
+    with _verrou_gabarits:
+        gabarit = _gabarits.setdefault(cle, gabarit)
+        _gabarits.move_to_end(cle)
+        if len(_gabarits) > _gabarits_max:
+            _gabarits.popitem(last=False)
+    return gabarit
+
+def cle_ordonnance(preferences, patient_data, decomposition=None, date_ordonnance=None, calendrier=None):
+    """Empreinte de tout ce qui détermine le PDF : deux ordonnances de même clé sont identiques."""
+    if date_ordonnance is None:
+        date_ordonnance = datetime.date.today()
+    elements = [cle_gabarit(preferences), patient_data, sorted((decomposition or {}).items()), date_ordonnance,
+                catalogue().get(patient_data.get("Medicament"))]  # Noms d'unités du catalogue en vigueur
+    if calendrier is not None:
+        elements.append([(l.numero, l.date, l.jours, sorted(l.quantites.items())) for l in calendrier])
+    donnees = json.dumps(elements, sort_keys=True, default=str)
+    return hashlib.sha256(donnees.encode("utf-8")).hexdigest()
+
+def rendre_ordonnance(preferences, patient_data, decomposition=None, date_ordonnance=None, avertissements=None,
+                      calendrier=None):
+    """Génère une ordonnance complète et retourne le PDF en octets.
+
+    `calendrier` (liste de délivrances, voir ordo_calendrier) ajoute une page avec le tableau des délivrances.
+    """
+    return rendre_avec_gabarit(gabarit_pour(preferences), patient_data, decomposition, date_ordonnance, avertissements,
+                               calendrier)
+
+def rendre_avec_gabarit(gabarit, patient_data, decomposition=None, date_ordonnance=None, avertissements=None,
+                        calendrier=None):
+    """Comme rendre_ordonnance, à partir d'un gabarit déjà compilé (profil de prescripteur)."""
+    with etape("mise_en_page"):
+        pdf = gabarit.nouveau_document()
+        messages = gabarit.avertissements + dessiner_corps(pdf, gabarit.preferences, patient_data, decomposition,
+                                                           date_ordonnance)
+        if calendrier:
+            dessiner_calendrier(pdf, patient_data, calendrier)
+    if avertissements is not None:
+        avertissements.extend(messages)
+    with etape("serialisation"):
+        octets = pdf.output(dest="S").encode("latin1")
+    compter("ordonnances")
+    return octets
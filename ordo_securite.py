@@ -0,0 +1,215 @@
+"""Contrôles de sécurité des prescriptions : dose, durée, augmentation brutale, chevauchement.
+
+Règles appliquées à chaque ordonnance :
+- dose_max : posologie supérieure à la dose journalière maximale du médicament (catalogue) ;
+- duree_max : durée supérieure à la durée maximale de prescription (catalogue : 14 jours pour
+  la méthadone, 28 jours pour les autres stupéfiants et la buprénorphine) ;
+- augmentation : posologie augmentée de plus de AUGMENTATION_MAX par rapport à l'ordonnance
+  précédente du même médicament pour le même N° SS ;
+- chevauchement : ordonnance qui commence avant la fin d'un traitement précédent du même
+  médicament pour le même N° SS alors que le chevauchement n'est pas autorisé.
+
+Les règles sont évaluées en une passe sur un DataFrame (pandas/NumPy) par auditer_archive(),
+qui contrôle toute l'archive ; verifier_ordonnance() contrôle l'ordonnance en cours de saisie à
+partir de l'historique du patient, sans pandas. En ligne de commande :
+    python ordo_securite.py --archive ordonnances.sqlite --sortie audit.csv
+"""
+import argparse
+import datetime
+import math
+import time
+from collections import namedtuple
+from ordo_catalogue import catalogue
+
+# Augmentation relative au-delà de laquelle la posologie est signalée (0,5 : plus de 50 %)
+AUGMENTATION_MAX = 0.5
+
+# Une alerte : règle enfreinte et message à afficher
+Alerte = namedtuple("Alerte", ["regle", "message"])
+REGLES = ("dose_max", "duree_max", "augmentation", "chevauchement")
+
+# Colonnes lues dans l'archive par l'audit
+_colonnes = "id, date_creation, nom, prenom, num_secu, medicament, posologie, duree, chevauchement"
+
+def _nombre(valeur):
+    return f"{valeur:g}".replace(".", ",")
+
+def _flottant(valeur):
+    """Valeur numérique ou NaN, comme pd.to_numeric(errors="coerce")."""
+    try:
+        return float(valeur)
+    except (TypeError, ValueError):
+        return math.nan
+
+# Messages des alertes, formatés à partir d'une ligne (DataFrame de l'audit ou ordonnance seule)
+_messages = {
+    "dose_max": lambda ligne: (f"{_nombre(ligne.posologie)} mg/jour dépasse la dose maximale de "
+                               f"{_nombre(ligne.dose_max)} mg/jour ({ligne.reference})."),
+    "duree_max": lambda ligne: (f"Durée de {_nombre(ligne.duree)} jours supérieure à la durée maximale "
+                                f"de prescription de {_nombre(ligne.duree_max)} jours ({ligne.reference})."),
+    "augmentation": lambda ligne: (f"Posologie portée de {_nombre(ligne.posologie_precedente)} à "
+                                   f"{_nombre(ligne.posologie)} mg/jour "
+                                   f"(+{(ligne.posologie / ligne.posologie_precedente - 1) * 100:.0f} %) "
+                                   f"depuis l'ordonnance du {ligne.debut_precedent:%d/%m/%Y}."),
+    "chevauchement": lambda ligne: (f"Chevauchement non autorisé : le traitement précédent ({ligne.reference}) "
+                                    f"couvre jusqu'au {ligne.fin_precedente - datetime.timedelta(days=1):%d/%m/%Y}."),
+}
+
+# Ordonnance seule contrôlée par verifier_ordonnance(), avec ce qui précède dans l'historique
+_Ligne = namedtuple("_Ligne", ["reference", "posologie", "dose_max", "duree", "duree_max",
+                               "posologie_precedente", "debut_precedent", "fin_precedente"])
+
+def _references(fiches):
+    """Limites du catalogue indexées par nom et par alias (nom de référence, dose et durée maximales)."""
+    import pandas as pd
+
+    lignes = [(nom, fiche.nom, fiche.dose_max_jour_mg, fiche.duree_max_jours)
+              for fiche in map(fiches.__getitem__, fiches) for nom in (fiche.nom,) + fiche.alias]
+    references = pd.DataFrame(lignes, columns=["medicament", "reference", "dose_max", "duree_max"])
+    references[["dose_max", "duree_max"]] = references[["dose_max", "duree_max"]].astype("float64")
+    return references.set_index("medicament")
+
+def auditer(ordonnances, fiches=None):
+    """Applique les règles à toutes les ordonnances d'un DataFrame.
+
+    `ordonnances` a les colonnes date_creation (ISO), num_secu, medicament, posologie, duree et
+    chevauchement ; l'historique est reconstitué par N° SS et par médicament (alias compris).
+    Retourne un DataFrame avec une ligne par alerte : ordonnance (index d'origine), regle, message.
+    """
+    import numpy as np
+    import pandas as pd
+
+    fiches = fiches or catalogue()
+    donnees = pd.DataFrame({
+        "position": np.arange(len(ordonnances)),
+        "date_creation": ordonnances["date_creation"].astype(str).to_numpy(),
+        "num_secu": ordonnances["num_secu"].where(ordonnances["num_secu"] != "").to_numpy(),
+        "medicament": ordonnances["medicament"].to_numpy(),
+        "posologie": pd.to_numeric(ordonnances["posologie"], errors="coerce").to_numpy(dtype="float64"),
+        "duree": pd.to_numeric(ordonnances["duree"], errors="coerce").to_numpy(dtype="float64"),
+        "chevauchement": ordonnances["chevauchement"].to_numpy(),
+    }).join(_references(fiches), on="medicament")
+    donnees["debut"] = pd.to_datetime(donnees["date_creation"].str.slice(0, 10))
+    donnees["fin"] = donnees["debut"] + pd.to_timedelta(donnees["duree"].fillna(0), unit="D")
+
+    # Historique : ordonnances précédentes du même médicament pour le même N° SS, dans l'ordre chronologique
+    suivies = donnees[donnees["num_secu"].notna() & donnees["reference"].notna()]
+    suivies = suivies.sort_values(["num_secu", "reference", "date_creation", "position"], kind="stable")
+    groupes = suivies.groupby(["num_secu", "reference"], sort=False)
+    donnees["posologie_precedente"] = groupes["posologie"].shift()
+    donnees["debut_precedent"] = groupes["debut"].shift()
+    suivies = suivies.assign(fin_couverte=groupes["fin"].cummax())
+    donnees["fin_precedente"] = suivies.groupby(["num_secu", "reference"], sort=False)["fin_couverte"].shift()
+
+    posologie, precedente = donnees["posologie"], donnees["posologie_precedente"]
+    masques = {
+        "dose_max": posologie > donnees["dose_max"],
+        "duree_max": donnees["duree"] > donnees["duree_max"],
+        "augmentation": (precedente > 0) & (posologie > precedente * (1 + AUGMENTATION_MAX)),
+        "chevauchement": (donnees["chevauchement"] == "Non") & (donnees["debut"] < donnees["fin_precedente"]),
+    }
+    # Les masques sont vectorisés ; seuls les messages des alertes sont formatés ligne à ligne
+    alertes = [(ligne.position, rang, regle, _messages[regle](ligne))
+               for rang, regle in enumerate(REGLES) for ligne in donnees[masques[regle]].itertuples()]
+    alertes = pd.DataFrame(alertes, columns=["position", "rang", "regle", "message"])
+    alertes = alertes.sort_values(["position", "rang"], kind="stable")
+    alertes.insert(0, "ordonnance", ordonnances.index.to_numpy()[alertes["position"].to_numpy(dtype=np.int64)])
+    return alertes.drop(columns=["position", "rang"]).reset_index(drop=True)
+
+def _fin(ordonnance):
+    """Lendemain du dernier jour couvert par une ordonnance archivée (durée inconnue : 0 jour)."""
+    duree = _flottant(ordonnance["duree"])
+    return (datetime.date.fromisoformat(ordonnance["date_creation"][:10])
+            + datetime.timedelta(days=0 if math.isnan(duree) else duree))
+
+def verifier_ordonnance(patient_data, historique=(), date_ordonnance=None):
+    """Contrôle l'ordonnance en cours de saisie et retourne la liste de ses alertes.
+
+    `historique` contient les ordonnances archivées du patient (résultats de rechercher()) ;
+    l'ordonnance est datée du jour par défaut. Mêmes règles qu'auditer(), évaluées sans DataFrame :
+    le contrôle est refait à chaque réexécution du script Streamlit.
+    """
+    fiches = catalogue()
+    fiche = fiches.get(patient_data.get("Medicament"))
+    if fiche is None:
+        return []  # Médicament hors catalogue : aucune limite connue
+
+    debut = date_ordonnance or datetime.date.today()
+    limite = f"{debut.isoformat()}T23:59:59"
+    num_secu = patient_data.get("Numero_Securite_Sociale")
+    precedentes = []
+    if num_secu:
+        precedentes = [ordonnance for ordonnance in historique
+                       if ordonnance["date_creation"] <= limite and ordonnance["num_secu"] == num_secu
+                       and getattr(fiches.get(ordonnance["medicament"]), "nom", None) == fiche.nom]
+    # Tri stable : à date égale, l'ordre de l'historique est conservé
+    precedentes.sort(key=lambda ordonnance: ordonnance["date_creation"])
+    posologie_precedente = debut_precedent = fin_precedente = None
+    if precedentes:
+        derniere = precedentes[-1]
+        posologie_precedente = _flottant(derniere["posologie"])
+        debut_precedent = datetime.date.fromisoformat(derniere["date_creation"][:10])
+        fin_precedente = max(map(_fin, precedentes))
+
+    ligne = _Ligne(fiche.nom, _flottant(patient_data.get("Posologie")), _flottant(fiche.dose_max_jour_mg),
+                   _flottant(patient_data.get("Duree")), _flottant(fiche.duree_max_jours),
+                   posologie_precedente, debut_precedent, fin_precedente)
+    enfreintes = {
+        "dose_max": ligne.posologie > ligne.dose_max,
+        "duree_max": ligne.duree > ligne.duree_max,
+        "augmentation": (posologie_precedente is not None and posologie_precedente > 0
+                         and ligne.posologie > posologie_precedente * (1 + AUGMENTATION_MAX)),
+        "chevauchement": (patient_data.get("Chevauchement_Autorise") == "Non"
+                          and fin_precedente is not None and debut < fin_precedente),
+    }
+    return [Alerte(regle, _messages[regle](ligne)) for regle in REGLES if enfreintes[regle]]
+
+def ordonnances_archivees(connexion, depuis=None):
+    """Ordonnances de l'archive (DataFrame indexé par id), à partir de la date `depuis` si elle est donnée.
+
+    Les ordonnances de l'année précédant `depuis` sont aussi lues : elles servent d'historique.
+    """
+    import pandas as pd
+
+    requete = f"SELECT {_colonnes} FROM ordonnances"
+    parametres = ()
+    if depuis is not None:
+        requete += " WHERE date_creation >= ?"
+        parametres = ((depuis - datetime.timedelta(days=366)).isoformat(),)
+    requete += " ORDER BY date_creation, id"
+    return pd.read_sql_query(requete, connexion, params=parametres).set_index("id")
+
+def auditer_archive(connexion, depuis=None):
+    """Audit de l'archive : DataFrame des alertes avec l'identité du patient et la prescription."""
+    ordonnances = ordonnances_archivees(connexion, depuis)
+    alertes = auditer(ordonnances)
+    alertes = alertes.join(ordonnances, on="ordonnance")
+    if depuis is not None:
+        alertes = alertes[alertes["date_creation"] >= depuis.isoformat()]
+    return alertes.reset_index(drop=True), len(ordonnances)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Contrôles de sécurité de toutes les ordonnances de l'archive.")
+    parser.add_argument("--archive", default="ordonnances.sqlite", help="Archive SQLite des ordonnances")
+    parser.add_argument("--depuis", type=datetime.date.fromisoformat, help="Ne contrôler que les ordonnances à partir de cette date AAAA-MM-JJ")
+    parser.add_argument("--sortie", required=True, help="Fichier CSV des alertes")
+    args = parser.parse_args(argv)
+
+    from ordo_archive import ouvrir_archive
+
+    debut = time.perf_counter()
+    connexion = ouvrir_archive(args.archive)
+    try:
+        alertes, nombre = auditer_archive(connexion, args.depuis)
+    finally:
+        connexion.close()
+    alertes.to_csv(args.sortie, sep=";", index=False,
+                   columns=["ordonnance", "date_creation", "nom", "prenom", "num_secu", "medicament", "posologie", "duree",
+                            "regle", "message"])
+    print(f"{nombre} ordonnance(s) lue(s), {len(alertes)} alerte(s) écrites dans {args.sortie} "
+          f"({time.perf_counter() - debut:.2f} s)")
+    for regle, total in alertes["regle"].value_counts().reindex(REGLES, fill_value=0).items():
+        print(f"  {regle:<14}{total:>8}")
+
+if __name__ == "__main__":
+    main()